@@ -7,3 +7,7 @@ class PrimersJuJuError(Exception):
 class PrimersJuJuDataError(PrimersJuJuError):
     """error raised on bad input data"""
     pass
+
+class PrimersJuJuTimeoutError(PrimersJuJuError):
+    """error raised when a target exceeds its time budget"""
+    pass
@@ -1,10 +1,18 @@
 """
 Find unspecified transcripts that will be amplified by an amplicon.
-"""
 
+All of the isoforms at a locus are built into a splice graph, which finds the
+isoforms that contain a primer, with blocks that span a splice junction
+matching a junction of the isoform.  An isoform is amplified by a design if it
+contains both primers, and the amplicon length is found by mapping the outer
+ends of the primers to the isoform's transcript coordinates.
+"""
+from typing import NamedTuple
+import numpy as np
 from pycbio.hgdata.coords import Coords
 from .genome_data import bigbed_read_by_range
-from .transcript_features import TranscriptId, Transcript, bed_to_features
+from .transcript_features import TranscriptId, Transcript, ExonFeature, bed_to_features
+from .splice_graph import SpliceGraph
 
 class AmpliconIsoformTracks:
     """
@@ -17,28 +25,132 @@ class AmpliconIsoformTracks:
         self.tracks = [genome_data.get_track(t) for t in track_names]
 
     def _bed_to_transcript(self, track, bed):
-        return Transcript(TranscriptId(track.name, bed.name), bed,
-                          bed_to_features(self.genome_data, bed))
+        return Transcript(trans_id=TranscriptId(track.name, bed.name), bed=bed,
+                          features=bed_to_features(self.genome_data, bed))
 
     def _load_track_transcripts(self, gcoords, strand, track):
         return [self._bed_to_transcript(track, bed)
                 for bed in bigbed_read_by_range(track.bigbed, gcoords)
                 if bed.strand == strand]
 
-    def get_amplicon_isoformat_query(self, gregion1, gregion2, strand):
-        gcoords = Coords.adjrange(min(gregion1.start, gregion2.start),
-                                  max(gregion1.end, gregion2.end))
+    def get_amplicon_isoform_query(self, gregion1, gregion2, strand):
+        gcoords = Coords(gregion1.name, min(gregion1.start, gregion2.start),
+                         max(gregion1.end, gregion2.end), strand='+', size=gregion1.size)
         transcripts = []
         for track in self.tracks:
             transcripts.extend(self._load_track_transcripts(gcoords, strand, track))
         return AmpliconIsoformQuery(transcripts)
 
+    def get_target_amplicon_isoform_query(self, target_transcript):
+        "create a query for the isoforms overlapping the primer regions of a TargetTranscript"
+        return self.get_amplicon_isoform_query(target_transcript.region_5p.genome, target_transcript.region_3p.genome,
+                                               target_transcript.strand)
+
+class AmplifiedIsoform(NamedTuple):
+    "an isoform that is amplified by a primer design"
+    trans_id: TranscriptId
+    amplicon_length: int
+
+def _genome_ordered_primer_features(primer_design):
+    "exon features of the two primers, genomically left primer first, each in genomic order"
+    features_5p = sorted(primer_design.features_5p, key=lambda f: f.genome.start)
+    features_3p = sorted(primer_design.features_3p, key=lambda f: f.genome.start)
+    if features_5p[0].genome.start < features_3p[0].genome.start:
+        return features_5p, features_3p
+    else:
+        return features_3p, features_5p
+
 class AmpliconIsoformQuery:
     """
     Query for amplicons for a given pair of target regiosn
     """
     def __init__(self, transcripts):
         self.transcripts = transcripts
+        self.splice_graph = SpliceGraph(transcripts)
+        exons = [(trans_idx, feat)
+                 for trans_idx, transcript in enumerate(transcripts)
+                 for feat in transcript.features if isinstance(feat, ExonFeature)]
+        self.exon_starts = np.array([e[1].genome.start for e in exons], dtype=np.int64)
+        self.exon_ends = np.array([e[1].genome.end for e in exons], dtype=np.int64)
+        # offset of exon in the transcript, in genomic order
+        self.exon_trans_starts = np.array([e[1].trans.start for e in exons], dtype=np.int64)
+        # exons of transcript i are exon_bounds[i] to exon_bounds[i + 1]
+        self.exon_bounds = np.searchsorted(np.array([e[0] for e in exons], dtype=np.int64),
+                                           np.arange(len(transcripts) + 1))
+
+    def features_isoforms(self, features):
+        """isoforms that contain all of the exon features, such as from
+        a junction-spanning primer"""
+        return self.splice_graph.features_transcripts(features)
+
+    def _trans_pos(self, trans_idx, gpos):
+        "transcript position of a genomic position that is in an exon of the transcript"
+        first, last = self.exon_bounds[trans_idx], self.exon_bounds[trans_idx + 1]
+        exon_idx = first + np.searchsorted(self.exon_ends[first:last], gpos, side='right')
+        return gpos + self.exon_trans_starts[exon_idx] - self.exon_starts[exon_idx]
+
+    def _is_amplified(self, primer_design_list):
+        """Returns an array of designs by transcripts with the amplicon length
+        in each transcript, or -1 if the transcript is not amplified."""
+        amplicon_lengths = np.full((len(primer_design_list), len(self.transcripts)), -1, dtype=np.int64)
+        for design_idx, primer_design in enumerate(primer_design_list):
+            left_features, right_features = _genome_ordered_primer_features(primer_design)
+            bits = self.splice_graph.features_bits(left_features) & self.splice_graph.features_bits(right_features)
+            start, end = left_features[0].genome.start, right_features[-1].genome.end
+            for trans_idx in self.splice_graph.bits_trans_idxs(bits):
+                amplicon_lengths[design_idx, trans_idx] = (self._trans_pos(trans_idx, end - 1) + 1) - self._trans_pos(trans_idx, start)
+        return amplicon_lengths
+
+    def amplicon_lengths(self, primer_design_list):
+        """Returns an array of designs by transcripts with the amplicon length
+        in each transcript, or -1 if the transcript is not amplified.  This
+        maybe passed to query() and length_gaps() to avoid recomputing it."""
+        return self._is_amplified(primer_design_list)
+
+    def query(self, primer_design_list, *, exclude_trans_ids=(), amplicon_lengths=None):
+        """Returns a list, parallel to primer_design_list, of lists of
+        AmplifiedIsoform for each transcript amplified by the design, other than
+        ones in exclude_trans_ids."""
+        if len(primer_design_list) == 0:
+            return []
+        if amplicon_lengths is None:
+            amplicon_lengths = self._is_amplified(primer_design_list)
+        exclude_trans_ids = frozenset(exclude_trans_ids)
+        results = []
+        for design_lengths in amplicon_lengths:
+            results.append([AmplifiedIsoform(self.transcripts[trans_idx].trans_id, int(design_lengths[trans_idx]))
+                            for trans_idx in np.nonzero(design_lengths >= 0)[0]
+                            if self.transcripts[trans_idx].trans_id not in exclude_trans_ids])
+        return results
+
+    def length_gaps(self, primer_design_list, target_transcript, *, amplicon_lengths=None):
+        """Returns a list, parallel to primer_design_list, of the minimum
+        difference between the length of the design's amplicon from
+        target_transcript and the amplicons of the other isoforms it
+        amplifies, or None if no other isoforms are amplified.  Isoforms that
+        give the same product as the target, such as the target from another
+        track, are not counted as competing."""
+        if len(primer_design_list) == 0:
+            return []
+        if amplicon_lengths is None:
+            amplicon_lengths = self._is_amplified(primer_design_list)
+        target_lengths = np.array([pd.amplicon_length for pd in primer_design_list], dtype=np.int64)
+        gaps = np.abs(amplicon_lengths - target_lengths[:, None])
+        competing = amplicon_lengths >= 0
+        for design_idx, trans_idx in zip(*np.nonzero(competing & (gaps == 0))):
+            if _same_product(primer_design_list[design_idx], self.transcripts[trans_idx], target_transcript):
+                competing[design_idx, trans_idx] = False
+        no_gap = np.iinfo(np.int64).max
+        min_gaps = np.where(competing, gaps, no_gap).min(axis=1, initial=no_gap)
+        return [None if gap == no_gap else int(gap) for gap in min_gaps]
+
+def _amplicon_blocks(transcript, start, end):
+    "exon blocks of the transcript within a genomic range"
+    return [(max(f.genome.start, start), min(f.genome.end, end)) for f in transcript.features
+            if isinstance(f, ExonFeature) and (f.genome.start < end) and (f.genome.end > start)]
 
-    def _is_amplified(self, primer_design, transcript):
-        pass
+def _same_product(primer_design, transcript, target_transcript):
+    "does the design amplify the same exon structure from the two transcripts"
+    left_features, right_features = _genome_ordered_primer_features(primer_design)
+    start, end = left_features[0].genome.start, right_features[-1].genome.end
+    return _amplicon_blocks(transcript, start, end) == _amplicon_blocks(target_transcript, start, end)
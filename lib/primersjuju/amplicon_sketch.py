@@ -0,0 +1,165 @@
+"""
+Isoform-specificity scoring by comparing k-mer sketches of amplicons to a
+sketch index of the transcriptome.  This finds transcripts that share
+sequence with an amplicon, such as paralogs or readthrough transcripts, which
+coordinate-based checks miss.
+
+Sketches are FracMinHash: canonical k-mers are hashed and only hashes below
+2^64/scale are kept, so the fraction of an amplicon's sketch found in a
+transcript's sketch estimates the fraction of the amplicon's k-mers contained
+in the transcript.
+
+Index files in the index directory:
+  - sketch_hashes.npy - sketch hashes of all transcripts, sorted
+  - sketch_seqs.npy - index in seqs.tsv of the transcript of each hash
+  - seqs.tsv - transcript name and number of sketch hashes
+  - index.json - parameters and the 2bit size and modification time, used to
+    rebuild the index if the 2bit changes.  Written last.
+"""
+import os
+import os.path as osp
+import json
+from typing import NamedTuple
+from dataclasses import dataclass, KW_ONLY
+import numpy as np
+from . import PrimersJuJuError
+from .seq_codes import NON_ACGT, encode_seq, reverse_complement_codes, twobit_stamp, read_twobit_seqs
+from .uniqueness_query import split_transcriptome_id
+
+_index_version = 1
+_MAX_KMER_SIZE = 31
+
+@dataclass
+class AmpliconSketchSpec:
+    """Specification of a transcriptome k-mer sketch index.  The index is
+    built in index_dir on first use and rebuilt if the 2bit file changes."""
+    twobit: str
+    index_dir: str
+    _: KW_ONLY
+    kmer_size: int = 21
+    scale: int = 4  # keep about 1/scale of the k-mers
+    max_hash_seqs: int = 1000  # ignore hashes in more than this many transcripts, such as repeats
+    top_n: int = 5  # number of similar transcripts to report
+    min_containment: float = 0.2  # minimum fraction of the amplicon sketch in a transcript to report
+
+class SimilarTranscript(NamedTuple):
+    "a non-target transcript sharing sequence with an amplicon"
+    name: str
+    containment: float  # fraction of the amplicon sketch in the transcript
+    shared: int  # number of sketch hashes shared
+
+def _mix_hash(vals):
+    "splitmix64 finalizer, wraps around on overflow"
+    vals = vals ^ (vals >> np.uint64(30))
+    vals = vals * np.uint64(0xbf58476d1ce4e5b9)
+    vals = vals ^ (vals >> np.uint64(27))
+    vals = vals * np.uint64(0x94d049bb133111eb)
+    return vals ^ (vals >> np.uint64(31))
+
+def _rolling_kmers(codes, kmer_size):
+    "2-bit k-mer values at each start position, with a mask of ones without non-ACGT bases"
+    num = len(codes) - kmer_size + 1
+    vals = np.zeros(num, dtype=np.uint64)
+    for j in range(kmer_size):
+        vals = (vals << np.uint64(2)) | (codes[j:j + num] & 3).astype(np.uint64)
+    bad = np.concatenate(([0], np.cumsum(codes == NON_ACGT)))
+    return vals, (bad[kmer_size:kmer_size + num] - bad[:num]) == 0
+
+def kmer_hashes(codes, kmer_size):
+    "hashes of the canonical k-mers of an encoded sequence, skipping k-mers with non-ACGT bases"
+    if len(codes) < kmer_size:
+        return np.zeros(0, dtype=np.uint64)
+    fwd, valid = _rolling_kmers(codes, kmer_size)
+    rev, _ = _rolling_kmers(reverse_complement_codes(codes), kmer_size)
+    return _mix_hash(np.minimum(fwd, rev[::-1])[valid])
+
+def sketch_hashes(codes, kmer_size, scale):
+    "sorted unique FracMinHash sketch of an encoded sequence"
+    hashes = kmer_hashes(codes, kmer_size)
+    return np.unique(hashes[hashes < np.uint64((2 ** 64 - 1) // scale)])
+
+def _index_info(spec):
+    return {"version": _index_version, "kmer_size": spec.kmer_size, "scale": spec.scale,
+            "twobit": osp.abspath(spec.twobit), "twobit_stamp": twobit_stamp(spec.twobit)}
+
+def _index_current(spec):
+    info_file = osp.join(spec.index_dir, "index.json")
+    if not osp.exists(info_file):
+        return False
+    with open(info_file) as fh:
+        return json.load(fh) == _index_info(spec)
+
+def amplicon_sketch_index_build(spec):
+    """build the index for an AmpliconSketchSpec"""
+    os.makedirs(spec.index_dir, exist_ok=True)
+    info_file = osp.join(spec.index_dir, "index.json")
+    if osp.exists(info_file):
+        os.unlink(info_file)
+    seq_infos = []
+    hashes_list = []
+    for seq_name, codes in read_twobit_seqs(spec.twobit):
+        hashes_list.append(sketch_hashes(codes, spec.kmer_size, spec.scale))
+        seq_infos.append((seq_name, len(hashes_list[-1])))
+    hashes = np.concatenate(hashes_list) if len(hashes_list) > 0 else np.zeros(0, dtype=np.uint64)
+    seqs = np.repeat(np.arange(len(seq_infos), dtype=np.uint32), np.array([si[1] for si in seq_infos], dtype=np.int64))
+    order = np.argsort(hashes, kind="stable")
+    for name, arr in (("sketch_hashes", hashes[order]), ("sketch_seqs", seqs[order])):
+        np.save(osp.join(spec.index_dir, name + ".tmp.npy"), arr)
+        os.replace(osp.join(spec.index_dir, name + ".tmp.npy"), osp.join(spec.index_dir, name + ".npy"))
+    with open(osp.join(spec.index_dir, "seqs.tsv"), "w") as fh:
+        for seq_info in seq_infos:
+            print(*seq_info, sep='\t', file=fh)
+    with open(info_file, "w") as fh:
+        json.dump(_index_info(spec), fh)
+
+class AmpliconSketchIndex:
+    """Memory-mapped transcriptome sketch index.  The index is built if
+    needed.  Queries are thread-safe."""
+    def __init__(self, spec):
+        if not (1 <= spec.kmer_size <= _MAX_KMER_SIZE):
+            raise PrimersJuJuError(f"AmpliconSketchSpec kmer_size must be in the range 1 to {_MAX_KMER_SIZE}, got {spec.kmer_size}")
+        self.spec = spec
+        if not _index_current(spec):
+            amplicon_sketch_index_build(spec)
+        self.hashes = np.load(osp.join(spec.index_dir, "sketch_hashes.npy"), mmap_mode="r")
+        self.seqs = np.load(osp.join(spec.index_dir, "sketch_seqs.npy"), mmap_mode="r")
+        with open(osp.join(spec.index_dir, "seqs.tsv")) as fh:
+            self.seq_names = [line.split('\t')[0] for line in fh]
+        self.seq_trans_ids = [split_transcriptome_id(name)[0] for name in self.seq_names]
+
+    def _shared_counts(self, sketches):
+        """count sketch hashes shared between each sketch and each transcript,
+        returning arrays of sketch index, transcript index, and count"""
+        query_idxs = np.repeat(np.arange(len(sketches)), np.array([len(s) for s in sketches], dtype=np.int64))
+        query_hashes = np.concatenate(sketches) if len(sketches) > 0 else np.zeros(0, dtype=np.uint64)
+        los = np.searchsorted(self.hashes, query_hashes, side='left')
+        cnts = np.searchsorted(self.hashes, query_hashes, side='right') - los
+        cnts[cnts > self.spec.max_hash_seqs] = 0
+        offsets = np.arange(cnts.sum()) - np.repeat(np.cumsum(cnts) - cnts, cnts)
+        seq_idxs = self.seqs[np.repeat(los, cnts) + offsets].astype(np.int64)
+        keys, shared = np.unique(np.repeat(query_idxs, cnts) * len(self.seq_names) + seq_idxs, return_counts=True)
+        return keys // len(self.seq_names), keys % len(self.seq_names), shared
+
+    def query(self, amplicons, exclude_names_list):
+        """Find the top non-target transcripts similar to each amplicon
+        sequence.  exclude_names_list is parallel to amplicons, with the
+        transcript names to exclude for each, which are compared by trans_id,
+        as index names maybe in the transcriptome isPcr form of
+        <trans_id>__<gene_name>.  Returns a
+        parallel list of lists of SimilarTranscript, most similar first."""
+        exclude_trans_ids_list = [frozenset(split_transcriptome_id(name)[0] for name in exclude_names)
+                                  for exclude_names in exclude_names_list]
+        sketches = [sketch_hashes(encode_seq(amplicon), self.spec.kmer_size, self.spec.scale)
+                    for amplicon in amplicons]
+        sketch_idxs, seq_idxs, shared = self._shared_counts(sketches)
+        sketch_sizes = np.array([max(len(s), 1) for s in sketches], dtype=np.int64)
+        containments = shared / sketch_sizes[sketch_idxs] if len(sketch_idxs) > 0 else np.zeros(0)
+        keep = containments >= self.spec.min_containment
+        order = np.lexsort((-containments[keep], sketch_idxs[keep]))
+        results = [[] for _ in amplicons]
+        for sketch_idx, seq_idx, cnt, containment in zip(sketch_idxs[keep][order], seq_idxs[keep][order],
+                                                         shared[keep][order], containments[keep][order]):
+            similar = results[sketch_idx]
+            if (len(similar) < self.spec.top_n) and (self.seq_trans_ids[seq_idx] not in exclude_trans_ids_list[sketch_idx]):
+                similar.append(SimilarTranscript(self.seq_names[seq_idx], float(containment), int(cnt)))
+        return results
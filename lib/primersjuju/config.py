@@ -2,21 +2,65 @@
 # your config.py should import this and construct a instance of
 # PrimersJuJuConfig in a variable named 'config'
 #
-from primersjuju.uniqueness_query import UniquenessQuery, IsPcrServerSpec
+from typing import Sequence
+from primersjuju import PrimersJuJuDataError
+from primersjuju.uniqueness_query import UniquenessQuery, IsPcrServerSpec, IsPcrServerStats
+from primersjuju.kmer_pcr import LocalPcrSpec
+from primersjuju.kmer_freq import KmerFreqSpec, KmerFreqTable, KmerFreqFilter
+from primersjuju.uniqueness_cache import PcrResultCache
 from primersjuju.genome_data import GenomeData
+from primersjuju.amplicon_isoform_query import AmpliconIsoformTracks
+from primersjuju.amplicon_sketch import AmpliconSketchSpec, AmpliconSketchIndex
+from primersjuju.junction_index import JunctionIndexSpec, JunctionIndex
 
 class GenomeConfig:
     """Configuration for a particular assembly.  Setting either of ispcr specs to None
-    cases the corresponding off target query to be skupped."""
+    cases the corresponding off target query to be skupped.  A LocalPcrSpec maybe
+    used instead of an IsPcrServerSpec to query a local k-mer index.  Either
+    ispcr spec maybe a list of equivalent replica servers to spread queries
+    across.  If kmer_freq_specs, normally one for the genome and one for the
+    transcriptome, are specified, primer 3' ends in high-frequency k-mers are
+    avoided.  If amplicon_isoform_track_names are specified, designs are
+    checked for other isoforms in these tracks that they amplify.  If
+    amplicon_sketch_spec is specified, amplicons are compared to a k-mer sketch
+    index of the transcriptome to find similar non-target transcripts.  A
+    junction_index_spec is required by the suggest-regions command."""
 
     def __init__(self,
                  genome_data: GenomeData,
-                 genome_ispcr_spec: IsPcrServerSpec,
-                 transcriptome_ispcr_spec: IsPcrServerSpec):
+                 genome_ispcr_spec: IsPcrServerSpec | LocalPcrSpec | Sequence[IsPcrServerSpec],
+                 transcriptome_ispcr_spec: IsPcrServerSpec | LocalPcrSpec | Sequence[IsPcrServerSpec],
+                 *,
+                 uniqueness_cache_db: str = None,
+                 uniqueness_cache_max_entries: int = 1_000_000,
+                 uniqueness_max_off_targets: int = None,
+                 ispcr_replica_max_failures: int = 3,
+                 kmer_freq_specs: Sequence[KmerFreqSpec] = None,
+                 amplicon_isoform_track_names: Sequence[str] = None,
+                 amplicon_sketch_spec: AmpliconSketchSpec = None,
+                 junction_index_spec: JunctionIndexSpec = None):
         self.genome_data = genome_data
         self.genome_ispcr_spec = genome_ispcr_spec
         self.transcriptome_ispcr_spec = transcriptome_ispcr_spec
+        # SQLite database to cache isPcr results between runs, None to not cache
+        self.uniqueness_cache_db = uniqueness_cache_db
+        self.uniqueness_cache_max_entries = uniqueness_cache_max_entries
+        # stop reading isPcr results for a primer pair after this many off-target
+        # hits, with counts reported as ≥N if more hits were not read; None reads
+        # all results.  When set, each primer pair is a separate streamed isPcr
+        # query, rather than being batched with the other pairs.
+        self.uniqueness_max_off_targets = uniqueness_max_off_targets
+        # replica servers are dropped after this many consecutive failures
+        self.ispcr_replica_max_failures = ispcr_replica_max_failures
         self.__uniqueness_query = None   # lazy
+        self.kmer_freq_specs = kmer_freq_specs
+        self.__kmer_freq_filter = None   # lazy
+        self.amplicon_isoform_track_names = amplicon_isoform_track_names
+        self.__amplicon_isoform_tracks = None   # lazy
+        self.amplicon_sketch_spec = amplicon_sketch_spec
+        self.__amplicon_sketch_index = None   # lazy
+        self.junction_index_spec = junction_index_spec
+        self.__junction_index = None   # lazy
 
     @property
     def genome_name(self):
@@ -27,10 +71,50 @@ class GenomeConfig:
         "lazy get/create UniquenessQuery object, or None if not configured"
         if ((self.__uniqueness_query is None) and
             ((self.genome_ispcr_spec is not None) or (self.transcriptome_ispcr_spec is not None))):
+            pcr_cache = None
+            if self.uniqueness_cache_db is not None:
+                pcr_cache = PcrResultCache(self.uniqueness_cache_db, max_entries=self.uniqueness_cache_max_entries)
             self.__uniqueness_query = UniquenessQuery(self.genome_data,
-                                                      self.genome_ispcr_spec, self.transcriptome_ispcr_spec)
+                                                      self.genome_ispcr_spec, self.transcriptome_ispcr_spec,
+                                                      pcr_cache=pcr_cache,
+                                                      max_off_targets=self.uniqueness_max_off_targets,
+                                                      replica_max_failures=self.ispcr_replica_max_failures)
         return self.__uniqueness_query
 
+    @property
+    def kmer_freq_filter(self) -> KmerFreqFilter:
+        "lazy get/create KmerFreqFilter object, or None if not configured"
+        if (self.__kmer_freq_filter is None) and self.kmer_freq_specs:
+            self.__kmer_freq_filter = KmerFreqFilter([KmerFreqTable(spec) for spec in self.kmer_freq_specs])
+        return self.__kmer_freq_filter
+
+    @property
+    def amplicon_isoform_tracks(self) -> AmpliconIsoformTracks:
+        "lazy get/create AmpliconIsoformTracks object, or None if not configured"
+        if (self.__amplicon_isoform_tracks is None) and self.amplicon_isoform_track_names:
+            self.__amplicon_isoform_tracks = AmpliconIsoformTracks(self.genome_data, self.amplicon_isoform_track_names)
+        return self.__amplicon_isoform_tracks
+
+    @property
+    def amplicon_sketch_index(self) -> AmpliconSketchIndex:
+        "lazy get/create AmpliconSketchIndex object, or None if not configured"
+        if (self.__amplicon_sketch_index is None) and (self.amplicon_sketch_spec is not None):
+            self.__amplicon_sketch_index = AmpliconSketchIndex(self.amplicon_sketch_spec)
+        return self.__amplicon_sketch_index
+
+    @property
+    def junction_index(self) -> JunctionIndex:
+        "lazy get/create JunctionIndex object, or None if not configured"
+        if (self.__junction_index is None) and (self.junction_index_spec is not None):
+            self.__junction_index = JunctionIndex(self.junction_index_spec, self.genome_data)
+        return self.__junction_index
+
+    def uniqueness_server_stats(self) -> Sequence[IsPcrServerStats]:
+        "query statistics for isPcr servers, empty if no queries were made"
+        if self.__uniqueness_query is None:
+            return []
+        return self.__uniqueness_query.server_stats()
+
 class Primer3Config:
     """Options to pass to primer3, see primer3 manual Global Input Tags for a
     description.
@@ -50,6 +134,50 @@ class Primer3Config:
         self.PRIMER_MIN_SIZE = 18
         self.PRIMER_MAX_SIZE = 22
 
+        # How pairs are picked: "primer3" uses the primer3 pair search,
+        # "split" has primer3 pick left and right candidate lists independently
+        # and pairs them in PrimersJuJu, which is much faster with the very large
+        # product size ranges used for full-length isoforms.
+        self.pair_picking = "primer3"
+        self.split_num_candidates = 100  # PRIMER_NUM_RETURN for each side with "split"
+
+        # Screen primer regions for oligos that could pass the primer3 GC, Tm,
+        # poly-X, and 3' end constraints before running primer3.  Targets with no
+        # feasible oligos skip primer3 and OK regions are narrowed to the feasible
+        # windows.  Tm limits are relaxed by prescreen_tm_slack to be safe.
+        self.prescreen = False
+        self.prescreen_tm_slack = 1.0
+
+        # Wall-clock budget in seconds for all primer3 runs for a target.  If
+        # set, primer3 runs in a worker process that is killed when the budget is
+        # exceeded and the target gets a TIMEOUT status.
+        self.time_budget = None
+
+        # Iterative design, used when uniqueness is checked.  Oligos from pairs
+        # that are not unique are excluded by masking their 3' ends and primer3
+        # is rerun, until design_min_good GOOD pairs are found or
+        # design_max_rounds is reached.
+        self.design_max_rounds = 1
+        self.design_min_good = 1
+
+        # When other isoforms amplified are checked, designs whose target
+        # amplicon differs in length from every other isoform's amplicon by at
+        # least this many bases, so that they can be separated on a gel, are
+        # ranked first, followed by the designs with the largest gap.  None to
+        # not rank by length.
+        self.design_min_length_gap = None
+
+        # When a variant store is configured, designs with variants in the
+        # primers are ranked after those without, and designs with a variant
+        # within this many bases of a primer's 3' end, where it is most likely
+        # to prevent priming, are ranked last.
+        self.design_variant_3p_bases = 5
+
+        # Exclude primer 3' ends in runs of at least this many soft-masked
+        # (lower-case) bases in the genome, normally repeats, as these are
+        # unlikely to be unique.  None to not use soft-masking.
+        self.soft_mask_min_run = None
+
         # library files
         self.misprime_lib = None
         self.mishyb_lib = None
@@ -62,9 +190,17 @@ class PrimersJuJuConfig:
     def __init__(self, *, primer3_config=_default_primer3_config):
         self.genomes = {}
         self.primer3 = primer3_config
+        self.primer3_variants = {}  # named Primer3Config objects for sweep
 
         # derived, not set in config file
         self.genome = None  # selected genome, set at load from genomes
 
     def add_genome(self, genome_config: GenomeConfig):
         self.genomes[genome_config.genome_name] = genome_config
+
+    def add_primer3_variant(self, name, primer3_config: Primer3Config):
+        """add a named primer3 configuration, used to compare parameters with
+        the sweep sub-command"""
+        if name in self.primer3_variants:
+            raise PrimersJuJuDataError(f"duplicate primer3 variant name '{name}'")
+        self.primer3_variants[name] = primer3_config
@@ -6,11 +6,14 @@ from typing import Sequence
 from dataclasses import dataclass
 from pycbio.sys.symEnum import SymEnum
 from pycbio.hgdata.coords import Coords
-from . import PrimersJuJuError
-from .primer3_interface import Primer3Results, Primer3Pair, primer3_design
+from . import PrimersJuJuError, PrimersJuJuTimeoutError
+from .primer3_interface import Primer3Results, Primer3Pair, primer3_design, primer3_deadline, primer3_empty_results, primer3_oligo_3p_positions
 from .primer_targets import PrimerTargets, TargetTranscript
-from .transcript_features import Features, transcript_range_to_features, features_to_transcript_coords, features_to_genomic_coords
-from .primer_uniqueness import PrimerUniqueness, primer_uniqueness_query, primer_uniqueness_none
+from .transcript_features import Features, ExonFeature, transcript_range_to_features, features_to_transcript_coords, features_to_genomic_coords
+from .primer_uniqueness import PrimerUniqueness, PrimerPairTarget, primer_uniqueness_query_batch, primer_uniqueness_none
+from .amplicon_isoform_query import AmplifiedIsoform
+from .amplicon_sketch import SimilarTranscript
+from .variant_store import PrimerVariant
 
 class DesignStatus(SymEnum):
     """Status of the design for a given target.  Smaller is better"""
@@ -18,6 +21,7 @@ class DesignStatus(SymEnum):
     NOT_GENOME_UNIQUE = 1
     NOT_TRANSCRIPTOME_UNIQUE = 2
     NO_PRIMERS = 3
+    TIMEOUT = 4
 
 @dataclass
 class PrimerDesign:
@@ -30,6 +34,15 @@ class PrimerDesign:
     uniqueness: PrimerUniqueness
     # ranking by stability and uniqueness
     priority: int = None
+    # other isoforms amplified, None if not checked
+    amplified_isoforms: Sequence[AmplifiedIsoform] = None
+    # minimum difference in amplicon length from other isoforms amplified,
+    # None if not checked or no other isoforms are amplified
+    isoform_length_gap: int = None
+    # non-target transcripts sharing sequence with the amplicon, None if not checked
+    similar_transcripts: Sequence[SimilarTranscript] = None
+    # variants overlapping the primers, None if not checked
+    primer_variants: Sequence[PrimerVariant] = None
 
     def spans_splice_juncs(self):
         return (len(self.features_5p) > 1) or (len(self.features_3p) > 1)
@@ -54,6 +67,13 @@ class PrimerDesign:
         print("    priority", self.priority, file=fh)
         print("    amplicon_coords", self.amplicon_coords, file=fh)
         print("    amplicon_length", self.amplicon_length, file=fh)
+        if self.amplified_isoforms is not None:
+            print("    amplified_isoforms", _lfmt(self.amplified_isoforms), file=fh)
+            print("    isoform_length_gap", self.isoform_length_gap, file=fh)
+        if self.similar_transcripts is not None:
+            print("    similar_transcripts", _lfmt(self.similar_transcripts), file=fh)
+        if self.primer_variants is not None:
+            print("    primer_variants", _lfmt(self.primer_variants), file=fh)
         _print_p3_attr("PRIMER_LEFT")
         _print_p3_attr("PRIMER_RIGHT")
         _print_p3_attr("PRIMER_LEFT_SEQUENCE")
@@ -77,11 +97,20 @@ class PrimerDesigns:
     uniqueness_checked: bool
     designs: Sequence[PrimerDesign]  # in priority order
     status: DesignStatus
+    # number of primer3 runs with iterative design, primer3_results is from the last
+    primer3_rounds: int = 1
+
+    @property
+    def good_count(self):
+        "number of designs with a GOOD status"
+        return _count_good_designs(self.designs)
 
     def dump(self, fh=sys.stderr):
         print(f">>> PrimerDesigns {len(self.designs)} <<<", file=fh)
         print("    target_id", self.target_id, file=fh)
         print("    tran_id", self.target_transcript.trans_id, file=fh)
+        if self.primer3_rounds > 1:
+            print("    primer3_rounds", self.primer3_rounds, file=fh)
         for design in self.designs:
             design.dump(fh)
 
@@ -111,20 +140,87 @@ def _validate_primer_features(features_5p, features_3p):
             if feature_5p.genome.overlaps(feature_3p.genome):
                 raise PrimersJuJuError(f"primer3 pairs overlap in genome space {features_5p} and {features_3p}")
 
-def _build_primer_design(target_transcript, target_id, result_num, primer3_pair, uniqueness_query):
+def _build_primer_design(target_transcript, target_id, result_num, primer3_pair):
+    "build a design, uniqueness is filled in by _query_designs_uniqueness"
     ppair_id = "{}_pp{}".format(target_id, result_num)
     features_5p = _get_exon_left_features(target_transcript, primer3_pair.PRIMER_LEFT)
     features_3p = _get_exon_right_features(target_transcript, primer3_pair.PRIMER_RIGHT)
     _validate_primer_features(features_5p, features_3p)
     amplicon_coords = features_to_transcript_coords(features_5p + features_3p)
     assert len(amplicon_coords) == primer3_pair.PRIMER_PAIR_PRODUCT_SIZE
+    return PrimerDesign(ppair_id, primer3_pair, features_5p, features_3p, amplicon_coords, None)
 
-    if uniqueness_query is not None:
-        uniqueness = primer_uniqueness_query(uniqueness_query, target_transcript, ppair_id, primer3_pair)
+def _query_designs_uniqueness(target_transcript, primer_design_list, uniqueness_query, uniqueness_cache):
+    "set uniqueness for all designs, with all pairs queried as one batch"
+    if uniqueness_query is None:
+        uniquenesses = [primer_uniqueness_none() for _ in primer_design_list]
     else:
-        uniqueness = primer_uniqueness_none()
+        pair_targets = [PrimerPairTarget(target_transcript, primer_design.ppair_id, primer_design.primer3_pair)
+                        for primer_design in primer_design_list]
+        if uniqueness_cache is not None:
+            uniquenesses = uniqueness_cache.query_batch(uniqueness_query, pair_targets)
+        else:
+            uniquenesses = primer_uniqueness_query_batch(uniqueness_query, pair_targets)
+    for primer_design, uniqueness in zip(primer_design_list, uniquenesses):
+        primer_design.uniqueness = uniqueness
+
+def _query_designs_isoforms(primer_targets, target_transcript, primer_design_list, amplicon_isoform_query):
+    "set other isoforms amplified and amplicon length gaps for all designs"
+    target_trans_ids = [trans.trans_id for trans in primer_targets.transcripts]
+    amplicon_lengths = amplicon_isoform_query.amplicon_lengths(primer_design_list)
+    amplified_isoforms_list = amplicon_isoform_query.query(primer_design_list, exclude_trans_ids=target_trans_ids,
+                                                           amplicon_lengths=amplicon_lengths)
+    length_gaps = amplicon_isoform_query.length_gaps(primer_design_list, target_transcript,
+                                                     amplicon_lengths=amplicon_lengths)
+    for primer_design, amplified_isoforms, length_gap in zip(primer_design_list, amplified_isoforms_list, length_gaps):
+        primer_design.amplified_isoforms = amplified_isoforms
+        primer_design.isoform_length_gap = length_gap
+
+def _query_designs_similarity(primer_targets, target_transcript, primer_design_list, amplicon_sketch_index):
+    "set non-target transcripts with sequence similar to the amplicon for all designs"
+    target_names = frozenset(trans.trans_id.name for trans in primer_targets.transcripts)
+    amplicons = [primer_design_amplicon(primer_design, target_transcript) for primer_design in primer_design_list]
+    similar_transcripts_list = amplicon_sketch_index.query(amplicons, len(amplicons) * [target_names])
+    for primer_design, similar_transcripts in zip(primer_design_list, similar_transcripts_list):
+        primer_design.similar_transcripts = similar_transcripts
+
+def _primer_genome_blocks(features):
+    "genomic ranges of the exon features of a primer, in genomic order"
+    return sorted((f.genome for f in features if isinstance(f, ExonFeature)), key=lambda g: g.start)
+
+def _primer_variant_dist_3p(blocks, variant, three_p_high):
+    """number of primer bases between a variant and the primer 3' end, which
+    is at the high genomic end if three_p_high"""
+    primer_len = sum(len(block) for block in blocks)
+    dist = primer_len
+    offset = 0
+    for block in blocks:
+        ovl_start, ovl_end = max(block.start, variant.start), min(block.end, variant.end)
+        if ovl_start < ovl_end:
+            if three_p_high:
+                dist = min(dist, primer_len - (offset + ovl_end - block.start))
+            else:
+                dist = min(dist, offset + ovl_start - block.start)
+        offset += len(block)
+    return dist
 
-    return PrimerDesign(ppair_id, primer3_pair, features_5p, features_3p, amplicon_coords, uniqueness)
+def _query_designs_variants(target_transcript, primer_design_list, variant_store):
+    "set variants overlapping the primers of all designs, with the blocks of all primers queried as one batch"
+    left_3p_high = (target_transcript.strand == '+')
+    primers = [(primer_design, side, _primer_genome_blocks(features), three_p_high)
+               for primer_design in primer_design_list
+               for side, features, three_p_high in (("left", primer_design.features_5p, left_3p_high),
+                                                    ("right", primer_design.features_3p, not left_3p_high))]
+    block_gcoords = [block for primer in primers for block in primer[2]]
+    block_primer_idxs = [primer_idx for primer_idx, primer in enumerate(primers) for _ in primer[2]]
+    primers_variants = [{} for _ in primers]  # dicts used as ordered sets
+    for primer_idx, variants in zip(block_primer_idxs, variant_store.query(block_gcoords)):
+        primers_variants[primer_idx].update(dict.fromkeys(variants))
+    for primer_design in primer_design_list:
+        primer_design.primer_variants = []
+    for (primer_design, side, blocks, three_p_high), variants in zip(primers, primers_variants):
+        primer_design.primer_variants.extend(PrimerVariant(variant, side, _primer_variant_dist_3p(blocks, variant, three_p_high))
+                                             for variant in variants)
 
 def _calc_design_status(primer_design) -> DesignStatus:
     if primer_design.uniqueness.transcriptome_off_target_cnt > 0:
@@ -159,35 +255,164 @@ def _primer_design_target_score(primer_design):
     else:
         return 3
 
-def _primer_design_sort_key(primer_design):
+def _primer_design_variant_score(primer_design, variant_3p_bases):
+    """designs without variants in the primers are best, then those without
+    variants within variant_3p_bases of a 3' end"""
+    if not primer_design.primer_variants:
+        return 0
+    elif (variant_3p_bases is not None) and (min(pv.dist_3p for pv in primer_design.primer_variants) >= variant_3p_bases):
+        return 1
+    else:
+        return 2
+
+def _primer_design_length_gap_score(primer_design, min_length_gap):
+    """designs with other amplified isoforms that can be separated from the
+    target by length are best, then those with the largest length gap"""
+    length_gap = primer_design.isoform_length_gap
+    if (min_length_gap is None) or (length_gap is None) or (length_gap >= min_length_gap):
+        return (0, 0)
+    else:
+        return (1, -length_gap)
+
+def _primer_design_sort_key(primer_design, min_length_gap=None, variant_3p_bases=None):
     """lowest values are best"""
     # higher delta-G is better, take total
     return (_primer_design_target_score(primer_design),
+            _primer_design_variant_score(primer_design, variant_3p_bases),
+            _primer_design_length_gap_score(primer_design, min_length_gap),
             -(primer_design.primer3_pair.PRIMER_LEFT_END_STABILITY +
               primer_design.primer3_pair.PRIMER_RIGHT_END_STABILITY))
 
-def _sort_primer_designs(primer_design_list):
+def _sort_primer_designs(primer_design_list, min_length_gap=None, variant_3p_bases=None):
     "sort and assign priorities"
-    primer_design_list = sorted(primer_design_list, key=_primer_design_sort_key)
+    primer_design_list = sorted(primer_design_list, key=lambda pd: _primer_design_sort_key(pd, min_length_gap, variant_3p_bases))
     for i in range(len(primer_design_list)):
         primer_design_list[i].priority = i + 1
     return primer_design_list
 
-def _build_primer_designs(primer_targets, target_transcript, primer3_results, uniqueness_query):
-    primer_design_list = [_build_primer_design(target_transcript, primer_targets.target_id, i + 1, pair, uniqueness_query)
-                          for i, pair in enumerate(primer3_results.pairs)]
+def _make_primer_designs(primer_targets, target_transcript, primer3_results, uniqueness_query, primer_design_list,
+                         primer3_rounds=1):
     primer_design_list = _sort_primer_designs(primer_design_list)
     return PrimerDesigns(primer_targets.target_id, primer_targets, target_transcript, primer3_results,
                          uniqueness_query is not None,
-                         primer_design_list, _get_design_status(primer_design_list))
+                         primer_design_list, _get_design_status(primer_design_list),
+                         primer3_rounds)
+
+def _build_primer_designs(primer_targets, target_transcript, primer3_results, uniqueness_query, uniqueness_cache):
+    primer_design_list = [_build_primer_design(target_transcript, primer_targets.target_id, i + 1, pair)
+                          for i, pair in enumerate(primer3_results.pairs)]
+    _query_designs_uniqueness(target_transcript, primer_design_list, uniqueness_query, uniqueness_cache)
+    return _make_primer_designs(primer_targets, target_transcript, primer3_results, uniqueness_query, primer_design_list)
+
+def _build_timeout_primer_designs(primer_targets, target_transcript, ex):
+    return PrimerDesigns(primer_targets.target_id, primer_targets, target_transcript,
+                         primer3_empty_results(str(ex)), False, [], DesignStatus.TIMEOUT)
+
+def _primer_pair_seqs(primer3_pair):
+    return (primer3_pair.PRIMER_LEFT_SEQUENCE, primer3_pair.PRIMER_RIGHT_SEQUENCE)
+
+def _get_failed_3p_positions(primer_design_list):
+    """Get 3' positions of oligos in pairs that are not unique.  Which oligo of a
+    pair causes the off-target products is not known, so both are excluded,
+    unless the oligo is also in a GOOD pair."""
+    failed_positions = set()
+    good_positions = set()
+    for primer_design in primer_design_list:
+        positions = primer3_oligo_3p_positions(primer_design.primer3_pair)
+        if _calc_design_status(primer_design) == DesignStatus.GOOD:
+            good_positions.update(positions)
+        else:
+            failed_positions.update(positions)
+    return failed_positions - good_positions
+
+def _count_good_designs(primer_design_list):
+    return sum([_calc_design_status(pd) == DesignStatus.GOOD for pd in primer_design_list])
+
+def _design_primers_round(primer3_config, primer_targets, target_transcript, uniqueness_query, uniqueness_cache,
+                          primer3_debug, kmer_freq_filter, deadline, excluded_3p_positions, checked_designs):
+    """run one round of iterative design, adding new designs to checked_designs, which
+    is keyed by primer sequences, so that pairs are only queried once."""
+    primer3_results = primer3_design(primer3_config, target_transcript, debug=primer3_debug,
+                                     excluded_3p_positions=excluded_3p_positions, kmer_freq_filter=kmer_freq_filter,
+                                     deadline=deadline)
+    new_designs = {}
+    for pair in primer3_results.pairs:
+        if (_primer_pair_seqs(pair) not in checked_designs) and (_primer_pair_seqs(pair) not in new_designs):
+            new_designs[_primer_pair_seqs(pair)] = _build_primer_design(target_transcript, primer_targets.target_id,
+                                                                        len(checked_designs) + len(new_designs) + 1, pair)
+    _query_designs_uniqueness(target_transcript, list(new_designs.values()), uniqueness_query, uniqueness_cache)
+    checked_designs.update(new_designs)
+    return primer3_results, len(new_designs)
+
+def _design_primers_iterative(primer3_config, primer_targets, target_transcript, uniqueness_query, uniqueness_cache,
+                              primer3_debug, kmer_freq_filter, deadline):
+    """Run primer3 repeatedly, excluding the 3' ends of oligos that are not
+    unique, until enough GOOD pairs are found, no new pairs are returned, or
+    the round limit is reached.  All rounds share the deadline."""
+    excluded_3p_positions = set()
+    checked_designs = {}
+    primer3_results = None
+    primer3_rounds = 0
+    while primer3_rounds < primer3_config.design_max_rounds:
+        try:
+            primer3_results, new_cnt = _design_primers_round(primer3_config, primer_targets, target_transcript, uniqueness_query,
+                                                             uniqueness_cache, primer3_debug, kmer_freq_filter, deadline,
+                                                             excluded_3p_positions, checked_designs)
+        except PrimersJuJuTimeoutError:
+            if primer3_rounds == 0:
+                raise
+            break  # keep designs from previous rounds
+        primer3_rounds += 1
+        primer_design_list = list(checked_designs.values())
+        if (new_cnt == 0) or (_count_good_designs(primer_design_list) >= primer3_config.design_min_good):
+            break
+        failed_3p_positions = _get_failed_3p_positions(primer_design_list) - excluded_3p_positions
+        if len(failed_3p_positions) == 0:
+            break
+        excluded_3p_positions |= failed_3p_positions
+    return _make_primer_designs(primer_targets, target_transcript, primer3_results, uniqueness_query,
+                                list(checked_designs.values()), primer3_rounds)
 
 def design_primers(primer3_config, primer_targets, *, uniqueness_query=None, primer3_debug=False,
-                   amplicon_isoform_query=None):
-    """design transcripts """
+                   amplicon_isoform_query=None, uniqueness_cache=None, kmer_freq_filter=None,
+                   amplicon_sketch_index=None, variant_store=None):
+    """design transcripts.  If uniqueness_cache, a PrimerUniquenessCache, is
+    specified, it is used to share uniqueness results between calls.  If
+    kmer_freq_filter, a KmerFreqFilter, is specified, primers with 3' ends in
+    high-frequency k-mers are avoided.  If amplicon_isoform_query, an
+    AmpliconIsoformQuery for the target locus, is specified, the other
+    isoforms amplified by each design are found, and if
+    primer3_config.design_min_length_gap is set, designs are ranked by how
+    well the target amplicon can be separated by length from the others.
+    If amplicon_sketch_index, an AmpliconSketchIndex of the transcriptome, is
+    specified, the non-target transcripts most similar in sequence to each
+    amplicon are found.  If variant_store, a VariantStore, is specified,
+    designs with variants in the primers are ranked lower, especially those
+    within primer3_config.design_variant_3p_bases of a 3' end."""
     target_transcript = primer_targets.transcripts[0]
-    primer3_results = primer3_design(primer3_config, target_transcript, debug=primer3_debug)
+    deadline = primer3_deadline(primer3_config)
+    try:
+        if (uniqueness_query is not None) and (primer3_config.design_max_rounds > 1):
+            primer_designs = _design_primers_iterative(primer3_config, primer_targets, target_transcript, uniqueness_query,
+                                                       uniqueness_cache, primer3_debug, kmer_freq_filter, deadline)
+        else:
+            primer3_results = primer3_design(primer3_config, target_transcript, debug=primer3_debug,
+                                             kmer_freq_filter=kmer_freq_filter, deadline=deadline)
+            primer_designs = _build_primer_designs(primer_targets, target_transcript, primer3_results, uniqueness_query,
+                                                   uniqueness_cache)
+    except PrimersJuJuTimeoutError as ex:
+        return _build_timeout_primer_designs(primer_targets, target_transcript, ex)
 
-    return _build_primer_designs(primer_targets, target_transcript, primer3_results, uniqueness_query)
+    if amplicon_isoform_query is not None:
+        _query_designs_isoforms(primer_targets, target_transcript, primer_designs.designs, amplicon_isoform_query)
+    if variant_store is not None:
+        _query_designs_variants(target_transcript, primer_designs.designs, variant_store)
+    if (variant_store is not None) or ((amplicon_isoform_query is not None) and (primer3_config.design_min_length_gap is not None)):
+        primer_designs.designs = _sort_primer_designs(primer_designs.designs, primer3_config.design_min_length_gap,
+                                                      primer3_config.design_variant_3p_bases)
+    if amplicon_sketch_index is not None:
+        _query_designs_similarity(primer_targets, target_transcript, primer_designs.designs, amplicon_sketch_index)
+    return primer_designs
 
 def primer_design_amplicon_features(primer_design, target_transcript):
     gcoords = features_to_genomic_coords(primer_design.features_5p + primer_design.features_3p)
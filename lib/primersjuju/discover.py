@@ -0,0 +1,70 @@
+"""
+Automatic generation of primer targets for the multi-isoform loci of an
+annotation track.
+
+The track is streamed in genomic order and transcripts are clustered into loci
+by overlap on the same strand, so only one locus is in memory at a time.  Each
+transcript of a locus with more than one isoform gets a PrimerTargetSpec for
+each of its first isoform-specific junctions from the JunctionIndex.
+"""
+import re
+from .primer_target_spec import PrimerTargetSpec
+from .transcript_features import TranscriptId
+
+def _format_gcoords(gcoords):
+    return f"{gcoords.name}:{gcoords.start + 1}-{gcoords.end}"
+
+class _OpenLocus:
+    "locus being accumulated on one strand"
+    def __init__(self, bed):
+        self.chrom = bed.chrom
+        self.end = bed.chromEnd
+        self.beds = [bed]
+
+    def add(self, bed):
+        self.end = max(self.end, bed.chromEnd)
+        self.beds.append(bed)
+
+def track_loci(beds):
+    """Cluster BEDs sorted by chrom and start into loci of transcripts with
+    overlapping bounds on the same strand, generating lists of BEDs"""
+    open_loci = {}  # by strand
+    for bed in beds:
+        for strand, locus in list(open_loci.items()):
+            if (locus.chrom != bed.chrom) or (bed.chromStart >= locus.end):
+                yield locus.beds
+                del open_loci[strand]
+        if bed.strand in open_loci:
+            open_loci[bed.strand].add(bed)
+        else:
+            open_loci[bed.strand] = _OpenLocus(bed)
+    for locus in open_loci.values():
+        yield locus.beds
+
+def _make_target_id(trans_name, num):
+    "target id from transcript name, with characters not valid in a target id replaced"
+    target_id = re.sub("[^-_.=%A-Za-z0-9]", "_", trans_name)
+    if not re.match("^[A-Za-z]", target_id):
+        target_id = "T" + target_id
+    return f"{target_id}+J{num}"
+
+def _make_primer_target_spec(trans_id, num, suggestion, num_isoforms):
+    primer_target_spec = PrimerTargetSpec(_make_target_id(trans_id.name, num), suggestion.region_5p, suggestion.region_3p,
+                                          {"suggest_junction": _format_gcoords(suggestion.sharing.gcoords),
+                                           "locus_isoforms": str(num_isoforms)}, False)
+    primer_target_spec.add_transcript(trans_id.track, trans_id.name, {})
+    return primer_target_spec
+
+def discover_target_specs(junction_index, track, *, max_per_transcript=1):
+    """Generate PrimerTargetSpec objects for the transcripts of multi-isoform
+    loci in a Track, with up to max_per_transcript targets for each
+    transcript.  Targets are generated in genomic order, so the same targets
+    are generated for each run."""
+    for locus_beds in track_loci(track.iter_all()):
+        if len(locus_beds) < 2:
+            continue
+        for bed in locus_beds:
+            trans_id = TranscriptId(track.name, bed.name)
+            suggestions = junction_index.suggest_regions(trans_id, bed)
+            for num, suggestion in enumerate(suggestions[:max_per_transcript], 1):
+                yield _make_primer_target_spec(trans_id, num, suggestion, len(locus_beds))
@@ -10,6 +10,7 @@ from pycbio.hgdata import dnaOps
 from pycbio.sys import fileOps
 from pycbio.ncbi.assembly import AssemblyReport
 from . import PrimersJuJuDataError
+from .variant_store import VariantStoreSpec, VariantStore
 
 @dataclass
 class Track:
@@ -31,18 +32,35 @@ class Track:
         except Exception as ex:
             raise PrimersJuJuDataError(f"track {self.name}: {ex}") from ex
 
+    def read_all(self):
+        try:
+            return bigbed_read_all(self.bigbed)
+        except Exception as ex:
+            raise PrimersJuJuDataError(f"failed to read track {self.name}") from ex
+
+    def iter_all(self):
+        "generator over all records, in chrom and start order, without loading the track"
+        try:
+            yield from bigbed_iter_all(self.bigbed)
+        except Exception as ex:
+            raise PrimersJuJuDataError(f"failed to read track {self.name}") from ex
+
 class GenomeData:
     """Genome sequence and annotations tracks.  Files are opened in a lazy manner,
     so this can be specified in a configuration for multiple genomes with overhead
-    of opening all of the files"""
+    of opening all of the files.  If variant_store_spec is specified, primers
+    are screened for overlapping variants, such as common SNPs."""
 
-    def __init__(self, genome_name, genome2bit, *, assembly_report=None):
+    def __init__(self, genome_name, genome2bit, *, assembly_report=None,
+                 variant_store_spec: VariantStoreSpec = None):
         self.genome_name = genome_name
         self.genome2bit = genome2bit
         self.__genome_seqs = None  # lazy
         self.assembly_report = assembly_report
         self.__assembly_info = None  # lazy
         self.tracks = {}
+        self.variant_store_spec = variant_store_spec
+        self.__variant_store = None  # lazy
 
     @property
     def genome_seqs(self) -> TwoBitFile:
@@ -56,15 +74,25 @@ class GenomeData:
             self.__assembly_info = AssemblyReport(self.assembly_report)
         return self.__assembly_info
 
+    @property
+    def variant_store(self) -> VariantStore:
+        "lazy get/create VariantStore object, or None if not configured"
+        if (self.__variant_store is None) and (self.variant_store_spec is not None):
+            self.__variant_store = VariantStore(self.variant_store_spec)
+        return self.__variant_store
+
     def add_track(self, track_name, bigBed, srcUrl):
         self.tracks[track_name] = Track(track_name, bigBed, srcUrl)
 
-    def get_genome_seq(self, gcoords, *, strand='+'):
+    def get_genome_seq(self, gcoords, *, strand='+', keep_mask=False):
         """reverses coordinates if has '-' strand; with reverse-complement of sequence will
-        be don't if strand is '-' """
+        be don't if strand is '-'.  Sequence is upper-cased unless keep_mask is
+        specified, in which case the 2bit soft-masking is kept."""
         if gcoords.strand == '-':
             gcoords = gcoords.reverse()
-        bases = self.genome_seqs[gcoords.name][gcoords.start:gcoords.end].upper()
+        bases = self.genome_seqs[gcoords.name][gcoords.start:gcoords.end]
+        if not keep_mask:
+            bases = bases.upper()
         if strand == '-':
             bases = dnaOps.reverseComplement(bases)
         return bases
@@ -110,6 +138,19 @@ def bigbed_fetch_by_name(bigbed, name):
     "returns None if not found"
     return _bigbed_read_with_names(bigbed, [name]).get(name)
 
+def bigbed_fetch_by_names(bigbed, names):
+    "returns dict by name of the records found"
+    return _bigbed_read_with_names(bigbed, names)
+
+def bigbed_iter_all(bigbed):
+    "generator over all records"
+    with pipettor.Popen(['bigBedToBed', bigbed, '/dev/stdout']) as fh:
+        yield from BedReader(fh)
+
+def bigbed_read_all(bigbed):
+    "read all records"
+    return list(bigbed_iter_all(bigbed))
+
 def bigbed_read_by_range(bigbed, gcoords):
     "read by genomic range"
     with pipettor.Popen(['bigBedToBed',
@@ -0,0 +1,294 @@
+"""
+Index of the splice junctions and exon pairs of all transcripts in a set of
+annotation tracks, used to suggest isoform-specific primer regions.
+
+Junctions are keyed by genomic coordinates and by the sequence flanking the
+junction in the spliced RNA, so junctions at other loci with the same
+sequence, such as in paralogs, are also found.  The flanking sequence of up to
+16 bases on each side is packed into a 64-bit key, using the smaller of the
+keys of the two strands.  Exon pairs are consecutive exons, keyed by the
+coordinates of both exons, which distinguishes alternate exon starts and ends
+that share a junction.
+
+Index files in the index directory, memory-mapped when used:
+  - junc_keys.npy - rows of chrom index, strand, donor, and acceptor of the
+    junctions, sorted by column
+  - junc_seq_keys.npy - flanking sequence key of each junction
+  - junc_seq_order.npy, junc_seq_sorted.npy - junction indexes and keys sorted
+    by flanking sequence key
+  - junc_trans_offsets.npy, junc_trans.npy - transcripts with each junction
+  - pair_keys.npy - rows of chrom index, strand, and exon coordinates of the
+    exon pairs, sorted by column
+  - pair_trans_offsets.npy, pair_trans.npy - transcripts with each exon pair
+  - trans_tracks.npy, trans_names.npy - track index and name of each transcript
+  - index.json - parameters, chroms, track names and sources.  Written last.
+"""
+import os
+import os.path as osp
+import json
+from typing import NamedTuple, Sequence
+from dataclasses import dataclass, KW_ONLY
+import numpy as np
+from pycbio.hgdata.coords import Coords
+from . import PrimersJuJuError, PrimersJuJuDataError
+from .seq_codes import NON_ACGT, encode_seq, complement_codes
+from .transcript_features import TranscriptId
+
+_index_version = 1
+_MAX_FLANK_SIZE = 16
+_NO_SEQ_KEY = np.uint64(2 ** 64 - 1)
+
+@dataclass
+class JunctionIndexSpec:
+    """Specification of a junction index built from annotation tracks in
+    GenomeData.  The index is built in index_dir on first use and rebuilt if
+    the tracks change."""
+    index_dir: str
+    track_names: Sequence[str]
+    _: KW_ONLY
+    flank_size: int = 16  # bases on each side of a junction in the sequence key
+    region_flank: int = 150  # maximum bases from the junction of a suggested primer region
+    min_region_size: int = 25  # minimum exon size for a suggested primer region
+
+class JunctionSharing(NamedTuple):
+    """A junction or exon pair of a transcript, with the other transcripts
+    that share it.  exon_num is the genomic order index of the first exon."""
+    kind: str  # "junction" or "exon_pair"
+    exon_num: int
+    gcoords: Coords  # the intron of a junction or span of an exon pair
+    same_coords: Sequence[TranscriptId]  # other transcripts with the same coordinates
+    same_seq: Sequence[TranscriptId]  # transcripts at other coordinates with the same flanking sequence
+
+    @property
+    def specific(self):
+        return (len(self.same_coords) == 0) and (len(self.same_seq) == 0)
+
+class RegionSuggestion(NamedTuple):
+    """suggested primer regions in genomic order, with the isoform-specific
+    junction they target"""
+    region_5p: Coords
+    region_3p: Coords
+    sharing: JunctionSharing
+
+def _track_stamp(bigbed):
+    if osp.exists(bigbed):
+        st = os.stat(bigbed)
+        return {"bigbed": osp.abspath(bigbed), "size": st.st_size, "mtime": st.st_mtime}
+    return {"bigbed": bigbed}
+
+def _index_info(spec, genome_data, chroms=None):
+    info = {"version": _index_version, "flank_size": spec.flank_size,
+            "genome": genome_data.genome_name,
+            "tracks": [[name, _track_stamp(genome_data.get_track(name).bigbed)] for name in spec.track_names]}
+    if chroms is not None:
+        info["chroms"] = chroms
+    return info
+
+def _read_index_info(spec):
+    info_file = osp.join(spec.index_dir, "index.json")
+    if not osp.exists(info_file):
+        return None
+    with open(info_file) as fh:
+        return json.load(fh)
+
+def _index_current(spec, genome_data, info):
+    if info is None:
+        return False
+    chroms = info.pop("chroms", None)
+    current = info == _index_info(spec, genome_data)
+    info["chroms"] = chroms
+    return current
+
+def _strand_code(strand):
+    return 0 if strand == '+' else 1
+
+class _TrackRecords:
+    "accumulate junctions and exon pairs of transcripts while building"
+    def __init__(self):
+        self.chroms = {}
+        self.trans_tracks = []
+        self.trans_names = []
+        self.juncs = []   # trans_idx, chrom_idx, strand, donor, acceptor
+        self.pairs = []   # trans_idx, chrom_idx, strand, start1, end1, start2, end2
+
+    def add_bed(self, track_idx, bed):
+        trans_idx = len(self.trans_names)
+        self.trans_tracks.append(track_idx)
+        self.trans_names.append(bed.name)
+        chrom_idx = self.chroms.setdefault(bed.chrom, len(self.chroms))
+        strand = _strand_code(bed.strand)
+        for blk1, blk2 in zip(bed.blocks[:-1], bed.blocks[1:]):
+            self.juncs.append((trans_idx, chrom_idx, strand, blk1.end, blk2.start))
+            self.pairs.append((trans_idx, chrom_idx, strand, blk1.start, blk1.end, blk2.start, blk2.end))
+
+def _group_transcripts(records, num_key_cols):
+    """records is an array of transcript index followed by key columns.  Returns
+    sorted unique keys, and the CSR offsets and transcripts of each key"""
+    records = np.asarray(records, dtype=np.int64).reshape(-1, 1 + num_key_cols)
+    keys, inverse = np.unique(records[:, 1:], axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind="stable")
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(inverse, minlength=len(keys)), out=offsets[1:])
+    return keys, offsets, records[order, 0].astype(np.int32)
+
+def _pack_codes(codes):
+    "pack rows of 2-bit codes into uint64 keys"
+    vals = np.zeros(len(codes), dtype=np.uint64)
+    for j in range(codes.shape[1]):
+        vals = (vals << np.uint64(2)) | (codes[:, j] & 3).astype(np.uint64)
+    return vals
+
+def _junction_seq_keys(genome_data, chrom_names, junc_keys, flank_size):
+    "canonical packed flanking sequence of each junction, _NO_SEQ_KEY if it has non-ACGT bases"
+    seq_keys = np.full(len(junc_keys), _NO_SEQ_KEY, dtype=np.uint64)
+    flank_offsets = np.arange(flank_size)
+    for chrom_idx, chrom in enumerate(chrom_names):
+        rows = np.nonzero(junc_keys[:, 0] == chrom_idx)[0]
+        if len(rows) == 0:
+            continue
+        chrom_codes = encode_seq(str(genome_data.genome_seqs[chrom]))
+        idxs = np.concatenate([junc_keys[rows, 2][:, None] - flank_size + flank_offsets,
+                               junc_keys[rows, 3][:, None] + flank_offsets], axis=1)
+        codes = chrom_codes[np.clip(idxs, 0, len(chrom_codes) - 1)]
+        keys = np.minimum(_pack_codes(codes), _pack_codes(complement_codes(codes[:, ::-1])))
+        valid = ~np.any(codes == NON_ACGT, axis=1) & np.all((idxs >= 0) & (idxs < len(chrom_codes)), axis=1)
+        seq_keys[rows[valid]] = keys[valid]
+    return seq_keys
+
+def _save_array(index_dir, name, arr):
+    np.save(osp.join(index_dir, name + ".tmp.npy"), arr)
+    os.replace(osp.join(index_dir, name + ".tmp.npy"), osp.join(index_dir, name + ".npy"))
+
+def junction_index_build(spec, genome_data):
+    """build the index for a JunctionIndexSpec"""
+    os.makedirs(spec.index_dir, exist_ok=True)
+    info_file = osp.join(spec.index_dir, "index.json")
+    if osp.exists(info_file):
+        os.unlink(info_file)
+    records = _TrackRecords()
+    for track_idx, track_name in enumerate(spec.track_names):
+        for bed in genome_data.get_track(track_name).read_all():
+            records.add_bed(track_idx, bed)
+    chrom_names = sorted(records.chroms.keys(), key=lambda c: records.chroms[c])
+
+    junc_keys, junc_offsets, junc_trans = _group_transcripts(records.juncs, 4)
+    junc_seq_keys = _junction_seq_keys(genome_data, chrom_names, junc_keys, spec.flank_size)
+    seq_order = np.argsort(junc_seq_keys, kind="stable")
+    pair_keys, pair_offsets, pair_trans = _group_transcripts(records.pairs, 6)
+    for name, arr in (("junc_keys", np.ascontiguousarray(junc_keys.T)), ("junc_seq_keys", junc_seq_keys),
+                      ("junc_seq_order", seq_order), ("junc_seq_sorted", junc_seq_keys[seq_order]),
+                      ("junc_trans_offsets", junc_offsets), ("junc_trans", junc_trans),
+                      ("pair_keys", np.ascontiguousarray(pair_keys.T)), ("pair_trans_offsets", pair_offsets), ("pair_trans", pair_trans),
+                      ("trans_tracks", np.array(records.trans_tracks, dtype=np.int16)),
+                      ("trans_names", np.array(records.trans_names, dtype=str))):
+        _save_array(spec.index_dir, name, arr)
+    with open(info_file, "w") as fh:
+        json.dump(_index_info(spec, genome_data, chrom_names), fh)
+
+def _find_key(keys, key):
+    """binary search of keys stored by column and sorted lexicographically,
+    returns the key index or None"""
+    lo, hi = 0, keys.shape[1]
+    for col, val in enumerate(key):
+        col_vals = keys[col, lo:hi]
+        lo, hi = lo + np.searchsorted(col_vals, val, side='left'), lo + np.searchsorted(col_vals, val, side='right')
+        if lo >= hi:
+            return None
+    return lo
+
+class JunctionIndex:
+    """Memory-mapped junction index, built if needed.  Queries are
+    thread-safe."""
+    def __init__(self, spec, genome_data):
+        if not (1 <= spec.flank_size <= _MAX_FLANK_SIZE):
+            raise PrimersJuJuError(f"JunctionIndexSpec flank_size must be in the range 1 to {_MAX_FLANK_SIZE}, got {spec.flank_size}")
+        self.spec = spec
+        self.genome_data = genome_data
+        info = _read_index_info(spec)
+        if not _index_current(spec, genome_data, info):
+            junction_index_build(spec, genome_data)
+            info = _read_index_info(spec)
+        self.chrom_idxs = {chrom: i for i, chrom in enumerate(info["chroms"])}
+        for name in ("junc_keys", "junc_seq_keys", "junc_seq_order", "junc_seq_sorted", "junc_trans_offsets", "junc_trans",
+                     "pair_keys", "pair_trans_offsets", "pair_trans", "trans_tracks", "trans_names"):
+            setattr(self, name, np.load(osp.join(spec.index_dir, name + ".npy"), mmap_mode="r"))
+
+    def _trans_ids(self, trans_idxs):
+        return [TranscriptId(self.spec.track_names[self.trans_tracks[i]], str(self.trans_names[i]))
+                for i in trans_idxs]
+
+    def _key_trans_idxs(self, offsets, trans, row):
+        return trans[offsets[row]:offsets[row + 1]]
+
+    def _same_seq_trans_idxs(self, junc_row):
+        "transcripts with other junctions having the same flanking sequence"
+        seq_key = self.junc_seq_keys[junc_row]
+        if seq_key == _NO_SEQ_KEY:
+            return []
+        lo = np.searchsorted(self.junc_seq_sorted, seq_key, side='left')
+        hi = np.searchsorted(self.junc_seq_sorted, seq_key, side='right')
+        return [i for row in self.junc_seq_order[lo:hi] if row != junc_row
+                for i in self._key_trans_idxs(self.junc_trans_offsets, self.junc_trans, row)]
+
+    def _others(self, trans_idxs, trans_id):
+        others = set(self._trans_ids(trans_idxs))
+        others.discard(trans_id)
+        return sorted(others)
+
+    def _junction_sharing(self, trans_id, chrom_idx, strand, exon_num, blk1, blk2, intron):
+        row = _find_key(self.junc_keys, (chrom_idx, strand, blk1.end, blk2.start))
+        if row is None:
+            return JunctionSharing("junction", exon_num, intron, [], [])
+        same_coords = self._others(self._key_trans_idxs(self.junc_trans_offsets, self.junc_trans, row), trans_id)
+        same_seq = self._others(self._same_seq_trans_idxs(row), trans_id)
+        return JunctionSharing("junction", exon_num, intron, same_coords, same_seq)
+
+    def _exon_pair_sharing(self, trans_id, chrom_idx, strand, exon_num, blk1, blk2, span):
+        row = _find_key(self.pair_keys, (chrom_idx, strand, blk1.start, blk1.end, blk2.start, blk2.end))
+        same_coords = [] if row is None else self._others(self._key_trans_idxs(self.pair_trans_offsets,
+                                                                               self.pair_trans, row), trans_id)
+        return JunctionSharing("exon_pair", exon_num, span, same_coords, [])
+
+    def transcript_sharing(self, trans_id, bed):
+        """Find the other transcripts sharing each junction and exon pair of a
+        transcript, in genomic order"""
+        chrom_idx = self.chrom_idxs.get(bed.chrom)
+        if chrom_idx is None:
+            raise PrimersJuJuDataError(f"chromosome {bed.chrom} of {trans_id} is not in the junction index")
+        strand = _strand_code(bed.strand)
+        chrom_size = self.genome_data.get_chrom_size(bed.chrom)
+        sharings = []
+        for exon_num, (blk1, blk2) in enumerate(zip(bed.blocks[:-1], bed.blocks[1:])):
+            intron = Coords(bed.chrom, blk1.end, blk2.start, strand='+', size=chrom_size)
+            span = Coords(bed.chrom, blk1.start, blk2.end, strand='+', size=chrom_size)
+            sharings.append(self._junction_sharing(trans_id, chrom_idx, strand, exon_num, blk1, blk2, intron))
+            sharings.append(self._exon_pair_sharing(trans_id, chrom_idx, strand, exon_num, blk1, blk2, span))
+        return sharings
+
+    def _junction_regions(self, bed, exon_num):
+        """primer regions in the exons on either side of a junction, so the
+        amplicon must include it.  Exons shorter than min_region_size are
+        skipped over.  Regions are limited to region_flank bases from the
+        junction."""
+        blocks = bed.blocks
+        min_size, flank = self.spec.min_region_size, self.spec.region_flank
+        lefts = [blk for blk in reversed(blocks[:exon_num + 1]) if (blk.end - blk.start) >= min_size]
+        rights = [blk for blk in blocks[exon_num + 1:] if (blk.end - blk.start) >= min_size]
+        if (len(lefts) == 0) or (len(rights) == 0):
+            return None
+        return (max(lefts[0].start, lefts[0].end - flank), lefts[0].end), (rights[0].start, min(rights[0].end, rights[0].start + flank))
+
+    def suggest_regions(self, trans_id, bed):
+        """Suggest primer regions in genomic order for each junction of a
+        transcript that is not shared with any other transcript, either by
+        coordinates or flanking sequence.  Returns a list of RegionSuggestion."""
+        chrom_size = self.genome_data.get_chrom_size(bed.chrom)
+        suggestions = []
+        for sharing in self.transcript_sharing(trans_id, bed):
+            if (sharing.kind == "junction") and sharing.specific:
+                regions = self._junction_regions(bed, sharing.exon_num)
+                if regions is not None:
+                    suggestions.append(RegionSuggestion(*[Coords(bed.chrom, start, end, strand='+', size=chrom_size)
+                                                          for start, end in regions], sharing))
+        return suggestions
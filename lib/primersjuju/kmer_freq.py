@@ -0,0 +1,123 @@
+"""
+Frequency of primer 3' end k-mers in a genome or transcriptome, used to avoid
+primers whose 3' ends are in high-copy sequence, which are unlikely to pass
+the uniqueness checks.
+
+The table is a memory-mapped numpy array of counts for every k-mer, indexed
+by the k-mer value, counting both strands of each sequence.  Since both
+strands are counted, the count of a k-mer and its reverse complement are the
+same, so the 3' end of a right primer can be looked up using the template
+sequence.
+
+Files:
+  - table_file - counts as a numpy uint32 array of size 4^kmer_size
+  - table_file.json - parameters and the 2bit size and modification time, used
+    to rebuild the table if the 2bit changes.  Written last.
+"""
+import os
+import os.path as osp
+import json
+from dataclasses import dataclass, KW_ONLY
+import numpy as np
+from . import PrimersJuJuError
+from .seq_codes import encode_seq, reverse_complement_codes, kmer_codes, twobit_stamp, read_twobit_seqs
+
+_table_version = 1
+_MIN_KMER_SIZE = 11
+_MAX_KMER_SIZE = 13
+
+@dataclass
+class KmerFreqSpec:
+    """Specification of a 3' end k-mer frequency table for a genome or
+    transcriptome.  The table is built on first use and rebuilt if the 2bit
+    file changes.  Primer 3' ends where the k-mer count is over max_freq are
+    excluded from designs."""
+    twobit: str
+    table_file: str
+    _: KW_ONLY
+    kmer_size: int = 12
+    max_freq: int = 100
+
+def _table_info(spec):
+    return {"version": _table_version, "kmer_size": spec.kmer_size,
+            "twobit": osp.abspath(spec.twobit), "twobit_stamp": twobit_stamp(spec.twobit)}
+
+def _table_current(spec):
+    info_file = spec.table_file + ".json"
+    if not (osp.exists(info_file) and osp.exists(spec.table_file)):
+        return False
+    with open(info_file) as fh:
+        return json.load(fh) == _table_info(spec)
+
+def _count_kmers(counts, kmers):
+    counts += np.bincount(kmers[kmers >= 0], minlength=len(counts)).astype(counts.dtype)
+
+def kmer_freq_table_build(spec):
+    """build the k-mer frequency table for a KmerFreqSpec"""
+    info_file = spec.table_file + ".json"
+    if osp.exists(info_file):
+        os.unlink(info_file)
+    counts = np.zeros(4 ** spec.kmer_size, dtype=np.int64)
+    for _, codes in read_twobit_seqs(spec.twobit):
+        _count_kmers(counts, kmer_codes(codes, spec.kmer_size))
+        _count_kmers(counts, kmer_codes(reverse_complement_codes(codes), spec.kmer_size))
+    tmp_file = spec.table_file + ".tmp.npy"
+    np.save(tmp_file, np.minimum(counts, np.iinfo(np.uint32).max).astype(np.uint32))
+    os.replace(tmp_file, spec.table_file)
+    with open(info_file, "w") as fh:
+        json.dump(_table_info(spec), fh)
+
+class KmerFreqTable:
+    """Memory-mapped k-mer frequency table, built if needed.  Lookups are
+    thread-safe."""
+    def __init__(self, spec):
+        if not (_MIN_KMER_SIZE <= spec.kmer_size <= _MAX_KMER_SIZE):
+            raise PrimersJuJuError(f"KmerFreqSpec kmer_size must be in the range {_MIN_KMER_SIZE} to {_MAX_KMER_SIZE}, got {spec.kmer_size}")
+        self.spec = spec
+        if not _table_current(spec):
+            kmer_freq_table_build(spec)
+        self.counts = np.load(spec.table_file, mmap_mode="r")
+
+    @property
+    def kmer_size(self):
+        return self.spec.kmer_size
+
+    def seq_kmer_freqs(self, seq):
+        """count of the k-mer starting at each position of seq, zero for
+        k-mers that contain non-ACGT bases or run off the end"""
+        kmers = kmer_codes(encode_seq(seq), self.kmer_size)
+        valid = kmers >= 0
+        freqs = np.zeros(len(kmers), dtype=np.int64)
+        freqs[valid] = self.counts[kmers[valid]]
+        return freqs
+
+    def high_freq_3p_positions(self, template, ok_regions):
+        """template positions in the primer regions where a left or right
+        primer 3' end would be in a k-mer with a count over max_freq.
+        ok_regions is in the SEQUENCE_PRIMER_PAIR_OK_REGION_LIST form.
+        The 3' end of a left primer is the last base of the k-mer, the 3'
+        end of a right primer is the first."""
+        k = self.kmer_size
+        high = self.seq_kmer_freqs(template) > self.spec.max_freq
+
+        def _region_high_starts(start, length):
+            return np.nonzero(high[start:max(start, start + length - k + 1)])[0] + start
+
+        positions = set()
+        for left_start, left_len, right_start, right_len in ok_regions:
+            positions.update((_region_high_starts(left_start, left_len) + k - 1).tolist())
+            positions.update(_region_high_starts(right_start, right_len).tolist())
+        return positions
+
+class KmerFreqFilter:
+    """Find primer 3' end positions that are high-frequency in any of a list
+    of KmerFreqTable objects, normally one for the genome and one for the
+    transcriptome."""
+    def __init__(self, tables):
+        self.tables = tables
+
+    def high_freq_3p_positions(self, template, ok_regions):
+        positions = set()
+        for table in self.tables:
+            positions |= table.high_freq_3p_positions(template, ok_regions)
+        return positions
@@ -0,0 +1,242 @@
+"""
+Local in-silico PCR using a memory-mapped k-mer index of a 2bit genome or
+transcriptome, as an alternative to an isPcr server.
+
+Primer binding sites are found by looking up the k-mer at the 3' end of each
+primer in the index, then allowing up to max_mismatches in the rest of the
+primer.  Sites are found once per distinct oligo and memoized, so the work
+scales with the number of distinct oligos rather than pairs.  Sites are paired
+to form products up to max_size.
+
+Index files in the index directory:
+  - seq.u8 - concatenated sequences encoded as ACGT=0..3, other=4, with a
+    separator between sequences
+  - kmer_offsets.npy - start of each k-mer's positions in kmer_positions.npy
+  - kmer_positions.npy - positions in seq.u8 of each k-mer, grouped by k-mer
+  - seqs.tsv - sequence name, offset in seq.u8, and size
+  - index.json - parameters and the 2bit size and modification time, used to
+    rebuild the index if the 2bit changes.  Written last.
+"""
+import os
+import os.path as osp
+import json
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+from dataclasses import dataclass, KW_ONLY
+import numpy as np
+from . import PrimersJuJuError
+from .seq_codes import NON_ACGT, encode_seq, decode_seq, reverse_complement_codes, kmer_codes, twobit_stamp, read_twobit_seqs
+
+_index_version = 1
+
+@dataclass
+class LocalPcrSpec:
+    """Specification of a local in-silico PCR engine, used in place of an
+    IsPcrServerSpec.  The index is built in index_dir on first use and rebuilt
+    if the 2bit file changes."""
+    twobit: str
+    index_dir: str
+    _: KW_ONLY
+    kmer_size: int = 12  # exact match required for this many bases at 3' end
+    max_mismatches: int = 2  # allowed in the rest of the primer
+    trans_bigbed: str = None  # big bed file/URL for transcriptome
+    trans_cache_size: int = 10_000  # number of transcripts to memoize features, for transcriptome
+    max_in_flight: int = 1  # maximum concurrent queries
+    oligo_cache_size: int = 100_000  # number of oligos to memoize binding sites
+    max_size: int = None  # maximum product size, None for the genome or transcriptome default
+    first_tier_size_factor: float = None  # if set, first query with this factor times the target's amplicon span
+
+def _index_info(spec):
+    return {"version": _index_version, "kmer_size": spec.kmer_size,
+            "twobit": osp.abspath(spec.twobit), "twobit_stamp": twobit_stamp(spec.twobit)}
+
+def _index_current(spec):
+    info_file = osp.join(spec.index_dir, "index.json")
+    if not osp.exists(info_file):
+        return False
+    with open(info_file) as fh:
+        return json.load(fh) == _index_info(spec)
+
+def _write_seqs(spec):
+    "write encoded sequences, returns list of (name, offset, size)"
+    seq_infos = []
+    offset = 0
+    with open(osp.join(spec.index_dir, "seq.u8.tmp"), "wb") as fh:
+        for seq_name, codes in read_twobit_seqs(spec.twobit):
+            seq_infos.append((seq_name, offset, len(codes)))
+            fh.write(codes.tobytes())
+            fh.write(bytes([NON_ACGT]))  # separator
+            offset += len(codes) + 1
+    return seq_infos
+
+def _seq_kmers(seq, seq_infos, kmer_size):
+    for _, offset, size in seq_infos:
+        yield offset, kmer_codes(np.asarray(seq[offset:offset + size]), kmer_size)
+
+def _build_positions(spec, seq, seq_infos):
+    "counting sort of positions by k-mer, one sequence at a time"
+    num_kmers = 4 ** spec.kmer_size
+    counts = np.zeros(num_kmers, dtype=np.int64)
+    for _, kmers in _seq_kmers(seq, seq_infos, spec.kmer_size):
+        counts += np.bincount(kmers[kmers >= 0], minlength=num_kmers)
+    offsets = np.zeros(num_kmers + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    pos_dtype = np.uint32 if len(seq) < 2 ** 32 else np.int64
+    positions = np.lib.format.open_memmap(osp.join(spec.index_dir, "kmer_positions.tmp.npy"), mode="w+",
+                                          dtype=pos_dtype, shape=(int(offsets[-1]),))
+    cursor = offsets[:-1].copy()
+    for offset, kmers in _seq_kmers(seq, seq_infos, spec.kmer_size):
+        seq_pos = np.nonzero(kmers >= 0)[0]
+        order = np.argsort(kmers[seq_pos], kind="stable")
+        seq_pos = seq_pos[order]
+        sorted_kmers = kmers[seq_pos]
+        group_starts = np.concatenate(([0], np.nonzero(np.diff(sorted_kmers))[0] + 1))
+        group_lens = np.diff(np.concatenate((group_starts, [len(sorted_kmers)])))
+        rank = np.arange(len(sorted_kmers)) - np.repeat(group_starts, group_lens)
+        positions[cursor[sorted_kmers] + rank] = seq_pos + offset
+        cursor += np.bincount(sorted_kmers, minlength=num_kmers)
+    positions.flush()
+    del positions
+    np.save(osp.join(spec.index_dir, "kmer_offsets.tmp.npy"), offsets)
+
+def kmer_pcr_index_build(spec):
+    """build the index for a LocalPcrSpec"""
+    os.makedirs(spec.index_dir, exist_ok=True)
+    info_file = osp.join(spec.index_dir, "index.json")
+    if osp.exists(info_file):
+        os.unlink(info_file)
+    seq_infos = _write_seqs(spec)
+    seq = np.memmap(osp.join(spec.index_dir, "seq.u8.tmp"), dtype=np.uint8, mode="r")
+    _build_positions(spec, seq, seq_infos)
+    del seq
+    with open(osp.join(spec.index_dir, "seqs.tsv"), "w") as fh:
+        for seq_info in seq_infos:
+            print(*seq_info, sep='\t', file=fh)
+    for name in ("seq.u8", "kmer_positions.npy", "kmer_offsets.npy"):
+        tmp_name = name.replace(".npy", ".tmp.npy") if name.endswith(".npy") else name + ".tmp"
+        os.replace(osp.join(spec.index_dir, tmp_name), osp.join(spec.index_dir, name))
+    with open(info_file, "w") as fh:
+        json.dump(_index_info(spec), fh)
+
+class PcrProduct(NamedTuple):
+    "product found by KmerPcrIndex, in positive strand coordinates of the sequence"
+    seq_name: str
+    start: int
+    end: int
+    strand: str  # '+' if left primer is at start, '-' if right primer is
+    seq_size: int
+
+class OligoSites(NamedTuple):
+    """Sorted start positions in the index sequence of an oligo's binding sites.
+    fwd are sites of the oligo itself, rc are sites of its reverse complement,
+    that is, where it primes on the negative strand."""
+    length: int
+    fwd: np.ndarray
+    rc: np.ndarray
+
+class KmerPcrIndex:
+    """Memory-mapped k-mer index for in-silico PCR.  The index is built if
+    needed.  Queries are thread-safe."""
+    def __init__(self, spec):
+        if spec.kmer_size > 15:
+            raise PrimersJuJuError(f"LocalPcrSpec kmer_size must be at most 15, got {spec.kmer_size}")
+        self.spec = spec
+        if not _index_current(spec):
+            kmer_pcr_index_build(spec)
+        self.seq = np.memmap(osp.join(spec.index_dir, "seq.u8"), dtype=np.uint8, mode="r")
+        self.offsets = np.load(osp.join(spec.index_dir, "kmer_offsets.npy"), mmap_mode="r")
+        self.positions = np.load(osp.join(spec.index_dir, "kmer_positions.npy"), mmap_mode="r")
+        seq_infos = []
+        with open(osp.join(spec.index_dir, "seqs.tsv")) as fh:
+            for line in fh:
+                name, offset, size = line.rstrip('\n').split('\t')
+                seq_infos.append((name, int(offset), int(size)))
+        self.seq_names = [si[0] for si in seq_infos]
+        self.seq_name_idxs = {si[0]: i for i, si in enumerate(seq_infos)}
+        self.seq_offsets = np.array([si[1] for si in seq_infos], dtype=np.int64)
+        self.seq_sizes = np.array([si[2] for si in seq_infos], dtype=np.int64)
+        self._oligo_cache = OrderedDict()
+        self._oligo_cache_lock = threading.Lock()
+
+    def _seq_index(self, positions):
+        return np.searchsorted(self.seq_offsets, positions, side="right") - 1
+
+    def primer_sites(self, oligo_codes, seed_at_end):
+        """Find start positions of oligo on the positive strand.  The seed is
+        the k-mer at the end of the oligo if seed_at_end (primer 3' end), else
+        the start (reverse-complement of primer)."""
+        kmer_size = self.spec.kmer_size
+        if len(oligo_codes) < kmer_size:
+            raise PrimersJuJuError(f"primer length {len(oligo_codes)} is less than LocalPcrSpec kmer_size {kmer_size}")
+        seed = oligo_codes[-kmer_size:] if seed_at_end else oligo_codes[:kmer_size]
+        kmer = kmer_codes(seed, kmer_size)[0]
+        if kmer < 0:
+            return np.zeros(0, dtype=np.int64)
+        seed_pos = np.asarray(self.positions[self.offsets[kmer]:self.offsets[kmer + 1]], dtype=np.int64)
+        starts = seed_pos - (len(oligo_codes) - kmer_size) if seed_at_end else seed_pos
+        starts = starts[(starts >= 0) & (starts + len(oligo_codes) <= len(self.seq))]
+        if len(starts) == 0:
+            return starts
+        # must be in one sequence, which also excludes the separators
+        starts = starts[self._seq_index(starts) == self._seq_index(starts + len(oligo_codes) - 1)]
+        windows = self.seq[starts[:, np.newaxis] + np.arange(len(oligo_codes))]
+        mismatches = np.sum(windows != oligo_codes, axis=1)
+        return np.sort(starts[mismatches <= self.spec.max_mismatches])
+
+    def _pair_sites(self, first_starts, first_len, last_starts, last_len, max_size):
+        """pair sites of the first primer with downstream sites of the last,
+        returning product start and end arrays"""
+        lo = np.searchsorted(last_starts, first_starts + first_len, side="left")
+        hi = np.searchsorted(last_starts, first_starts + max_size - last_len, side="right")
+        cnts = np.maximum(hi - lo, 0)
+        starts = np.repeat(first_starts, cnts)
+        idx = np.repeat(lo, cnts) + (np.arange(cnts.sum()) - np.repeat(np.cumsum(cnts) - cnts, cnts))
+        ends = last_starts[idx] + last_len
+        same_seq = self._seq_index(starts) == self._seq_index(ends - 1)
+        return starts[same_seq], ends[same_seq]
+
+    def _find_oligo_sites(self, oligo):
+        oligo_codes = encode_seq(oligo)
+        return OligoSites(len(oligo_codes),
+                          self.primer_sites(oligo_codes, True),
+                          self.primer_sites(reverse_complement_codes(oligo_codes), False))
+
+    def oligo_sites(self, oligo) -> OligoSites:
+        """get the binding sites of an oligo, memoized"""
+        oligo = oligo.upper()
+        with self._oligo_cache_lock:
+            sites = self._oligo_cache.get(oligo)
+            if sites is not None:
+                self._oligo_cache.move_to_end(oligo)
+                return sites
+        sites = self._find_oligo_sites(oligo)
+        if self.spec.oligo_cache_size > 0:
+            with self._oligo_cache_lock:
+                self._oligo_cache[oligo] = sites
+                while len(self._oligo_cache) > self.spec.oligo_cache_size:
+                    self._oligo_cache.popitem(last=False)
+        return sites
+
+    def _strand_products(self, first_sites, last_sites, max_size, strand):
+        starts, ends = self._pair_sites(first_sites.fwd, first_sites.length,
+                                        last_sites.rc, last_sites.length,
+                                        max_size)
+        seq_idxs = self._seq_index(starts)
+        return [PcrProduct(self.seq_names[si], int(start - self.seq_offsets[si]), int(end - self.seq_offsets[si]),
+                           strand, int(self.seq_sizes[si]))
+                for si, start, end in zip(seq_idxs, starts, ends)]
+
+    def pcr_products(self, left_primer, right_primer, max_size):
+        """find products of a primer pair that are no longer than max_size"""
+        left_sites = self.oligo_sites(left_primer)
+        right_sites = self.oligo_sites(right_primer)
+        return sorted(self._strand_products(left_sites, right_sites, max_size, '+') +
+                      self._strand_products(right_sites, left_sites, max_size, '-'),
+                      key=lambda p: (p.seq_name, p.start, p.end, p.strand))
+
+    def get_seq(self, seq_name, start, end):
+        si = self.seq_name_idxs[seq_name]
+        offset = self.seq_offsets[si]
+        return decode_seq(np.asarray(self.seq[offset + start:offset + end]))
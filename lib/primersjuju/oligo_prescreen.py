@@ -0,0 +1,228 @@
+"""
+Vectorized pre-screen of candidate oligo windows in primer regions before
+running primer3.  This computes approximate versions of the primer3 per-oligo
+constraints for every start and length in a region, so that targets with no
+possible oligos can be reported without running primer3 and the OK regions
+passed to primer3 can be narrowed to the feasible windows.
+
+The screen must never reject an oligo primer3 would accept.  Tm is computed
+with the SantaLucia 1998 nearest-neighbor parameters and salt correction
+that are the primer3 defaults, and checked with a small slack.
+"""
+from collections import namedtuple
+from dataclasses import dataclass
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# primer3 defaults for arguments used in screening
+_screen_defaults = dict(PRIMER_MIN_SIZE=18,
+                        PRIMER_MAX_SIZE=27,
+                        PRIMER_MIN_GC=20.0,
+                        PRIMER_MAX_GC=80.0,
+                        PRIMER_MIN_TM=57.0,
+                        PRIMER_MAX_TM=63.0,
+                        PRIMER_MAX_POLY_X=5,
+                        PRIMER_MAX_END_GC=5,
+                        PRIMER_GC_CLAMP=0,
+                        PRIMER_MAX_NS_ACCEPTED=0,
+                        PRIMER_SALT_MONOVALENT=50.0,
+                        PRIMER_SALT_DIVALENT=1.5,
+                        PRIMER_DNTP_CONC=0.6,
+                        PRIMER_DNA_CONC=50.0)
+
+# number of 3' bases checked by PRIMER_MAX_END_GC
+_END_GC_LEN = 5
+
+# base to code, with 4 for anything else
+_BASES = "ACGT"
+_base_codes = np.full(256, 4, dtype=np.int64)
+for _i, _b in enumerate(_BASES):
+    _base_codes[ord(_b)] = _i
+
+# SantaLucia 1998 unified nearest-neighbor delta-H (kcal/mol) and delta-S
+# (cal/K/mol), indexed by the code of base1 * 5 + base2.  Dinucleotides with
+# N are zero.
+_nn_params = {"AA": (-7.9, -22.2), "TT": (-7.9, -22.2), "AT": (-7.2, -20.4), "TA": (-7.2, -21.3),
+              "CA": (-8.5, -22.7), "TG": (-8.5, -22.7), "GT": (-8.4, -22.4), "AC": (-8.4, -22.4),
+              "CT": (-7.8, -21.0), "AG": (-7.8, -21.0), "GA": (-8.2, -22.2), "TC": (-8.2, -22.2),
+              "CG": (-10.6, -27.2), "GC": (-9.8, -24.4), "GG": (-8.0, -19.9), "CC": (-8.0, -19.9)}
+_nn_delta_h = np.zeros(25)
+_nn_delta_s = np.zeros(25)
+for _dinuc, (_dh, _ds) in _nn_params.items():
+    _nn_delta_h[_BASES.index(_dinuc[0]) * 5 + _BASES.index(_dinuc[1])] = _dh
+    _nn_delta_s[_BASES.index(_dinuc[0]) * 5 + _BASES.index(_dinuc[1])] = _ds
+
+# terminal initiation (delta-H, delta-S) for A/T and G/C ends
+_init_at = (2.3, 4.1)
+_init_gc = (0.1, -2.8)
+_GAS_CONST = 1.987
+
+def _screen_arg(global_args, name):
+    val = global_args.get(name)
+    return _screen_defaults[name] if val is None else val
+
+class OligoWindowMetrics(namedtuple("OligoWindowMetrics",
+                                    ("starts", "length", "gc_percent", "tm", "max_poly_x",
+                                     "end_gc", "clamp_gc", "num_ns"))):
+    """arrays of metrics for all oligo windows of a given length, indexed by
+    window.  starts are zero-based template positions.  end_gc is the number of
+    G/C in the five 3' bases and clamp_gc is the number of consecutive G/C
+    ending at the 3' end."""
+    __slots__ = ()
+
+def _encode_seq(seq):
+    return np.frombuffer(seq.upper().encode(), dtype=np.uint8)
+
+def _salt_conc(global_args):
+    "monovalent equivalent salt concentration (mM), as used by primer3"
+    divalent = _screen_arg(global_args, "PRIMER_SALT_DIVALENT") - _screen_arg(global_args, "PRIMER_DNTP_CONC")
+    return _screen_arg(global_args, "PRIMER_SALT_MONOVALENT") + 120.0 * np.sqrt(max(divalent, 0.0))
+
+def _prefix_sum(vals):
+    "prefix sum with leading zero, so sum over [s, e) is psum[e] - psum[s]"
+    return np.concatenate(([0], np.cumsum(vals)))
+
+def _run_lengths_ending(bases):
+    "length of the homopolymer run ending at each position"
+    idxs = np.arange(len(bases))
+    run_start = np.zeros(len(bases), dtype=np.int64)
+    run_start[1:] = np.where(bases[1:] != bases[:-1], idxs[1:], 0)
+    run_start = np.maximum.accumulate(run_start)
+    return idxs - run_start + 1
+
+def _gc_run_lengths_ending(is_gc):
+    "length of the run of G/C ending at each position"
+    idxs = np.arange(len(is_gc))
+    last_non_gc = np.maximum.accumulate(np.where(is_gc, -1, idxs))
+    return idxs - last_non_gc
+
+def window_tms(codes, win_starts, length, global_args):
+    """nearest-neighbor Tm of windows of length starting at win_starts in
+    base-coded sequence, vectorized.  Tm is the same for either strand."""
+    dinucs = codes[:-1] * 5 + codes[1:]
+    dh_psum = _prefix_sum(_nn_delta_h[dinucs])
+    ds_psum = _prefix_sum(_nn_delta_s[dinucs])
+    delta_h = dh_psum[win_starts + length - 1] - dh_psum[win_starts]
+    delta_s = ds_psum[win_starts + length - 1] - ds_psum[win_starts]
+    for end_codes in (codes[win_starts], codes[win_starts + length - 1]):
+        is_at = (end_codes == 0) | (end_codes == 3)
+        delta_h = delta_h + np.where(is_at, _init_at[0], _init_gc[0])
+        delta_s = delta_s + np.where(is_at, _init_at[1], _init_gc[1])
+    delta_s = delta_s + 0.368 * (length - 1) * np.log(_salt_conc(global_args) / 1000.0)
+    dna_conc = _screen_arg(global_args, "PRIMER_DNA_CONC") / 4.0e9
+    return (1000.0 * delta_h) / (delta_s + _GAS_CONST * np.log(dna_conc)) - 273.15
+
+def oligo_window_metrics(seq, start, end, length, side, global_args):
+    """compute metrics for all windows of length in seq[start:end].  Side is
+    LEFT or RIGHT; a right oligo is the reverse-complement of the window, so its
+    3' end is at the start of the window."""
+    bases = _encode_seq(seq[start:end])
+    num_windows = len(bases) - length + 1
+    if num_windows <= 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return OligoWindowMetrics(empty, length, empty.astype(np.float64), empty.astype(np.float64),
+                                  empty, empty, empty, empty)
+    is_gc = (bases == ord('G')) | (bases == ord('C'))
+    is_n = ~np.isin(bases, np.frombuffer(b"ACGT", dtype=np.uint8))
+    gc_psum = _prefix_sum(is_gc)
+    win_starts = np.arange(num_windows)
+    win_ends = win_starts + length
+    gc_cnt = gc_psum[win_ends] - gc_psum[win_starts]
+    n_psum = _prefix_sum(is_n)
+
+    # runs are clipped to the window by limiting the run ending at window
+    # offset j to j + 1
+    max_poly_x = np.minimum(sliding_window_view(_run_lengths_ending(bases), length),
+                            np.arange(1, length + 1)).max(axis=1)
+
+    end_len = min(_END_GC_LEN, length)
+    if side == "LEFT":
+        end_gc = gc_psum[win_ends] - gc_psum[win_ends - end_len]
+        clamp_gc = np.minimum(_gc_run_lengths_ending(is_gc)[win_ends - 1], length)
+    else:
+        end_gc = gc_psum[win_starts + end_len] - gc_psum[win_starts]
+        # G/C run starting at window start, computed on reversed sequence
+        clamp_gc = np.minimum(_gc_run_lengths_ending(is_gc[::-1])[::-1][win_starts], length)
+
+    return OligoWindowMetrics(win_starts + start, length,
+                              100.0 * gc_cnt / length, window_tms(_base_codes[bases], win_starts, length, global_args),
+                              max_poly_x, end_gc, clamp_gc,
+                              n_psum[win_ends] - n_psum[win_starts])
+
+@dataclass
+class OligoRegionScreen:
+    """Result of screening one primer region.  Rejection counts are by the first
+    failing check, as with primer3 explain strings."""
+    side: str
+    region: tuple  # (start, length)
+    num_considered: int = 0
+    num_ns: int = 0
+    num_gc: int = 0
+    num_tm: int = 0
+    num_poly_x: int = 0
+    num_end_gc: int = 0
+    num_ok: int = 0
+    feasible_start: int = None
+    feasible_end: int = None
+
+    @property
+    def feasible(self):
+        return self.num_ok > 0
+
+    @property
+    def feasible_region(self):
+        "(start, length) covering all feasible windows, or None"
+        if not self.feasible:
+            return None
+        return [self.feasible_start, self.feasible_end - self.feasible_start]
+
+    def explain(self):
+        return (f"prescreen {self.side}: considered {self.num_considered}, Ns {self.num_ns}, GC {self.num_gc}, "
+                f"tm {self.num_tm}, poly-x {self.num_poly_x}, end GC {self.num_end_gc}, ok {self.num_ok}")
+
+def _screen_windows(metrics, global_args, tm_slack, screen):
+    remain = np.ones(len(metrics.starts), dtype=bool)
+
+    def _reject(failed):
+        nonlocal remain
+        failed = failed & remain
+        remain = remain & ~failed
+        return int(np.count_nonzero(failed))
+
+    screen.num_considered += len(metrics.starts)
+    screen.num_ns += _reject(metrics.num_ns > _screen_arg(global_args, "PRIMER_MAX_NS_ACCEPTED"))
+    screen.num_gc += _reject((metrics.gc_percent < _screen_arg(global_args, "PRIMER_MIN_GC")) |
+                             (metrics.gc_percent > _screen_arg(global_args, "PRIMER_MAX_GC")))
+    screen.num_tm += _reject((metrics.tm < _screen_arg(global_args, "PRIMER_MIN_TM") - tm_slack) |
+                             (metrics.tm > _screen_arg(global_args, "PRIMER_MAX_TM") + tm_slack))
+    screen.num_poly_x += _reject(metrics.max_poly_x > _screen_arg(global_args, "PRIMER_MAX_POLY_X"))
+    screen.num_end_gc += _reject((metrics.end_gc > _screen_arg(global_args, "PRIMER_MAX_END_GC")) |
+                                 (metrics.clamp_gc < _screen_arg(global_args, "PRIMER_GC_CLAMP")))
+    ok_starts = metrics.starts[remain]
+    screen.num_ok += len(ok_starts)
+    if len(ok_starts) > 0:
+        start, end = int(ok_starts.min()), int(ok_starts.max()) + metrics.length
+        screen.feasible_start = start if screen.feasible_start is None else min(start, screen.feasible_start)
+        screen.feasible_end = end if screen.feasible_end is None else max(end, screen.feasible_end)
+
+def oligo_region_screen(seq, region, side, global_args, *, tm_slack=1.0):
+    """screen all windows for all primer lengths in region (start, length) of seq"""
+    screen = OligoRegionScreen(side, tuple(region))
+    start, end = region[0], region[0] + region[1]
+    for length in range(_screen_arg(global_args, "PRIMER_MIN_SIZE"), _screen_arg(global_args, "PRIMER_MAX_SIZE") + 1):
+        _screen_windows(oligo_window_metrics(seq, start, end, length, side, global_args), global_args, tm_slack, screen)
+    return screen
+
+def oligo_prescreen(seq, ok_regions, global_args, *, tm_slack=1.0):
+    """Screen a SEQUENCE_PRIMER_PAIR_OK_REGION_LIST, returning a list of
+    (left_screen, right_screen) for each OK region set."""
+    return [(oligo_region_screen(seq, ok_region[0:2], "LEFT", global_args, tm_slack=tm_slack),
+             oligo_region_screen(seq, ok_region[2:4], "RIGHT", global_args, tm_slack=tm_slack))
+            for ok_region in ok_regions]
+
+def prescreen_narrow_ok_regions(screens):
+    """build a new OK region list with only the feasible OK region sets, with each
+    region narrowed to the feasible windows.  Empty if none are feasible."""
+    return [left_screen.feasible_region + right_screen.feasible_region
+            for left_screen, right_screen in screens
+            if left_screen.feasible and right_screen.feasible]
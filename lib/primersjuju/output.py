@@ -27,12 +27,16 @@ PRIMERS_ON_OFF_COLOR = SvgColors.orange
 PRIMERS_OFF_COLOR = SvgColors.red
 PRIMERS_NONE_COLOR = SvgColors.darkorange
 PRIMERS_NON_COLOR = SvgColors.purple
+PRIMERS_VARIANT_COLOR = SvgColors.goldenrod
 
 # uniqueness track
 UNIQ_ON_COLOR = SvgColors.green
 UNIQ_OFF_COLOR = SvgColors.red
 UNIQ_NON_COLOR = SvgColors.purple
 
+# variant track
+VARIANT_COLOR = SvgColors.black
+
 
 #  Delta G: secondary structures of any self-dimers, hairpins, and
 #  heterodimers that should be weaker (more positive) thanÂ -9.0 kcal/mole.
@@ -157,13 +161,14 @@ def _primer_color(primer_design):
     if (((uniqueness.transcriptome_on_target_cnt + uniqueness.genome_on_target_cnt) > 0) and
         ((uniqueness.transcriptome_off_target_cnt + uniqueness.genome_off_target_cnt) > 0)):
         return PRIMERS_ON_OFF_COLOR
+    # variants are only shown on pairs that are unique or not checked, so that uniqueness problems are not hidden
     if ((uniqueness.transcriptome_on_target_cnt + uniqueness.genome_on_target_cnt) > 0):
-        return PRIMERS_ON_COLOR
+        return PRIMERS_VARIANT_COLOR if primer_design.primer_variants else PRIMERS_ON_COLOR
     if ((uniqueness.transcriptome_off_target_cnt + uniqueness.genome_off_target_cnt) > 0):
         return PRIMERS_OFF_COLOR
     if ((uniqueness.transcriptome_non_target_cnt + uniqueness.genome_non_target_cnt) > 0):
         return PRIMERS_NON_COLOR
-    return PRIMERS_NONE_COLOR
+    return PRIMERS_VARIANT_COLOR if primer_design.primer_variants else PRIMERS_NONE_COLOR
 
 def _primer_to_bed(primer_designs, primer_design, *, color=None, add_extra=True):
     if color is None:
@@ -229,6 +234,16 @@ def build_transcriptome_uniqueness_hits_beds(primer_designs):
         beds.extend(_build_transcriptome_uniqueness_hits_beds(primer_design))
     return beds
 
+def _primer_variant_to_bed(primer_design, primer_variant):
+    variant = primer_variant.variant
+    return Bed(variant.chrom, variant.start, variant.end, f"{variant.variant_id}|{primer_design.ppair_id}",
+               strand='+', thickStart=variant.start, thickEnd=variant.end,
+               itemRgb=VARIANT_COLOR.toRgb8Str(), numStdCols=9)
+
+def build_primer_variant_beds(primer_designs):
+    return [_primer_variant_to_bed(pd, pv)
+            for pd in primer_designs.designs for pv in pd.primer_variants]
+
 def _write_beds(beds, bed_file):
     beds = sorted(beds, key=Bed.genome_sort_key)
     with open(bed_file, "w") as fh:
@@ -274,6 +289,18 @@ def _make_uniqeness_hits_browser_gcoords(hits):
         gcoords_list = sorted(set([h.get_genome_range() for h in hits]))
         return ", ".join([str(c) for c in gcoords_list])
 
+def _make_off_target_hits_browser_gcoords(hits, truncated):
+    """list of off-target coordinates, prefixed with ≥N if the query was stopped
+    after the maximum number of off-targets"""
+    gcoords_str = _make_uniqeness_hits_browser_gcoords(hits)
+    return f"≥{len(hits)}: {gcoords_str}" if truncated else gcoords_str
+
+def _format_primer_variants(primer_variants):
+    "list of variant ids, with primer and distance from the 3' end"
+    if primer_variants is None:
+        return ""
+    return ", ".join(f"{pv.variant.variant_id}({pv.primer},{pv.dist_3p})" for pv in primer_variants)
+
 def _count_amplicon_exons(primer_design, target_transcript):
     amp_features = primer_design_amplicon_features(primer_design, target_transcript)
     return len([exon for exon in amp_features.iter_type(ExonFeature)])
@@ -304,14 +331,17 @@ def output_target_beds(outdir, primer_targets, primer_designs):
                     _get_out_path(outdir, primer_targets.target_id, "genome-uniqueness.bed"))
         _write_beds(build_transcriptome_uniqueness_hits_beds(primer_designs),
                     _get_out_path(outdir, primer_targets.target_id, "transcriptome-uniqueness.bed"))
+    if any(pd.primer_variants is not None for pd in primer_designs.designs):
+        _write_beds(build_primer_variant_beds(primer_designs),
+                    _get_out_path(outdir, primer_targets.target_id, "variants.bed"))
 
 
 _design_tsv_header = ("target_id", "transcript_id", "design_status", "position", "browser",
                       "primer_id", "left_primer", "right_primer", "pri",
                       "amplicon_len", "amplicon_exons", "left_delta_G", "right_delta_G",
                       "on_target_trans", "off_target_trans",
-                      "on_target_genome", "off_target_genome",
-                      "amplicon")
+                      "on_target_genome", "off_target_genome", "uniqueness_tier",
+                      "primer_variants", "amplicon")
 
 def _write_primer_pair_design_trans(fh, primer_designs, primer_design, trans, first, hub_urls):
     "write one design, if primer_design is None, it means there were no primers found"
@@ -323,7 +353,7 @@ def _write_primer_pair_design_trans(fh, primer_designs, primer_design, trans, fi
     else:
         row.extend(2 * [''])
     if primer_design is None:
-        row += 13 * ['']
+        row += 15 * ['']
     else:
         amp_seq = primer_design_amplicon(primer_design, trans)
         row += [primer_design.ppair_id,
@@ -335,9 +365,13 @@ def _write_primer_pair_design_trans(fh, primer_designs, primer_design, trans, fi
                 primer_design.primer3_pair.PRIMER_LEFT_END_STABILITY,
                 primer_design.primer3_pair.PRIMER_RIGHT_END_STABILITY,
                 _make_uniqeness_hits_browser_gcoords(primer_design.uniqueness.transcriptome_on_targets),
-                _make_uniqeness_hits_browser_gcoords(primer_design.uniqueness.transcriptome_off_targets),
+                _make_off_target_hits_browser_gcoords(primer_design.uniqueness.transcriptome_off_targets,
+                                                      primer_design.uniqueness.transcriptome_off_targets_truncated),
                 _make_uniqeness_hits_browser_gcoords(primer_design.uniqueness.genome_on_targets),
-                _make_uniqeness_hits_browser_gcoords(primer_design.uniqueness.genome_off_targets),
+                _make_off_target_hits_browser_gcoords(primer_design.uniqueness.genome_off_targets,
+                                                      primer_design.uniqueness.genome_off_targets_truncated),
+                '' if primer_design.uniqueness.tier is None else primer_design.uniqueness.tier,
+                _format_primer_variants(primer_design.primer_variants),
                 amp_seq]
     fileOps.prRow(fh, row)
 
@@ -388,6 +422,45 @@ def output_primers_isoforms(outdir, primer_targets, primer_designs):
         with open(tmp_tsv, "w") as fh:
             _write_primers_isoforms(fh, primer_targets, primer_designs)
 
+_amplified_isoform_tsv_header = ("target_id", "primer_id", "pri", "track", "transcript_id", "amplicon_len",
+                                 "min_length_gap")
+
+def _write_amplified_isoforms(fh, primer_targets, primer_designs):
+    fileOps.prRow(fh, _amplified_isoform_tsv_header)
+    for primer_design in primer_designs.designs:
+        for amplified_isoform in primer_design.amplified_isoforms:
+            fileOps.prRowv(fh, primer_targets.target_id, primer_design.ppair_id, primer_design.priority,
+                           amplified_isoform.trans_id.track, amplified_isoform.trans_id.name,
+                           amplified_isoform.amplicon_length, primer_design.isoform_length_gap)
+
+def output_amplified_isoforms(outdir, primer_targets, primer_designs):
+    "output other isoforms amplified by designs, if they were checked"
+    if not any(pd.amplified_isoforms is not None for pd in primer_designs.designs):
+        return
+    fileOps.ensureDir(outdir)
+    with fileOps.AtomicFileCreate(_get_out_path(outdir, primer_targets.target_id, "amplified-isoforms.tsv")) as tmp_tsv:
+        with open(tmp_tsv, "w") as fh:
+            _write_amplified_isoforms(fh, primer_targets, primer_designs)
+
+_similar_transcript_tsv_header = ("target_id", "primer_id", "pri", "transcript_id", "containment", "shared_kmers")
+
+def _write_similar_transcripts(fh, primer_targets, primer_designs):
+    fileOps.prRow(fh, _similar_transcript_tsv_header)
+    for primer_design in primer_designs.designs:
+        for similar_transcript in primer_design.similar_transcripts:
+            fileOps.prRowv(fh, primer_targets.target_id, primer_design.ppair_id, primer_design.priority,
+                           similar_transcript.name, f"{similar_transcript.containment:.3f}",
+                           similar_transcript.shared)
+
+def output_similar_transcripts(outdir, primer_targets, primer_designs):
+    "output non-target transcripts similar to amplicons, if they were checked"
+    if not any(pd.similar_transcripts is not None for pd in primer_designs.designs):
+        return
+    fileOps.ensureDir(outdir)
+    with fileOps.AtomicFileCreate(_get_out_path(outdir, primer_targets.target_id, "similar-transcripts.tsv")) as tmp_tsv:
+        with open(tmp_tsv, "w") as fh:
+            _write_similar_transcripts(fh, primer_targets, primer_designs)
+
 def output_target_designs(config, outdir, primer_targets, primer_designs, hub_urls=None):
     """output primer TSV, BEDs, and debug information for one target.  The
     $target_id.design.tsv file is created atomically, so it can be used as a
@@ -399,4 +472,90 @@ def output_target_designs(config, outdir, primer_targets, primer_designs, hub_ur
     output_target_debug(config, outdir, primer_targets, primer_designs)
     output_target_beds(outdir, primer_targets, primer_designs)
     output_primers_isoforms(outdir, primer_targets, primer_designs)
+    output_amplified_isoforms(outdir, primer_targets, primer_designs)
+    output_similar_transcripts(outdir, primer_targets, primer_designs)
     output_primer_designs(outdir, primer_targets, primer_designs, hub_urls)
+
+_sweep_tsv_header = ("target_id", "variant", "design_status", "num_designs", "num_good",
+                     "primer_id", "left_primer", "right_primer", "amplicon_len",
+                     "left_delta_G", "right_delta_G", "error")
+
+def _write_sweep_result(fh, sweep_result):
+    primer_designs = sweep_result.primer_designs
+    if sweep_result.error is not None:
+        fileOps.prRow(fh, [sweep_result.target_id, sweep_result.variant] + 9 * [''] + [str(sweep_result.error)])
+        return
+    row = [sweep_result.target_id, sweep_result.variant, primer_designs.status,
+           len(primer_designs.designs), primer_designs.good_count]
+    if len(primer_designs.designs) == 0:
+        row += 6 * ['']
+    else:
+        primer_design = primer_designs.designs[0]
+        row += [primer_design.ppair_id,
+                primer_design.primer3_pair.PRIMER_LEFT_SEQUENCE,
+                primer_design.primer3_pair.PRIMER_RIGHT_SEQUENCE,
+                primer_design.amplicon_length,
+                primer_design.primer3_pair.PRIMER_LEFT_END_STABILITY,
+                primer_design.primer3_pair.PRIMER_RIGHT_END_STABILITY]
+    fileOps.prRow(fh, row + [''])
+
+def _write_sweep_status(fh, sweep_results, variants):
+    "one row per target, with the design status for each variant"
+    fileOps.prRow(fh, ["target_id"] + list(variants))
+    status_by_target = {}
+    for sweep_result in sweep_results:
+        status = "ERROR" if sweep_result.error is not None else sweep_result.primer_designs.status
+        status_by_target.setdefault(sweep_result.target_id, {})[sweep_result.variant] = status
+    for target_id, statuses in status_by_target.items():
+        fileOps.prRow(fh, [target_id] + [statuses.get(variant, '') for variant in variants])
+
+def output_sweep_summary(outdir, sweep_results, variants):
+    """output comparative summary of a primer3 configuration sweep.
+    sweep.tsv has the best design for each target and variant, sweep-status.tsv
+    has the design status for target by variant."""
+    fileOps.ensureDir(outdir)
+    with fileOps.AtomicFileCreate(osp.join(outdir, "sweep.tsv")) as tmp_tsv:
+        with open(tmp_tsv, "w") as fh:
+            fileOps.prRow(fh, _sweep_tsv_header)
+            for sweep_result in sweep_results:
+                _write_sweep_result(fh, sweep_result)
+    with fileOps.AtomicFileCreate(osp.join(outdir, "sweep-status.tsv")) as tmp_tsv:
+        with open(tmp_tsv, "w") as fh:
+            _write_sweep_status(fh, sweep_results, variants)
+
+_region_suggestion_tsv_header = ("target_id", "region_5p", "region_3p", "trans_track", "trans_id", "suggest_junction")
+
+def _one_based_coords_str(gcoords):
+    "format in the browser one-based form used by primer target specifications"
+    return f"{gcoords.name}:{gcoords.start + 1}-{gcoords.end}"
+
+def _write_region_suggestion(fh, trans_id, num, suggestion):
+    fileOps.prRowv(fh, f"{trans_id.name}+J{num}",
+                   _one_based_coords_str(suggestion.region_5p), _one_based_coords_str(suggestion.region_3p),
+                   trans_id.track, trans_id.name, _one_based_coords_str(suggestion.sharing.gcoords))
+
+def output_region_suggestions(suggestions_tsv, trans_suggestions):
+    """output suggested isoform-specific primer regions as a primer targets
+    TSV.  trans_suggestions is a list of tuples of TranscriptId and list of
+    RegionSuggestion"""
+    with fileOps.AtomicFileCreate(suggestions_tsv) as tmp_tsv:
+        with open(tmp_tsv, "w") as fh:
+            fileOps.prRow(fh, _region_suggestion_tsv_header)
+            for trans_id, suggestions in trans_suggestions:
+                for num, suggestion in enumerate(suggestions, 1):
+                    _write_region_suggestion(fh, trans_id, num, suggestion)
+
+_discovered_target_tsv_header = ("target_id", "region_5p", "region_3p", "trans_track", "trans_id",
+                                 "suggest_junction", "locus_isoforms")
+
+def output_discovered_target_header(fh):
+    fileOps.prRow(fh, _discovered_target_tsv_header)
+
+def output_discovered_target(fh, primer_target_spec):
+    """write a PrimerTargetSpec generated by discover_target_specs as a
+    primer targets TSV row"""
+    (trans_track, trans_id), = primer_target_spec.get_tracks_trans()
+    fileOps.prRowv(fh, primer_target_spec.target_id,
+                   _one_based_coords_str(primer_target_spec.region_5p), _one_based_coords_str(primer_target_spec.region_3p),
+                   trans_track, trans_id,
+                   primer_target_spec.user_attrs["suggest_junction"], primer_target_spec.user_attrs["locus_isoforms"])
@@ -4,10 +4,16 @@ Interface to primer3 python module
 import sys
 import re
 import copy
+import time
 import pprint
+import threading
+import multiprocessing
+from functools import lru_cache
+import numpy as np
 import primer3
 from pycbio.sys.objDict import ObjDict
-from . import PrimersJuJuDataError, PrimersJuJuError
+from . import PrimersJuJuDataError, PrimersJuJuError, PrimersJuJuTimeoutError
+from .oligo_prescreen import oligo_prescreen, prescreen_narrow_ok_regions
 
 # Notes:
 # forces the use of 0-based indexing
@@ -102,10 +108,48 @@ def _build_strong_match_str(config):
         mstr += (config.MIN_5_PRIME_OVERLAP_OF_JUNCTION - config.num_5_prime_strong_match) * 'N'
     return mstr
 
-def _build_seq_args(config, target_transcript):
+def _lower_positions(seq, positions):
+    bases = list(seq)
+    for pos in positions:
+        bases[pos] = bases[pos].lower()
+    return "".join(bases)
+
+def _soft_mask_runs(seq, min_run):
+    """find runs of at least min_run lower-case bases in seq, returning arrays
+    of the starts and ends of the runs"""
+    masked = np.frombuffer(seq.encode(), dtype=np.uint8) >= ord('a')
+    edges = np.diff(np.concatenate(([False], masked, [False])).astype(np.int8))
+    starts = np.nonzero(edges == 1)[0]
+    ends = np.nonzero(edges == -1)[0]
+    keep = (ends - starts) >= min_run
+    return starts[keep], ends[keep]
+
+def _soft_mask_template(template, rna_soft_masked, min_run):
+    """lower-case the template in runs of soft-masked bases"""
+    starts, ends = _soft_mask_runs(rna_soft_masked, min_run)
+    if len(starts) == 0:
+        return template
+    cover = np.zeros(len(template) + 1, dtype=np.int32)
+    np.add.at(cover, starts, 1)
+    np.add.at(cover, ends, -1)
+    bases = np.frombuffer(template.encode(), dtype=np.uint8).copy()
+    bases[np.cumsum(cover[:-1]) > 0] |= 0x20  # ASCII lower-case
+    return bases.tobytes().decode()
+
+def _build_seq_args(config, target_transcript, kmer_freq_filter=None):
+    """If kmer_freq_filter is specified, the template is lower-cased at 3' end
+    positions in the primer regions that are in high-frequency k-mers, so
+    they are excluded when primer3 lowercase masking is enabled.  Likewise,
+    if config.soft_mask_min_run is set, runs of soft-masked genome bases are
+    lower-cased."""
     ok_regions = make_ok_region(target_transcript)
+    template = target_transcript.rna
+    if (config.soft_mask_min_run is not None) and (target_transcript.rna_soft_masked is not None):
+        template = _soft_mask_template(template, target_transcript.rna_soft_masked, config.soft_mask_min_run)
+    if kmer_freq_filter is not None:
+        template = _lower_positions(template, kmer_freq_filter.high_freq_3p_positions(template, ok_regions))
     seq_args = ObjDict(SEQUENCE_ID=target_transcript.trans_id.name,
-                       SEQUENCE_TEMPLATE=target_transcript.rna,
+                       SEQUENCE_TEMPLATE=template,
                        SEQUENCE_PRIMER_PAIR_OK_REGION_LIST=ok_regions)
     junction_overlaps = _build_junction_overlap(target_transcript.features_5p) + _build_junction_overlap(target_transcript.features_3p)
     if len(junction_overlaps) > 0:
@@ -161,16 +205,51 @@ def _check_common_errors(target_transcript, seq_args, global_args):
         _check_region(region_features, "PRIMER_MIN_SIZE", global_args.PRIMER_MIN_SIZE)
         _check_region(region_features, "PRIMER_MAX_SIZE", global_args.PRIMER_MAX_SIZE)
 
-def primer3_design(primer3_config, target_transcript, *, debug=False):
+def primer3_oligo_3p_positions(primer3_pair):
+    """template positions of the 3' ends of the left and right primers of a pair.
+    PRIMER_RIGHT is the 5' end of the right primer, which is the rightmost base."""
+    left, right = primer3_pair.PRIMER_LEFT, primer3_pair.PRIMER_RIGHT
+    return left[0] + left[1] - 1, right[0] - right[1] + 1
+
+def _mask_3p_positions(seq_args, global_args, excluded_3p_positions):
+    """exclude primers with 3' ends at the template positions by lower-casing
+    them and enabling primer3 lowercase masking"""
+    seq_args.SEQUENCE_TEMPLATE = _lower_positions(seq_args.SEQUENCE_TEMPLATE, excluded_3p_positions)
+    global_args.PRIMER_LOWERCASE_MASKING = 1
+
+def primer3_deadline(primer3_config):
+    """time.monotonic() value when primer3_config.time_budget for a target is
+    exceeded, or None if there is no budget"""
+    if primer3_config.time_budget is None:
+        return None
+    return time.monotonic() + primer3_config.time_budget
+
+def primer3_design(primer3_config, target_transcript, *, debug=False, excluded_3p_positions=None,
+                   kmer_freq_filter=None, deadline=None):
     """main entry to run primer3
     global_args defined here:
     https://www.primer3plus.com/primer3plusHelp.html#globalTags
 
     global PRIMER_FIRST_BASE_INDEX must be zero.
+
+    Primers with 3' ends at template positions in excluded_3p_positions are not
+    returned.  If kmer_freq_filter, a KmerFreqFilter, is specified, primers
+    with 3' ends in high-frequency k-mers are also not returned.
+
+    Raises PrimersJuJuTimeoutError if primer3_config.time_budget is exceeded.
+    When primer3 is run multiple times for a target, deadline from
+    primer3_deadline() is passed so the budget covers all runs, otherwise
+    the budget starts with this call.
     """
+    if deadline is None:
+        deadline = primer3_deadline(primer3_config)
 
     global_args = _build_global_args(primer3_config, target_transcript)
-    seq_args = _build_seq_args(primer3_config, target_transcript)
+    seq_args = _build_seq_args(primer3_config, target_transcript, kmer_freq_filter)
+    if seq_args.SEQUENCE_TEMPLATE != target_transcript.rna:
+        global_args.PRIMER_LOWERCASE_MASKING = 1
+    if excluded_3p_positions:
+        _mask_3p_positions(seq_args, global_args, excluded_3p_positions)
     if debug:
         print(">>>>> primer3 debug:", target_transcript, file=sys.stderr)
         primer3_dump_args(sys.stderr, primer3_config, target_transcript,
@@ -178,17 +257,268 @@ def primer3_design(primer3_config, target_transcript, *, debug=False):
 
     _check_common_errors(target_transcript, seq_args, global_args)
 
-    # FIXME: dict() is a hack around primer3 give type error on ObjDict
-    p3_output = primer3.bindings.design_primers(dict(seq_args), dict(global_args),
-                                                misprime_lib=primer3_config.misprime_lib,
-                                                mishyb_lib=primer3_config.mishyb_lib)
-    results = primer3_parse_output(p3_output)
-    if "PRIMER_ERRORS" in results:
-        raise PrimersJuJuError(f"primer3 errors: {results.PRIMER_ERRORS}")
-    if "PRIMER_WARNINGS" in results:
-        raise PrimersJuJuError(f"primer3 warnings: {results.PRIMER_WARNINGS}")
+    if primer3_config.prescreen:
+        screens = oligo_prescreen(target_transcript.rna, seq_args.SEQUENCE_PRIMER_PAIR_OK_REGION_LIST, global_args,
+                                  tm_slack=primer3_config.prescreen_tm_slack)
+        if debug:
+            for screen in (s for screen_pair in screens for s in screen_pair):
+                print(screen.explain(), file=sys.stderr)
+        seq_args.SEQUENCE_PRIMER_PAIR_OK_REGION_LIST = prescreen_narrow_ok_regions(screens)
+        if len(seq_args.SEQUENCE_PRIMER_PAIR_OK_REGION_LIST) == 0:
+            return _prescreen_failed_results(screens)
+
+    if primer3_config.pair_picking == "primer3":
+        results = primer3_parse_output(_primer3_run(primer3_config, seq_args, global_args, deadline))
+    elif primer3_config.pair_picking == "split":
+        results = _primer3_split_design(primer3_config, seq_args, global_args, deadline)
+    else:
+        raise PrimersJuJuError(f"invalid Primer3Config.pair_picking value '{primer3_config.pair_picking}', expected 'primer3' or 'split'")
+    if global_args.get("PRIMER_LOWERCASE_MASKING"):
+        _upcase_pair_sequences(results)
     return results
 
+def _upcase_pair_sequences(results):
+    "primer3 returns masked bases in lower case"
+    for pair in results.pairs:
+        pair.PRIMER_LEFT_SEQUENCE = pair.PRIMER_LEFT_SEQUENCE.upper()
+        pair.PRIMER_RIGHT_SEQUENCE = pair.PRIMER_RIGHT_SEQUENCE.upper()
+
+def primer3_empty_results(pair_explain, *, left_explain="", right_explain=""):
+    "results with no pairs, for when primer3 was not run or did not complete"
+    return primer3_parse_output(ObjDict(PRIMER_LEFT_EXPLAIN=left_explain,
+                                        PRIMER_RIGHT_EXPLAIN=right_explain,
+                                        PRIMER_PAIR_EXPLAIN=pair_explain,
+                                        PRIMER_LEFT_NUM_RETURNED=0,
+                                        PRIMER_RIGHT_NUM_RETURNED=0,
+                                        PRIMER_INTERNAL_NUM_RETURNED=0,
+                                        PRIMER_PAIR_NUM_RETURNED=0))
+
+def _prescreen_failed_results(screens):
+    "results without running primer3 when pre-screen found no feasible oligos"
+    def _explain(side_idx):
+        return "; ".join(screen_pair[side_idx].explain() for screen_pair in screens)
+
+    return primer3_empty_results("prescreen: no feasible oligos, primer3 not run",
+                                 left_explain=_explain(0), right_explain=_explain(1))
+
+# primer3 keeps global state, so in-process calls from multiple threads must be serialized
+_primer3_lock = threading.Lock()
+
+# killable workers are started from a fork server, as forking this process,
+# which may have running thread pools, can deadlock
+_worker_mp_context = multiprocessing.get_context("forkserver")
+
+def _primer3_call(primer3_config, seq_args, global_args):
+    # FIXME: dict() is a hack around primer3 give type error on ObjDict
+    return primer3.bindings.design_primers(dict(seq_args), dict(global_args),
+                                           misprime_lib=primer3_config.misprime_lib,
+                                           mishyb_lib=primer3_config.mishyb_lib)
+
+def _primer3_worker(conn, primer3_config, seq_args, global_args):
+    "run primer3 in worker process, sending (output, error message) back"
+    try:
+        conn.send((_primer3_call(primer3_config, seq_args, global_args), None))
+    except Exception as ex:
+        conn.send((None, f"{type(ex).__name__}: {ex}"))
+    finally:
+        conn.close()
+
+def _primer3_call_killable(primer3_config, seq_args, global_args, deadline):
+    "run primer3 in a worker process that is killed if it runs past the deadline"
+    timeout = deadline - time.monotonic()
+    if timeout <= 0:
+        raise PrimersJuJuTimeoutError(f"primer3 time budget of {primer3_config.time_budget} seconds exceeded")
+    recv_conn, send_conn = _worker_mp_context.Pipe(duplex=False)
+    worker = _worker_mp_context.Process(target=_primer3_worker,
+                                        args=(send_conn, primer3_config, dict(seq_args), dict(global_args)),
+                                        daemon=True)
+    worker.start()
+    send_conn.close()
+    try:
+        if not recv_conn.poll(timeout):
+            raise PrimersJuJuTimeoutError(f"primer3 time budget of {primer3_config.time_budget} seconds exceeded")
+        p3_output, error_msg = recv_conn.recv()
+    finally:
+        recv_conn.close()
+        if worker.is_alive():
+            worker.kill()
+        worker.join()
+    if error_msg is not None:
+        raise PrimersJuJuError(f"primer3 failed: {error_msg}")
+    return p3_output
+
+def _primer3_run(primer3_config, seq_args, global_args, deadline=None):
+    """run primer3 and check for errors, returning the raw output.  If deadline
+    is not None, run is killed if not complete by that time.monotonic() value."""
+    if deadline is None:
+        with _primer3_lock:
+            p3_output = _primer3_call(primer3_config, seq_args, global_args)
+    else:
+        p3_output = _primer3_call_killable(primer3_config, seq_args, global_args, deadline)
+    if "PRIMER_ERRORS" in p3_output:
+        raise PrimersJuJuError(f"primer3 errors: {p3_output['PRIMER_ERRORS']}")
+    if "PRIMER_WARNINGS" in p3_output:
+        raise PrimersJuJuError(f"primer3 warnings: {p3_output['PRIMER_WARNINGS']}")
+    return ObjDict(p3_output)
+
+###
+# Split picking.  Primer3 is run to pick left and right candidate lists
+# independently in each OK region, then all left x right combinations are
+# scored and ranked here.  This avoids the primer3 pair search, which is
+# slow when the product size range spans many kilobases.
+###
+
+# primer3 defaults for pair arguments used in ranking
+_split_pair_defaults = ObjDict(PRIMER_NUM_RETURN=5,
+                               PRIMER_PAIR_MAX_DIFF_TM=5.0,
+                               PRIMER_PAIR_MAX_COMPL_ANY_TH=47.0,
+                               PRIMER_PAIR_MAX_COMPL_END_TH=47.0,
+                               PRIMER_PAIR_WT_PR_PENALTY=1.0,
+                               PRIMER_PAIR_WT_DIFF_TM=0.0,
+                               PRIMER_PAIR_WT_COMPL_ANY_TH=0.0,
+                               PRIMER_PAIR_WT_COMPL_END_TH=0.0,
+                               PRIMER_SALT_MONOVALENT=50.0,
+                               PRIMER_SALT_DIVALENT=1.5,
+                               PRIMER_DNTP_CONC=0.6,
+                               PRIMER_DNA_CONC=50.0)
+
+def _split_pair_arg(global_args, name):
+    return global_args.get(name, _split_pair_defaults[name])
+
+@lru_cache(maxsize=65536)
+def _pair_compl_th(left_seq, right_seq, mv_conc, dv_conc, dntp_conc, dna_conc):
+    """compute (COMPL_ANY_TH, COMPL_END_TH) for a pair of oligos, cached as the
+    same oligos are paired many times"""
+    conc_args = dict(mv_conc=mv_conc, dv_conc=dv_conc, dntp_conc=dntp_conc, dna_conc=dna_conc)
+    compl_any = primer3.bindings.calc_heterodimer(left_seq, right_seq, **conc_args).tm
+    compl_end = primer3.bindings.calc_end_stability(left_seq, right_seq, **conc_args).tm
+    return max(compl_any, 0.0), max(compl_end, 0.0)
+
+def _get_pair_compl_th(global_args, left_seq, right_seq):
+    return _pair_compl_th(left_seq, right_seq,
+                          _split_pair_arg(global_args, "PRIMER_SALT_MONOVALENT"),
+                          _split_pair_arg(global_args, "PRIMER_SALT_DIVALENT"),
+                          _split_pair_arg(global_args, "PRIMER_DNTP_CONC"),
+                          _split_pair_arg(global_args, "PRIMER_DNA_CONC"))
+
+def _split_side_pick(primer3_config, seq_args, global_args, side, included_region, deadline):
+    """run primer3 to pick a list of candidate oligos for one side (LEFT or RIGHT)
+    in included_region, return list of Primer3Pair-style objects with only the side's tags"""
+    side_global_args = copy.copy(global_args)
+    side_global_args.PRIMER_PICK_LEFT_PRIMER = int(side == "LEFT")
+    side_global_args.PRIMER_PICK_RIGHT_PRIMER = int(side == "RIGHT")
+    side_global_args.PRIMER_NUM_RETURN = primer3_config.split_num_candidates
+    side_seq_args = copy.copy(seq_args)
+    del side_seq_args.SEQUENCE_PRIMER_PAIR_OK_REGION_LIST
+    side_seq_args.SEQUENCE_INCLUDED_REGION = included_region
+    p3_output = _primer3_run(primer3_config, side_seq_args, side_global_args, deadline)
+    return ([_parse_result(p3_output, i) for i in range(p3_output[f"PRIMER_{side}_NUM_RETURNED"])],
+            p3_output.get(f"PRIMER_{side}_EXPLAIN", ""))
+
+def _side_arrays(candidates, side):
+    "get position, Tm, and penalty arrays from candidates"
+    return (np.array([c[f"PRIMER_{side}"][0] for c in candidates], dtype=np.int64),
+            np.array([c[f"PRIMER_{side}_TM"] for c in candidates], dtype=np.float64),
+            np.array([c[f"PRIMER_{side}_PENALTY"] for c in candidates], dtype=np.float64))
+
+def split_pair_metrics(left_pos, left_tm, left_penalty, right_pos, right_tm, right_penalty,
+                       product_size_ranges, global_args):
+    """Compute left x right matrices of product size, Tm difference, and pair
+    penalty without complementarity, along with a boolean matrix of
+    combinations that pass the size and Tm difference limits.  Positions are
+    primer3 coordinates; the 5' position of the left primer and 3' position of
+    the right primer."""
+    product_size = right_pos[np.newaxis, :] - left_pos[:, np.newaxis] + 1
+    diff_tm = np.abs(left_tm[:, np.newaxis] - right_tm[np.newaxis, :])
+    penalty = (_split_pair_arg(global_args, "PRIMER_PAIR_WT_PR_PENALTY") * (left_penalty[:, np.newaxis] + right_penalty[np.newaxis, :]) +
+               _split_pair_arg(global_args, "PRIMER_PAIR_WT_DIFF_TM") * diff_tm)
+    size_ok = np.zeros(product_size.shape, dtype=bool)
+    for min_size, max_size in product_size_ranges:
+        size_ok |= (product_size >= min_size) & (product_size <= max_size)
+    ok = size_ok & (diff_tm <= _split_pair_arg(global_args, "PRIMER_PAIR_MAX_DIFF_TM"))
+    return product_size, diff_tm, penalty, ok
+
+def _split_make_pair(global_args, left, right, product_size, penalty):
+    "create a pair, or None if it fails complementarity checks"
+    compl_any, compl_end = _get_pair_compl_th(global_args, left.PRIMER_LEFT_SEQUENCE, right.PRIMER_RIGHT_SEQUENCE)
+    if ((compl_any > _split_pair_arg(global_args, "PRIMER_PAIR_MAX_COMPL_ANY_TH")) or
+        (compl_end > _split_pair_arg(global_args, "PRIMER_PAIR_MAX_COMPL_END_TH"))):
+        return None
+    pair = Primer3Pair(None)
+    for oligo in (left, right):
+        for name, val in oligo.items():
+            if name != "result_num":
+                pair[name] = val
+    pair.PRIMER_PAIR_PENALTY = (penalty +
+                                _split_pair_arg(global_args, "PRIMER_PAIR_WT_COMPL_ANY_TH") * compl_any +
+                                _split_pair_arg(global_args, "PRIMER_PAIR_WT_COMPL_END_TH") * compl_end)
+    pair.PRIMER_PAIR_COMPL_ANY_TH = compl_any
+    pair.PRIMER_PAIR_COMPL_END_TH = compl_end
+    pair.PRIMER_PAIR_PRODUCT_SIZE = product_size
+    return pair
+
+def _split_region_pairs(global_args, lefts, rights, num_return):
+    """rank combinations of left and right candidates, returning the best pairs
+    and number of combinations considered"""
+    if (len(lefts) == 0) or (len(rights) == 0):
+        return [], 0
+    product_size, diff_tm, penalty, ok = split_pair_metrics(*_side_arrays(lefts, "LEFT"), *_side_arrays(rights, "RIGHT"),
+                                                            global_args.PRIMER_PRODUCT_SIZE_RANGE, global_args)
+    left_idxs, right_idxs = np.nonzero(ok)
+    order = np.argsort(penalty[left_idxs, right_idxs], kind="stable")
+    # complementarity is only computed as needed, unless it is weighted and affects the ranking
+    compl_weighted = ((_split_pair_arg(global_args, "PRIMER_PAIR_WT_COMPL_ANY_TH") != 0) or
+                      (_split_pair_arg(global_args, "PRIMER_PAIR_WT_COMPL_END_TH") != 0))
+    pairs = []
+    for i in order:
+        li, ri = left_idxs[i], right_idxs[i]
+        pair = _split_make_pair(global_args, lefts[li], rights[ri], int(product_size[li, ri]), float(penalty[li, ri]))
+        if pair is not None:
+            pairs.append(pair)
+            if (len(pairs) >= num_return) and not compl_weighted:
+                break
+    return pairs, product_size.size
+
+def _number_tag(name, result_num):
+    "convert PRIMER_LEFT_TM to PRIMER_LEFT_0_TM"
+    for prefix in ("PRIMER_LEFT", "PRIMER_RIGHT", "PRIMER_PAIR"):
+        if (name == prefix) or name.startswith(prefix + "_"):
+            return prefix + f"_{result_num}" + name[len(prefix):]
+    raise PrimersJuJuError(f"unexpected primer3 tag: {name}")
+
+def _split_pairs_to_output(pairs, left_explain, right_explain, pair_explain):
+    "build a primer3 style output for the pairs"
+    p3_output = ObjDict(PRIMER_LEFT_EXPLAIN=left_explain,
+                        PRIMER_RIGHT_EXPLAIN=right_explain,
+                        PRIMER_PAIR_EXPLAIN=pair_explain,
+                        PRIMER_LEFT_NUM_RETURNED=len(pairs),
+                        PRIMER_RIGHT_NUM_RETURNED=len(pairs),
+                        PRIMER_INTERNAL_NUM_RETURNED=0,
+                        PRIMER_PAIR_NUM_RETURNED=len(pairs))
+    for result_num, pair in enumerate(pairs):
+        for name, val in pair.items():
+            if name != "result_num":
+                p3_output[_number_tag(name, result_num)] = val
+    return p3_output
+
+def _primer3_split_design(primer3_config, seq_args, global_args, deadline):
+    "pick left and right oligos independently in each OK region and pair them"
+    num_return = _split_pair_arg(global_args, "PRIMER_NUM_RETURN")
+    pairs = []
+    explains = {"LEFT": [], "RIGHT": []}
+    num_considered = 0
+    for ok_region in seq_args.SEQUENCE_PRIMER_PAIR_OK_REGION_LIST:
+        lefts, left_explain = _split_side_pick(primer3_config, seq_args, global_args, "LEFT", ok_region[0:2], deadline)
+        rights, right_explain = _split_side_pick(primer3_config, seq_args, global_args, "RIGHT", ok_region[2:4], deadline)
+        explains["LEFT"].append(left_explain)
+        explains["RIGHT"].append(right_explain)
+        region_pairs, region_considered = _split_region_pairs(global_args, lefts, rights, num_return)
+        pairs.extend(region_pairs)
+        num_considered += region_considered
+    pairs = sorted(pairs, key=lambda p: p.PRIMER_PAIR_PENALTY)[0:num_return]
+    return primer3_parse_output(_split_pairs_to_output(pairs, "; ".join(explains["LEFT"]), "; ".join(explains["RIGHT"]),
+                                                       f"considered {num_considered}, ok {len(pairs)}"))
+
 def primer3_dump_args(fh, primer3_config, target_transcript, *, global_args=None, seq_args=None):
     "print the arguments that will be used for this design"
     if global_args is None:
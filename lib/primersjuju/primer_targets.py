@@ -4,10 +4,11 @@ regions to match exons.
 """
 import sys
 from dataclasses import dataclass, KW_ONLY
+from functools import cached_property
 import pprint
 from pycbio.hgdata.coords import Coords
 from . import PrimersJuJuError, PrimersJuJuDataError
-from .transcript_features import IntronFeature, ExonFeature, Features, TranscriptId, Transcript
+from .transcript_features import IntronFeature, ExonFeature, Features, TranscriptId, Transcript, ExonIntervalIndex
 from .transcript_features import bed_to_features, features_intersect_genome, get_features_rna
 
 @dataclass
@@ -16,6 +17,7 @@ class TargetTranscript(Transcript):
     _: KW_ONLY
     features_5p: Features  # 5' on transcript
     features_3p: Features
+    rna_soft_masked: str = None  # rna with genome soft-masking
 
     @property
     def region_5p(self):
@@ -32,6 +34,11 @@ class TargetTranscript(Transcript):
         else:
             return self.features_3p, self.features_5p
 
+    @cached_property
+    def genome_ordered_exon_indexes(self):
+        "pair of ExonIntervalIndex objects of the features, with 5' genome first"
+        return tuple(ExonIntervalIndex(features) for features in self.get_genome_ordered_features())
+
     def _features_to_trans_coords(self, features):
         "get positive strand transcript coords in transcription order"
         if features[0].trans.strand == '+':
@@ -129,12 +136,13 @@ def _build_target_transcript(genome_data, primer_target_spec, trans_spec):
     "build transcript with initial regions trimmed to exons"
     trans_bed = genome_data.get_track(trans_spec.trans_track).read_by_name(trans_spec.trans_id)
     features = bed_to_features(genome_data, trans_bed)
-    rna = get_features_rna(genome_data, features)
+    rna_soft_masked = get_features_rna(genome_data, features, keep_mask=True)
     region_5p, region_3p = _get_regions_transcript_orient(trans_bed, primer_target_spec.region_5p,
                                                           primer_target_spec.region_3p)
     trans_id = TranscriptId(trans_spec.trans_track, trans_bed.name)
     return TargetTranscript(trans_id=trans_id,
-                            bed=trans_bed, features=features, rna=rna,
+                            bed=trans_bed, features=features, rna=rna_soft_masked.upper(),
+                            rna_soft_masked=rna_soft_masked,
                             features_5p=_build_region_transcript_features(trans_id, features, region_5p),
                             features_3p=_build_region_transcript_features(trans_id, features, region_3p))
 
@@ -1,17 +1,31 @@
 """
 Primer uniqueness query and results
 """
-
-from typing import Sequence
+import math
+import functools
+import threading
+from collections import defaultdict
+from concurrent.futures import Future
+from typing import Sequence, NamedTuple
 from dataclasses import dataclass
+import numpy as np
 from pycbio.ncbi.assembly import AssemblyReportNotFound
+from .primer_targets import TargetTranscript
+from .primer3_interface import Primer3Pair
 from .transcript_features import ExonFeature
-from .uniqueness_query import GenomeHit, TranscriptomeHit
+from .uniqueness_query import GenomeHit, TranscriptomeHit, PrimerPairQuery
+
+# maximum product sizes for isPcr queries, arbitrary
+GENOME_MAX_SIZE = 1_000_000
+TRANSCRIPTOME_MAX_SIZE = 500_000
 
 def _len_none(l):
     "0 if list is None, else length"
     return 0 if l is None else len(l)
 
+def _cnt_str(cnt, truncated):
+    return f"≥{cnt}" if truncated else str(cnt)
+
 @dataclass
 class PrimerUniqueness:
     "Results or querying a primer design for genome and transcriptone uniqueness."
@@ -25,6 +39,13 @@ class PrimerUniqueness:
     transcriptome_on_targets: Sequence[TranscriptomeHit]
     transcriptome_off_targets: Sequence[TranscriptomeHit]
     transcriptome_non_targets: Sequence[TranscriptomeHit]
+    # set if a streamed query was stopped after reaching the maximum number of
+    # off-targets, so the off-target count is a lower bound
+    genome_off_targets_truncated: bool = False
+    transcriptome_off_targets_truncated: bool = False
+    # uniqueness query tier that decided the result, 1 or 2, None if tiered
+    # queries are not configured
+    tier: int = None
 
     @property
     def genome_on_target_cnt(self):
@@ -50,10 +71,22 @@ class PrimerUniqueness:
     def transcriptome_non_target_cnt(self):
         return _len_none(self.transcriptome_non_targets)
 
+    @property
+    def genome_off_target_cnt_str(self):
+        "off-target count for reports, ≥N if truncated"
+        return _cnt_str(self.genome_off_target_cnt, self.genome_off_targets_truncated)
+
+    @property
+    def transcriptome_off_target_cnt_str(self):
+        "off-target count for reports, ≥N if truncated"
+        return _cnt_str(self.transcriptome_off_target_cnt, self.transcriptome_off_targets_truncated)
+
+@functools.lru_cache(maxsize=None)
 def _is_target_chrom(genome_data, chrom_name):
     """Should a chromosome be consider at target for off-target/on target
     check.  This excludes patches and alts.  For genomes without this information,
-    all sequences are conserved a target.
+    all sequences are conserved a target.  Memoized, as there are few distinct
+    chromosomes in hits.
     """
     if genome_data.assembly_info is None:
         # no information so consider this a possible target
@@ -66,77 +99,255 @@ def _is_target_chrom(genome_data, chrom_name):
     return ((chrom_info.sequenceRole == "assembled-molecule") and
             (chrom_info.assemblyUnit == "Primary Assembly"))
 
-def _check_gcoords_overlap(features, gcoordss):
-    for f in features.iter_type(ExonFeature):
-        for gcoords in gcoordss:
-            if f.genome.overlaps(gcoords):
-                return True
-    return False
+# hit classes
+_ON_TARGET = 0
+_OFF_TARGET = 1
+_NON_TARGET = 2
+
+def _target_chroms_mask(genome_data, chroms):
+    "boolean array of which chroms are targets, looking up each distinct name once"
+    names, inverse = np.unique(chroms, return_inverse=True)
+    is_target = np.array([_is_target_chrom(genome_data, name) for name in names], dtype=bool)
+    return is_target[inverse]
+
+def _hit_classes(target_mask, on_target_mask):
+    return np.where(target_mask, np.where(on_target_mask, _ON_TARGET, _OFF_TARGET), _NON_TARGET)
+
+def _gcoords_arrays(gcoords_list):
+    "pack Coords into chrom, start, and end arrays"
+    return (np.array([c.name for c in gcoords_list], dtype=object),
+            np.array([c.start for c in gcoords_list], dtype=np.int64),
+            np.array([c.end for c in gcoords_list], dtype=np.int64))
+
+def _genome_hits_classes(genome_data, target_transcript, hits):
+    """classify genome hits in bulk, returning an array of hit classes.
+    Genome hits will not span introns, but may partially align one
+    of the exons."""
+    index_first, index_last = target_transcript.genome_ordered_exon_indexes
+    left_arrays = _gcoords_arrays([hit.left_gcoords for hit in hits])
+    on_target_mask = (index_first.overlaps(*left_arrays) &
+                      index_last.overlaps(*_gcoords_arrays([hit.right_gcoords for hit in hits])))
+    return _hit_classes(_target_chroms_mask(genome_data, left_arrays[0]), on_target_mask)
+
+def _features_list_overlaps(index, features_list):
+    "boolean array of which Features in a list have an exon overlapping the index"
+    hit_idxs = []
+    gcoords_list = []
+    for i, features in enumerate(features_list):
+        for gcoords in features.genome_coords_type(ExonFeature):
+            hit_idxs.append(i)
+            gcoords_list.append(gcoords)
+    hit_idxs = np.array(hit_idxs, dtype=np.int64)
+    overlapping = index.overlaps(*_gcoords_arrays(gcoords_list))
+    return np.bincount(hit_idxs[overlapping], minlength=len(features_list)) > 0
+
+def _transcriptome_hits_classes(genome_data, target_transcript, hits):
+    """classify transcriptome hits in bulk, returning an array of hit classes"""
+    index_first, index_last = target_transcript.genome_ordered_exon_indexes
+    on_target_mask = (_features_list_overlaps(index_first, [hit.left_features for hit in hits]) &
+                      _features_list_overlaps(index_last, [hit.right_features for hit in hits]))
+    chroms = np.array([hit.left_features[0].genome.name for hit in hits], dtype=object)
+    return _hit_classes(_target_chroms_mask(genome_data, chroms), on_target_mask)
+
+class _HitClassifier:
+    """Classifies hits, either in bulk or as they are received.  It is used
+    as a hit sink for streamed queries, stopping the query at the first hit
+    received after max_off_targets off-target hits have been found, as the
+    status of the pair is then decided.  Only then is the result marked as
+    truncated, so exactly max_off_targets off-targets is not a lower bound."""
+    def __init__(self, hits_classes_func, genome_data, target_transcript, max_off_targets):
+        self.hits_classes_func = hits_classes_func
+        self.genome_data = genome_data
+        self.target_transcript = target_transcript
+        self.max_off_targets = max_off_targets
+        self.hits_by_class = {_ON_TARGET: [], _OFF_TARGET: [], _NON_TARGET: []}
+        self.truncated = False
+
+    def add_hits(self, hits):
+        "classify a list of hits, not checking max_off_targets"
+        if len(hits) > 0:
+            for hit, hit_class in zip(hits, self.hits_classes_func(self.genome_data, self.target_transcript, hits)):
+                self.hits_by_class[hit_class].append(hit)
+
+    def __call__(self, hit):
+        if (self.max_off_targets is not None) and (self.off_target_cnt >= self.max_off_targets):
+            self.truncated = True  # this and any further hits are not read
+            return False
+        self.add_hits([hit])
+        return True
+
+    @property
+    def off_target_cnt(self):
+        return len(self.hits_by_class[_OFF_TARGET])
 
-def _check_hit_overlap(target_transcript, left_gcoordss, right_gcoordss):
-    """check overlap based on list of genomic coordinates"""
+    @property
+    def classified(self):
+        return self.hits_by_class[_ON_TARGET], self.hits_by_class[_OFF_TARGET], self.hits_by_class[_NON_TARGET]
+
+class PrimerPairTarget(NamedTuple):
+    "a primer pair to query for uniqueness along with the transcript it targets"
+    target_transcript: TargetTranscript
+    ppair_id: str
+    primer3_pair: Primer3Pair
+
+def _pair_query(pair_target):
+    return PrimerPairQuery(pair_target.ppair_id, pair_target.primer3_pair.PRIMER_LEFT_SEQUENCE,
+                           pair_target.primer3_pair.PRIMER_RIGHT_SEQUENCE)
+
+class _UniquenessSide(NamedTuple):
+    "spec and query functions for either genome or transcriptome uniqueness"
+    spec: object
+    default_max_size: int
+    hits_classes_func: object
+    submit_stream: object
+    submit_batch: object
+
+def _get_uniqueness_sides(uniqueness_query):
+    return (_UniquenessSide(uniqueness_query.genome_spec, GENOME_MAX_SIZE, _genome_hits_classes,
+                            uniqueness_query.submit_genome_stream, uniqueness_query.submit_genome_batch),
+            _UniquenessSide(uniqueness_query.transcriptome_spec, TRANSCRIPTOME_MAX_SIZE, _transcriptome_hits_classes,
+                            uniqueness_query.submit_transcriptome_stream, uniqueness_query.submit_transcriptome_batch))
+
+def _is_tiered(side):
+    return (side.spec is not None) and (side.spec.first_tier_size_factor is not None)
+
+def _target_amplicon_span(target_transcript):
+    """genomic length spanned by the target regions, which is the longest
+    possible on-target amplicon in the genome or transcriptome"""
     features_first, features_last = target_transcript.get_genome_ordered_features()
-    return (_check_gcoords_overlap(features_first, left_gcoordss) and
-            _check_gcoords_overlap(features_last, right_gcoordss))
-
-def _check_genome_hit_overlap(target_transcript, hit):
-    """does a genome uniqueness hit correspond to the target regions"""
-    # Genome hits will not span introns, but may partially align one
-    # of the exons
-    return _check_hit_overlap(target_transcript, [hit.left_gcoords], [hit.right_gcoords])
-
-def _genome_uniqueness_classify(genome_data, target_transcript, hits):
-    on_targets = []
-    off_targets = []
-    non_targets = []
-    for hit in hits:
-        if not _is_target_chrom(genome_data, hit.left_gcoords.name):
-            non_targets.append(hit)
-        elif _check_genome_hit_overlap(target_transcript, hit):
-            on_targets.append(hit)
-        else:
-            off_targets.append(hit)
-    return on_targets, off_targets, non_targets
-
-def _genome_uniqueness_query(uniqueness_query, target_transcript, ppair_id, primer3_pair):
-    """guery to find genomic on and off target hits via an alignment method"""
-    max_size = 1_000_000  # arbitrary
-    hits = uniqueness_query.query_genome(ppair_id, primer3_pair.PRIMER_LEFT_SEQUENCE, primer3_pair.PRIMER_RIGHT_SEQUENCE, max_size)
-    return _genome_uniqueness_classify(uniqueness_query.genome_data, target_transcript, hits)
-
-def _check_transcriptome_hit_overlap(target_transcript, hit):
-    """does a transcriptome uniqueness hit correspond to the target regions"""
-    return _check_hit_overlap(target_transcript,
-                              hit.left_features.genome_coords_type(ExonFeature),
-                              hit.right_features.genome_coords_type(ExonFeature))
-
-def _transcriptome_uniqueness_classify(genome_data, target_transcript, hits):
-    on_targets = []
-    off_targets = []
-    non_targets = []
-    for hit in hits:
-        if not _is_target_chrom(genome_data, hit.left_features[0].genome.name):
-            non_targets.append(hit)
-        elif _check_transcriptome_hit_overlap(target_transcript, hit):
-            on_targets.append(hit)
+    return features_last.bounds.genome.end - features_first.bounds.genome.start
+
+def _tier_max_sizes(side, target_transcript):
+    "max_size for the first and second tier queries, which are the same if not tiered"
+    max_size = side.default_max_size
+    if (side.spec is not None) and (side.spec.max_size is not None):
+        max_size = side.spec.max_size
+    if not _is_tiered(side):
+        return max_size, max_size
+    return min(max_size, math.ceil(side.spec.first_tier_size_factor * _target_amplicon_span(target_transcript))), max_size
+
+class _UniquenessSideQuery:
+    """Concurrent genome or transcriptome queries for a list of PrimerPairTarget,
+    each with its own max_size.  If uniqueness_query.max_off_targets is set,
+    each pair is a streamed query, otherwise pairs with the same max_size are
+    run as a batch."""
+    def __init__(self, uniqueness_query, side, pair_targets, max_sizes):
+        self.pair_targets = pair_targets
+        self.classifiers = [_HitClassifier(side.hits_classes_func, uniqueness_query.genome_data,
+                                           pt.target_transcript, uniqueness_query.max_off_targets)
+                            for pt in pair_targets]
+        self.stream_futures = []
+        self.batch_futures = []
+        if uniqueness_query.max_off_targets is not None:
+            self.stream_futures = [side.submit_stream(*_pair_query(pt), max_size, classifier)
+                                   for pt, max_size, classifier in zip(pair_targets, max_sizes, self.classifiers)]
         else:
-            off_targets.append(hit)
-    return on_targets, off_targets, non_targets
+            by_max_size = defaultdict(list)
+            for i, max_size in enumerate(max_sizes):
+                by_max_size[max_size].append(i)
+            self.batch_futures = [(idxs, side.submit_batch([_pair_query(pair_targets[i]) for i in idxs], max_size))
+                                  for max_size, idxs in by_max_size.items()]
 
-def _transcriptome_uniqueness_query(uniqueness_query, target_transcript, ppair_id, primer3_pair):
-    """guery to find transcriptome on and off target hits via an alignment method"""
-    max_size = 500_000  # arbitrary
-    hits = uniqueness_query.query_transcriptome(ppair_id, primer3_pair.PRIMER_LEFT_SEQUENCE, primer3_pair.PRIMER_RIGHT_SEQUENCE, max_size)
-    return _transcriptome_uniqueness_classify(uniqueness_query.genome_data, target_transcript, hits)
+    def result(self) -> Sequence[_HitClassifier]:
+        for future in self.stream_futures:
+            future.result()
+        for idxs, future in self.batch_futures:
+            hits_by_name = future.result()
+            for i in idxs:
+                self.classifiers[i].add_hits(hits_by_name[self.pair_targets[i].ppair_id])
+        return self.classifiers
 
-def primer_uniqueness_query(uniqueness_query, target_transcript, ppair_id, primer3_pair):
-    "Run genome and transcriptome queries and collate results"
-    genome_on_targets, genome_off_targets, genome_non_targets = _genome_uniqueness_query(uniqueness_query, target_transcript, ppair_id, primer3_pair)
-    transcriptome_on_targets, transcriptome_off_targets, transcriptome_non_targets = _transcriptome_uniqueness_query(uniqueness_query, target_transcript, ppair_id, primer3_pair)
+def _second_tier_query(uniqueness_query, sides, pair_targets, side_tier_sizes, side_results, tiers):
+    """rerun queries with the second tier max_size for pairs without
+    off-targets in the first tier, for sides where it is larger"""
+    passed = [i for i in range(len(pair_targets))
+              if all(results[i].off_target_cnt == 0 for results in side_results)]
+    side_queries = []
+    for side, tier_sizes in zip(sides, side_tier_sizes):
+        rerun = [i for i in passed if tier_sizes[i][1] > tier_sizes[i][0]]
+        side_queries.append((rerun, _UniquenessSideQuery(uniqueness_query, side, [pair_targets[i] for i in rerun],
+                                                         [tier_sizes[i][1] for i in rerun])))
+    for results, (rerun, side_query) in zip(side_results, side_queries):
+        for i, classifier in zip(rerun, side_query.result()):
+            results[i] = classifier
+            tiers[i] = 2
+
+def primer_uniqueness_query_batch(uniqueness_query, pair_targets) -> Sequence[PrimerUniqueness]:
+    """Run genome and transcriptome queries for a list of PrimerPairTarget,
+    which maybe from multiple targets, with the pairs split between up to
+    max_in_flight concurrent gfPcr runs per server.
+    The ppair_ids must be unique.  Returns PrimerUniqueness objects in the same
+    order as pair_targets.
 
-    return PrimerUniqueness(genome_on_targets, genome_off_targets, genome_non_targets,
-                            transcriptome_on_targets, transcriptome_off_targets, transcriptome_non_targets)
+    If uniqueness_query.max_off_targets is set, each pair is run as a
+    concurrent streamed query instead of in batches.  If either spec has
+    first_tier_size_factor set, the pairs that have no off-targets with the
+    first tier product size are queried again with the second tier size."""
+    sides = _get_uniqueness_sides(uniqueness_query)
+    side_tier_sizes = [[_tier_max_sizes(side, pt.target_transcript) for pt in pair_targets]
+                       for side in sides]
+    side_queries = [_UniquenessSideQuery(uniqueness_query, side, pair_targets, [sizes[0] for sizes in tier_sizes])
+                    for side, tier_sizes in zip(sides, side_tier_sizes)]
+    genome_results, transcriptome_results = [side_query.result() for side_query in side_queries]
+    tiers = len(pair_targets) * [None]
+    if any(_is_tiered(side) for side in sides):
+        tiers = len(pair_targets) * [1]
+        _second_tier_query(uniqueness_query, sides, pair_targets, side_tier_sizes,
+                           [genome_results, transcriptome_results], tiers)
+    return [PrimerUniqueness(*genome_result.classified, *transcriptome_result.classified,
+                             genome_off_targets_truncated=genome_result.truncated,
+                             transcriptome_off_targets_truncated=transcriptome_result.truncated,
+                             tier=tier)
+            for genome_result, transcriptome_result, tier in zip(genome_results, transcriptome_results, tiers)]
+
+def primer_uniqueness_query(uniqueness_query, target_transcript, ppair_id, primer3_pair):
+    """Run genome and transcriptome queries concurrently and collate results,
+    see primer_uniqueness_query_batch"""
+    return primer_uniqueness_query_batch(uniqueness_query, [PrimerPairTarget(target_transcript, ppair_id, primer3_pair)])[0]
 
 def primer_uniqueness_none():
     "When uniqueness_query is not available"
     return PrimerUniqueness(None, None, None, None, None, None)
+
+class PrimerUniquenessCache:
+    """Thread-safe memo of primer uniqueness query results, so that identical
+    primer pairs for the same target transcript are only queried once, such as
+    when designing with multiple primer3 configurations.  Concurrent requests
+    for the same pair wait on the first query.  Failed queries are not cached."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._results = {}  # (trans_id, left_seq, right_seq) -> Future
+
+    @staticmethod
+    def _key(pair_target):
+        return (pair_target.target_transcript.trans_id,
+                pair_target.primer3_pair.PRIMER_LEFT_SEQUENCE, pair_target.primer3_pair.PRIMER_RIGHT_SEQUENCE)
+
+    def query_batch(self, uniqueness_query, pair_targets) -> Sequence[PrimerUniqueness]:
+        """query PrimerPairTarget objects that are not already cached as one batch"""
+        futures = []
+        to_query = {}
+        with self._lock:
+            for pair_target in pair_targets:
+                key = self._key(pair_target)
+                future = self._results.get(key)
+                if future is None:
+                    future = self._results[key] = Future()
+                    to_query[key] = (pair_target, future)
+                futures.append(future)
+        if len(to_query) > 0:
+            try:
+                uniquenesses = primer_uniqueness_query_batch(uniqueness_query, [pt for pt, _ in to_query.values()])
+                for (_, future), uniqueness in zip(to_query.values(), uniquenesses):
+                    future.set_result(uniqueness)
+            except Exception as ex:
+                # don't keep failures, so later requests query again
+                with self._lock:
+                    for key in to_query.keys():
+                        del self._results[key]
+                for _, future in to_query.values():
+                    future.set_exception(ex)
+        return [future.result() for future in futures]
+
+    def query(self, uniqueness_query, target_transcript, ppair_id, primer3_pair):
+        return self.query_batch(uniqueness_query, [PrimerPairTarget(target_transcript, ppair_id, primer3_pair)])[0]
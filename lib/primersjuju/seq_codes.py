@@ -0,0 +1,56 @@
+"""
+DNA sequences encoded as numpy arrays of codes, ACGT=0..3 and other bases
+NON_ACGT, and reading of encoded sequences from 2bit files.  These are shared
+by the k-mer indexes.
+"""
+import os
+import numpy as np
+from twobitreader import TwoBitFile
+
+NON_ACGT = 4
+_code_table = np.full(256, NON_ACGT, dtype=np.uint8)
+for _i, _base in enumerate(b"ACGT"):
+    _code_table[_base] = _i
+    _code_table[ord(chr(_base).lower())] = _i
+_decode_table = np.frombuffer(b"ACGTN", dtype=np.uint8)
+_complement_codes = np.array([3, 2, 1, 0, NON_ACGT], dtype=np.uint8)
+
+def encode_seq(seq):
+    "encode a DNA string as numpy codes"
+    return _code_table[np.frombuffer(seq.encode(), dtype=np.uint8)]
+
+def decode_seq(codes):
+    return _decode_table[codes].tobytes().decode()
+
+def complement_codes(codes):
+    "complement an array of codes of any shape"
+    return _complement_codes[codes]
+
+def reverse_complement_codes(codes):
+    return _complement_codes[codes[::-1]]
+
+def kmer_codes(codes, kmer_size):
+    """compute k-mer values for each position in an encoded sequence, with -1 for
+    k-mers that contain non-ACGT bases or run off the end"""
+    num = len(codes) - kmer_size + 1
+    kmers = np.full(len(codes), -1, dtype=np.int32)
+    if num <= 0:
+        return kmers
+    vals = np.zeros(num, dtype=np.int32)
+    for j in range(kmer_size):
+        vals = (vals << 2) | (codes[j:j + num] & 3)
+    bad = np.concatenate(([0], np.cumsum(codes == NON_ACGT)))
+    vals[(bad[kmer_size:kmer_size + num] - bad[:num]) > 0] = -1
+    kmers[:num] = vals
+    return kmers
+
+def twobit_stamp(twobit):
+    "size and modification time of a 2bit, used to detect that an index is out of date"
+    st = os.stat(twobit)
+    return {"size": st.st_size, "mtime": st.st_mtime}
+
+def read_twobit_seqs(twobit_file):
+    "generate (name, codes) for the sequences in a 2bit, in name order"
+    twobit = TwoBitFile(twobit_file)
+    for seq_name in sorted(twobit.sequence_sizes().keys()):
+        yield seq_name, encode_seq(str(twobit[seq_name]))
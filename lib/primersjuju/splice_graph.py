@@ -0,0 +1,111 @@
+"""
+Splice graph of the isoforms at a locus, for answering which isoforms contain
+an exon segment or splice junction without intersecting the features of each
+transcript.
+
+Nodes are the exon segments between consecutive exon boundaries of any isoform
+and edges are the splice junctions.  Each node and edge has a bitset of the
+isoforms that include it, stored as rows of uint64 words, so the isoforms
+compatible with a multi-block feature list are found with bitset ANDs.
+"""
+import numpy as np
+from .transcript_features import ExonFeature
+
+_WORD_BITS = 64
+
+def _set_bits(num_rows, num_words, rows, trans_idxs):
+    "build bitset rows with the bits for trans_idxs set in rows"
+    bits = np.zeros((num_rows, num_words), dtype=np.uint64)
+    np.bitwise_or.at(bits, (rows, trans_idxs // _WORD_BITS),
+                     np.left_shift(np.uint64(1), (trans_idxs % _WORD_BITS).astype(np.uint64)))
+    return bits
+
+class SpliceGraph:
+    """Splice graph built from a list of Transcript objects on the same
+    chromosome and strand.  Isoforms are identified by their index in the
+    transcripts list."""
+    def __init__(self, transcripts):
+        self.transcripts = transcripts
+        self.num_words = max(1, (len(transcripts) + _WORD_BITS - 1) // _WORD_BITS)
+        exons = [(trans_idx, feat.genome.start, feat.genome.end)
+                 for trans_idx, transcript in enumerate(transcripts)
+                 for feat in transcript.features if isinstance(feat, ExonFeature)]
+        exon_trans_idxs = np.array([e[0] for e in exons], dtype=np.int64)
+        exon_starts = np.array([e[1] for e in exons], dtype=np.int64)
+        exon_ends = np.array([e[2] for e in exons], dtype=np.int64)
+        self._build_nodes(exon_trans_idxs, exon_starts, exon_ends)
+        self._build_edges(exon_trans_idxs, exon_starts, exon_ends)
+
+    def _build_nodes(self, exon_trans_idxs, exon_starts, exon_ends):
+        "exon segments between all exon boundaries that are covered by an exon"
+        breaks = np.unique(np.concatenate((exon_starts, exon_ends)))
+        firsts = np.searchsorted(breaks, exon_starts)
+        cnts = np.searchsorted(breaks, exon_ends) - firsts
+        offsets = np.arange(cnts.sum()) - np.repeat(np.cumsum(cnts) - cnts, cnts)
+        seg_idxs = np.repeat(firsts, cnts) + offsets
+        bits = _set_bits(max(len(breaks) - 1, 0), self.num_words, seg_idxs, np.repeat(exon_trans_idxs, cnts))
+        covered = bits.any(axis=1)
+        self.node_starts = breaks[:-1][covered]
+        self.node_ends = breaks[1:][covered]
+        self.node_bits = bits[covered]
+
+    def _build_edges(self, exon_trans_idxs, exon_starts, exon_ends):
+        "splice junctions between consecutive exons of each isoform, sorted by donor and acceptor"
+        same_trans = exon_trans_idxs[1:] == exon_trans_idxs[:-1]
+        donors = exon_ends[:-1][same_trans]
+        acceptors = exon_starts[1:][same_trans]
+        juncs, junc_idxs = np.unique(np.stack([donors, acceptors], axis=1), axis=0, return_inverse=True)
+        self.junc_donors = juncs[:, 0]
+        self.junc_acceptors = juncs[:, 1]
+        self.junc_bits = _set_bits(len(juncs), self.num_words, junc_idxs.reshape(-1), exon_trans_idxs[1:][same_trans])
+
+    def empty_bits(self):
+        return np.zeros(self.num_words, dtype=np.uint64)
+
+    def all_bits(self):
+        return _set_bits(1, self.num_words, np.zeros(len(self.transcripts), dtype=np.int64),
+                         np.arange(len(self.transcripts)))[0]
+
+    def segment_bits(self, start, end):
+        "bitset of isoforms with an exon containing the genomic range"
+        first = np.searchsorted(self.node_ends, start, side='right')
+        last = np.searchsorted(self.node_starts, end, side='left')
+        if ((first >= last) or (self.node_starts[first] > start) or (self.node_ends[last - 1] < end)
+                or np.any(self.node_starts[first + 1:last] != self.node_ends[first:last - 1])):
+            return self.empty_bits()
+        return np.bitwise_and.reduce(self.node_bits[first:last], axis=0)
+
+    def junction_bits(self, donor, acceptor):
+        """bitset of isoforms with a splice junction from the exon ending at
+        donor to the exon starting at acceptor, in genomic order"""
+        lo = np.searchsorted(self.junc_donors, donor, side='left')
+        hi = np.searchsorted(self.junc_donors, donor, side='right')
+        idx = lo + np.searchsorted(self.junc_acceptors[lo:hi], acceptor)
+        if (idx >= hi) or (self.junc_acceptors[idx] != acceptor):
+            return self.empty_bits()
+        return self.junc_bits[idx]
+
+    def features_bits(self, features):
+        """bitset of isoforms that contain all of the exon features, such as
+        a junction-spanning primer, with consecutive features joined by a
+        splice junction"""
+        blocks = sorted((f.genome.start, f.genome.end) for f in features if isinstance(f, ExonFeature))
+        bits = self.all_bits()
+        for i, (start, end) in enumerate(blocks):
+            bits &= self.segment_bits(start, end)
+            if i > 0:
+                bits &= self.junction_bits(blocks[i - 1][1], start)
+        return bits
+
+    def bits_trans_idxs(self, bits):
+        "indexes of isoforms in a bitset"
+        flags = (bits[:, None] >> np.arange(_WORD_BITS, dtype=np.uint64)) & np.uint64(1)
+        return np.nonzero(flags.reshape(-1)[:len(self.transcripts)])[0]
+
+    def bits_transcripts(self, bits):
+        "isoforms in a bitset"
+        return [self.transcripts[i] for i in self.bits_trans_idxs(bits)]
+
+    def features_transcripts(self, features):
+        "isoforms that contain all of the exon features"
+        return self.bits_transcripts(self.features_bits(features))
@@ -0,0 +1,52 @@
+"""
+Design primers for the same targets with multiple named primer3
+configurations, for comparing parameter choices.
+"""
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from .primer_targets import PrimerTargets
+from .design_primers import PrimerDesigns, design_primers
+from .primer_uniqueness import PrimerUniquenessCache
+
+@dataclass
+class SweepResult:
+    """results of designing one target with one primer3 variant; error is
+    set if the design failed"""
+    primer_targets: PrimerTargets
+    variant: str
+    primer_designs: PrimerDesigns = None
+    error: Exception = None
+
+    @property
+    def target_id(self):
+        return self.primer_targets.target_id
+
+def _sweep_design_one(primer3_config, primer_targets, variant, uniqueness_query, uniqueness_cache, kmer_freq_filter,
+                      variant_store):
+    try:
+        primer_designs = design_primers(primer3_config, primer_targets, uniqueness_query=uniqueness_query,
+                                        uniqueness_cache=uniqueness_cache, kmer_freq_filter=kmer_freq_filter,
+                                        variant_store=variant_store)
+        return SweepResult(primer_targets, variant, primer_designs)
+    except Exception as ex:
+        # any failure only loses this target and variant, not the whole sweep
+        return SweepResult(primer_targets, variant, error=ex)
+
+def sweep_design(primer3_variants, primer_targets_list, *, uniqueness_query=None, max_workers=None,
+                 kmer_freq_filter=None, variant_store=None):
+    """Design each PrimerTargets in primer_targets_list with each of the
+    Primer3Config objects in the primer3_variants dict, keyed by variant
+    name.  Designs are run in parallel and uniqueness query results are shared
+    for identical primer pairs.  Returns a list of SweepResult, ordered by
+    target and then variant, with the error set for designs that failed.
+
+    As primer3 keeps global state, in-process primer3 runs are serialized and
+    only the uniqueness queries run in parallel.  Variants with a time_budget
+    run primer3 in worker processes, which do run in parallel."""
+    uniqueness_cache = PrimerUniquenessCache()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_sweep_design_one, primer3_config, primer_targets, variant,
+                                   uniqueness_query, uniqueness_cache, kmer_freq_filter, variant_store)
+                   for primer_targets in primer_targets_list
+                   for variant, primer3_config in primer3_variants.items()]
+        return [f.result() for f in futures]
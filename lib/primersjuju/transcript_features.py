@@ -6,6 +6,7 @@ import sys
 from dataclasses import dataclass, KW_ONLY
 import pprint
 from collections import namedtuple
+import numpy as np
 from pycbio.hgdata.coords import Coords
 from pycbio.hgdata.bed import Bed
 from . import PrimersJuJuError
@@ -139,6 +140,30 @@ class Features(list):
                 intersect_feats.append(f)
         return intersect_feats
 
+class ExonIntervalIndex:
+    """Merged genomic intervals of the exons in a Features object, for
+    vectorized overlap tests of arrays of ranges"""
+    def __init__(self, features):
+        self.chrom = features[0].genome.name
+        intervals = []
+        for start, end in sorted([(f.genome.start, f.genome.end) for f in features.iter_type(ExonFeature)]):
+            if (len(intervals) > 0) and (start <= intervals[-1][1]):
+                intervals[-1][1] = max(intervals[-1][1], end)
+            else:
+                intervals.append([start, end])
+        self.starts = np.array([i[0] for i in intervals], dtype=np.int64)
+        self.ends = np.array([i[1] for i in intervals], dtype=np.int64)
+
+    def overlaps(self, chroms, starts, ends):
+        """boolean array indicating which of the ranges, given as arrays, overlap
+        an exon"""
+        # first interval ending after each range start is the only candidate
+        idxs = np.searchsorted(self.ends, starts, side='right')
+        in_bounds = idxs < len(self.ends)
+        overlapping = np.zeros(len(starts), dtype=bool)
+        overlapping[in_bounds] = self.starts[idxs[in_bounds]] < ends[in_bounds]
+        return overlapping & (chroms == self.chrom)
+
 class TranscriptId(namedtuple("TranscriptId", ("track", "name"))):
     "uniquely identifies a transcript by track and name"
     __slots__ = ()
@@ -250,11 +275,13 @@ def features_intersect_genome(features, region) -> Features:
     features_contig_assert(subfeatures)
     return subfeatures
 
-def get_features_rna(genome_data, features):
+def get_features_rna(genome_data, features, *, keep_mask=False):
+    """get the RNA sequence of the features, keeping soft-masking if keep_mask
+    is specified"""
     exon_seqs = []
     for feat in features:
         if isinstance(feat, ExonFeature):
-            exon_seqs.append(genome_data.get_genome_seq(feat.genome, strand=feat.trans.strand))
+            exon_seqs.append(genome_data.get_genome_seq(feat.genome, strand=feat.trans.strand, keep_mask=keep_mask))
     if features[0].trans.strand == '-':
         exon_seqs = reversed(exon_seqs)
     return "".join(exon_seqs)
@@ -0,0 +1,105 @@
+"""
+Persistent cache of isPcr query results, stored in an SQLite database.
+
+Raw PSLs are stored, keyed by server, primer sequences, and max_size, so
+classification against a target transcript is always recomputed.  Servers are
+identified by the sequences they query rather than host and port, so replicas
+share results.  Each server has a stamp, derived from its sequence files, and
+results with a different stamp are discarded.  The number of entries is limited, with the least
+recently used entries removed first.
+"""
+import time
+import sqlite3
+import threading
+from typing import Sequence
+from pycbio.hgdata.psl import Psl
+
+_schema = """
+CREATE TABLE IF NOT EXISTS pcr_results (
+    server TEXT NOT NULL,
+    server_stamp TEXT NOT NULL,
+    left_primer TEXT NOT NULL,
+    right_primer TEXT NOT NULL,
+    max_size INTEGER NOT NULL,
+    psls TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (server, left_primer, right_primer, max_size));
+CREATE INDEX IF NOT EXISTS pcr_results_last_used ON pcr_results (last_used);
+"""
+
+_PSL_QNAME_COL = 9
+
+def _rows_to_text(rows):
+    return "\n".join(["\t".join([str(c) for c in row]) for row in rows])
+
+def _text_to_psls(text, name):
+    psls = []
+    for line in text.split("\n") if len(text) > 0 else []:
+        row = line.split("\t")
+        row[_PSL_QNAME_COL] = name
+        psls.append(Psl.fromRow(row))
+    return psls
+
+class PcrResultCache:
+    """SQLite cache of PSLs returned by isPcr queries.  Thread-safe; the
+    database maybe shared by multiple processes."""
+    def __init__(self, db_file, *, max_entries=1_000_000, trim_fraction=0.1):
+        self.db_file = db_file
+        self.max_entries = max_entries
+        self.trim_fraction = trim_fraction
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_schema)
+        self._puts_since_trim = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def invalidate_server(self, server, server_stamp):
+        "remove results for server that have a different stamp"
+        with self._lock:
+            self._conn.execute("DELETE FROM pcr_results WHERE server = ? AND server_stamp != ?",
+                               (server, server_stamp))
+
+    def get(self, server, server_stamp, name, left_primer, right_primer, max_size) -> Sequence[Psl]:
+        """get cached PSLs, with the query name set to name, or None if not cached"""
+        key = (server, left_primer, right_primer, max_size)
+        with self._lock:
+            row = self._conn.execute("SELECT server_stamp, psls FROM pcr_results "
+                                     "WHERE server = ? AND left_primer = ? AND right_primer = ? AND max_size = ?",
+                                     key).fetchone()
+            if (row is None) or (row[0] != server_stamp):
+                return None
+            self._conn.execute("UPDATE pcr_results SET last_used = ? "
+                               "WHERE server = ? AND left_primer = ? AND right_primer = ? AND max_size = ?",
+                               (time.time(),) + key)
+        return _text_to_psls(row[1], name)
+
+    def put(self, server, server_stamp, left_primer, right_primer, max_size, psls):
+        self.put_rows(server, server_stamp, left_primer, right_primer, max_size,
+                      [psl.toRow() for psl in psls])
+
+    def put_rows(self, server, server_stamp, left_primer, right_primer, max_size, rows):
+        "cache PSLs that are in the form of rows of columns"
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO pcr_results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (server, server_stamp, left_primer, right_primer, max_size,
+                                _rows_to_text(rows), time.time()))
+            self._puts_since_trim += 1
+            if self._puts_since_trim >= max(1, int(self.max_entries * self.trim_fraction)):
+                self._trim()
+
+    def _trim(self):
+        "remove least recently used entries over the limit, called with lock held"
+        self._puts_since_trim = 0
+        cnt = self._conn.execute("SELECT COUNT(*) FROM pcr_results").fetchone()[0]
+        if cnt > self.max_entries:
+            self._conn.execute("DELETE FROM pcr_results WHERE rowid IN "
+                               "(SELECT rowid FROM pcr_results ORDER BY last_used LIMIT ?)",
+                               (cnt - self.max_entries,))
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM pcr_results").fetchone()[0]
@@ -1,16 +1,31 @@
 """
 Query for uniqueness in genome and transcriptome
 """
-from typing import Sequence
+import os
+import copy
+import glob
+import time
+import functools
+import socket
+import tempfile
+import threading
+import subprocess
+from contextlib import closing
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Sequence, NamedTuple
 from dataclasses import dataclass, KW_ONLY
 
 import pipettor
+from twobitreader import TwoBitFile
 from pycbio.hgdata.psl import Psl, PslReader
 from pycbio.hgdata.coords import Coords
+from pycbio.hgdata import dnaOps
 
-from .genome_data import bigbed_read_by_name, bigbed_fetch_by_name
+from .genome_data import bigbed_fetch_by_names
 from .transcript_features import Features, bed_to_features, transcript_range_to_features
-from . import PrimersJuJuError
+from .kmer_pcr import LocalPcrSpec, KmerPcrIndex
+from . import PrimersJuJuError, PrimersJuJuDataError
 
 def _coords_range(coords_list):
     "convert a list of coordinates to the range that it spans"
@@ -23,7 +38,12 @@ class IsPcrServerSpec:
     """Specification of an isPCR server, static or dynamic;
     for genome or transcriptome.  Transcriptome BED either use
     UCSSC isPcr server convention of <trans_id>__<gene_name> or
-    just gene_id, both are tried."""
+    just gene_id, both are tried.
+
+    If first_tier_size_factor is set, uniqueness queries are done in two tiers.
+    The first tier limits products to the factor times the genomic span of the
+    target regions, and the second, with max_size, is only run for primer
+    pairs that have no off-targets in the first tier."""
     host: str
     port: str
     target_seq_dir: str  # contains 2bit matching one returned by server
@@ -31,13 +51,55 @@ class IsPcrServerSpec:
     dyn_name: str = None  # target or transcriptome name for dynamic server
     dyn_data_dir: str = None   # dynamic blat data dir
     trans_bigbed: str = None  # big bed file/URL for transcriptome
+    trans_cache_size: int = 10_000  # number of transcripts to memoize features, for transcriptome
+    max_in_flight: int = 4  # maximum concurrent gfPcr queries to this server
+    client: str = "gfPcr"  # gfPcr to run program, native to use the in-process client
+    max_size: int = None  # maximum product size, None for the genome or transcriptome default
+    first_tier_size_factor: float = None  # if set, first query with this factor times the target's amplicon span
+
+class PcrAlignmentBlock(NamedTuple):
+    "target range of one block of a PcrAlignment"
+    tStart: int
+    tEnd: int
+
+class PcrAlignment(NamedTuple):
+    """The fields of an isPcr PSL that are needed to build hits, parsed from a
+    PSL row without creating a Psl object.  Used by streamed queries."""
+    qName: str
+    tName: str
+    tSize: int
+    tStrand: str
+    blocks: tuple[PcrAlignmentBlock, ...]
+
+# PSL columns used by parse_pcr_alignment
+_PSL_STRAND_COL = 8
+_PSL_QNAME_COL = 9
+_PSL_TNAME_COL = 13
+_PSL_TSIZE_COL = 14
+_PSL_BLOCK_SIZES_COL = 18
+_PSL_TSTARTS_COL = 20
+
+def _parse_int_list(col):
+    return [int(v) for v in col.rstrip(',').split(',')] if len(col) > 0 else []
+
+def parse_pcr_alignment(row) -> PcrAlignment:
+    """parse the needed fields of a PSL row, as a list of strings"""
+    strand = row[_PSL_STRAND_COL]
+    blocks = tuple(PcrAlignmentBlock(t_start, t_start + size)
+                   for t_start, size in zip(_parse_int_list(row[_PSL_TSTARTS_COL]),
+                                            _parse_int_list(row[_PSL_BLOCK_SIZES_COL])))
+    return PcrAlignment(row[_PSL_QNAME_COL], row[_PSL_TNAME_COL], int(row[_PSL_TSIZE_COL]),
+                        strand[1] if len(strand) > 1 else '+', blocks)
+
+def _psl_to_row(psl):
+    return [str(c) for c in psl.toRow()]
 
 @dataclass
 class GenomeHit:
     "one isPcr hit to the genome, in positive genomic coords and order"
     left_gcoords: Coords
     right_gcoords: Coords
-    alignment: Psl
+    alignment: Psl | PcrAlignment  # PcrAlignment if streamed
 
     def __str__(self):
         return f"{self.__class__.__name__}(left={str(self.left_gcoords)},right={str(self.right_gcoords)})"
@@ -54,7 +116,7 @@ class TranscriptomeHit:
     gene_name: str
     left_features: Features
     right_features: Features
-    alignment: Psl
+    alignment: Psl | PcrAlignment  # PcrAlignment if streamed
 
     def __str__(self):
         def _lfmt(l):
@@ -65,17 +127,259 @@ class TranscriptomeHit:
         """get the range covering both  """
         return _coords_range([self.left_features.bounds.genome, self.right_features.bounds.genome])
 
-def _gfPcr(spec, name, left_primer, right_primer, max_size):
-    "returns PSL records"
-    cmd = ["gfPcr", f"-maxSize={max_size}", "-out=psl", f"-name={name}"]
+class PrimerPairQuery(NamedTuple):
+    "one primer pair for a batch query, the name must be unique in the batch"
+    name: str
+    left_primer: str
+    right_primer: str
+
+def _gfPcr_cmd(spec, max_size, *, name=None):
+    cmd = ["gfPcr", f"-maxSize={max_size}", "-out=psl"]
+    if name is not None:
+        cmd.append(f"-name={name}")
     if spec.dyn_name is not None:
         cmd.append(f"-genome={spec.dyn_name}")
     if spec.dyn_data_dir is not None:
-        cmd.extend(f"-genomeDataDir={spec.dyn_data_dir}")
-    cmd.extend([spec.host, spec.port, spec.target_seq_dir, left_primer, right_primer, "/dev/stdout"])
+        cmd.append(f"-genomeDataDir={spec.dyn_data_dir}")
+    return cmd + [spec.host, spec.port, spec.target_seq_dir]
+
+def _gfPcr(spec, name, left_primer, right_primer, max_size):
+    "returns PSL records"
+    cmd = _gfPcr_cmd(spec, max_size, name=name) + [left_primer, right_primer, "/dev/stdout"]
     with pipettor.Popen(cmd) as fh:
         return [p for p in PslReader(fh)]
 
+def _gfPcr_stream(spec, name, left_primer, right_primer, max_size):
+    """generator of PSL rows, as lists of strings, as gfPcr outputs them.  If
+    the generator is closed before all rows are read, gfPcr is killed."""
+    cmd = _gfPcr_cmd(spec, max_size, name=name) + [left_primer, right_primer, "/dev/stdout"]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    completed = False
+    try:
+        for line in proc.stdout:
+            row = line.rstrip('\n').split('\t')
+            if row[0].isdigit():  # skip headers and blank lines
+                yield row
+        completed = True
+    finally:
+        if not completed:
+            proc.kill()
+            proc.stdout.close()
+            proc.stderr.close()
+            proc.wait()
+    stderr = proc.stderr.read()
+    proc.stdout.close()
+    proc.stderr.close()
+    if proc.wait() != 0:
+        raise PrimersJuJuError(f"gfPcr failed: {' '.join(cmd)}: {stderr.strip()}")
+
+def _check_batch_queries(queries):
+    names = set()
+    for query in queries:
+        if (len(query.name) == 0) or (len(query.name.split()) != 1):
+            raise PrimersJuJuError(f"invalid primer pair query name for gfPcr batch: '{query.name}'")
+        if query.name in names:
+            raise PrimersJuJuError(f"duplicate primer pair query name in gfPcr batch: '{query.name}'")
+        names.add(query.name)
+
+def _gfPcr_batch(spec, queries, max_size):
+    """Query with multiple primer pairs in one gfPcr run, returning a dict
+    of query name to list of PSL records, by query name"""
+    _check_batch_queries(queries)
+    psls_by_name = {query.name: [] for query in queries}
+    if len(queries) == 0:
+        return psls_by_name
+    with tempfile.NamedTemporaryFile("w", prefix="primersjuju.", suffix=".pcr") as pcr_fh:
+        for query in queries:
+            print(query.name, query.left_primer, query.right_primer, sep='\t', file=pcr_fh)
+        pcr_fh.flush()
+        cmd = _gfPcr_cmd(spec, max_size) + [pcr_fh.name, "/dev/stdout"]
+        with pipettor.Popen(cmd) as fh:
+            for psl in PslReader(fh):
+                psls = psls_by_name.get(psl.qName)
+                if psls is None:
+                    raise PrimersJuJuError(f"gfPcr returned result for unknown primer pair query: '{psl.qName}'")
+                psls.append(psl)
+    return psls_by_name
+
+###
+# Native gfServer PCR client.  This speaks the gfServer protocol directly and
+# builds the PSLs that gfPcr would output, using the 2bit files in
+# target_seq_dir.  gfServer handles one request per connection, so a new
+# connection is made for each query; the server address is resolved once and
+# the 2bit files are kept open.
+###
+
+GF_SIGNATURE = "0ljkr"  # gfServer request signature
+
+def gfserver_pcr_request(left_primer, right_primer, max_size, *, dyn_name=None, dyn_data_dir=None):
+    "format a gfServer PCR request"
+    if dyn_name is None:
+        return f"{GF_SIGNATURE}pcr {left_primer} {right_primer} {max_size}"
+    if dyn_data_dir is None:
+        dyn_data_dir = dyn_name  # gfPcr default
+    return f"{GF_SIGNATURE}pcr {dyn_name} {dyn_data_dir} {left_primer} {right_primer} {max_size}"
+
+def gfserver_recv_string(sock_fh):
+    """read a gfServer string, which is prefixed by a one byte length; None on EOF"""
+    size = sock_fh.read(1)
+    if len(size) == 0:
+        return None
+    data = sock_fh.read(size[0])
+    if len(data) != size[0]:
+        raise PrimersJuJuError("gfServer connection closed in the middle of a response")
+    return data.decode()
+
+def gfserver_send_string(sock, string):
+    "write a gfServer one byte length prefixed string"
+    data = string.encode()
+    if len(data) > 255:
+        raise PrimersJuJuError(f"gfServer string too long: '{string}'")
+    sock.sendall(bytes([len(data)]) + data)
+
+class GfPcrLocation(NamedTuple):
+    "PCR product location returned by gfServer"
+    seq_file: str  # None if server did not include it
+    seq_name: str
+    start: int
+    end: int
+    strand: str
+
+def _parse_pcr_location(line):
+    words = line.split()
+    if (len(words) < 4) or (words[3] not in ('+', '-')):
+        raise PrimersJuJuError(f"invalid PCR result from gfServer: '{line}'")
+    seq_file, seq_name = words[0].split(':', 1) if ':' in words[0] else (None, words[0])
+    return GfPcrLocation(seq_file, seq_name, int(words[1]), int(words[2]), words[3])
+
+def _count_matches(dna, primer):
+    matches = sum(1 for d, p in zip(dna, primer) if d == p)
+    return matches, len(primer) - matches
+
+def gfpcr_location_to_psl(name, left_primer, right_primer, location, target_dna, target_size):
+    """build the PSL that gfPcr outputs for a product, target_dna is the
+    positive strand target sequence of the product"""
+    left_primer = left_primer.upper()
+    right_primer = right_primer.upper()
+    target_dna = target_dna.upper()
+    if location.strand == '+':
+        first_primer, last_primer = left_primer, dnaOps.reverseComplement(right_primer)
+    else:
+        first_primer, last_primer = right_primer, dnaOps.reverseComplement(left_primer)
+    product_size = location.end - location.start
+    gap_size = product_size - len(first_primer) - len(last_primer)
+    first_match, first_mismatch = _count_matches(target_dna[:len(first_primer)], first_primer)
+    last_match, last_mismatch = _count_matches(target_dna[product_size - len(last_primer):], last_primer)
+    return Psl.fromRow([str(v) for v in (
+        first_match + last_match, first_mismatch + last_mismatch, 0, 0,
+        1, gap_size, 1, gap_size, location.strand,
+        name, product_size, 0, product_size,
+        location.seq_name, target_size, location.start, location.end,
+        2, f"{len(first_primer)},{len(last_primer)},",
+        f"0,{product_size - len(last_primer)},",
+        f"{location.start},{location.end - len(last_primer)},")])
+
+class GfServerPcrClient:
+    """In-process client to run PCR queries against a gfServer described
+    by an IsPcrServerSpec.  Thread-safe."""
+    def __init__(self, spec, *, timeout=600):
+        self.spec = spec
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._addrinfo = None
+        self._twobits = {}
+
+    def _get_addrinfo(self):
+        with self._lock:
+            if self._addrinfo is None:
+                try:
+                    self._addrinfo = socket.getaddrinfo(self.spec.host, int(self.spec.port), type=socket.SOCK_STREAM)[0]
+                except OSError as ex:
+                    raise PrimersJuJuError(f"can't resolve gfServer {self.spec.host}:{self.spec.port}") from ex
+            return self._addrinfo
+
+    def _connect(self):
+        family, socktype, proto, _, sockaddr = self._get_addrinfo()
+        sock = socket.socket(family, socktype, proto)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(sockaddr)
+        except OSError as ex:
+            sock.close()
+            raise PrimersJuJuError(f"can't connect to gfServer {self.spec.host}:{self.spec.port}") from ex
+        return sock
+
+    def iter_locations(self, left_primer, right_primer, max_size):
+        """generator of product locations as they are received from the server,
+        closing the generator closes the connection"""
+        request = gfserver_pcr_request(left_primer, right_primer, max_size,
+                                       dyn_name=self.spec.dyn_name, dyn_data_dir=self.spec.dyn_data_dir)
+        with self._connect() as sock, sock.makefile('rb') as sock_fh:
+            sock.sendall(request.encode())
+            while True:
+                line = gfserver_recv_string(sock_fh)
+                if line is None:
+                    raise PrimersJuJuError(f"gfServer {self.spec.host}:{self.spec.port} closed connection without end of response")
+                if line == "end":
+                    break
+                if line.startswith("Error:"):
+                    raise PrimersJuJuError(f"gfServer {self.spec.host}:{self.spec.port}: {line}")
+                yield _parse_pcr_location(line)
+
+    def query_locations(self, left_primer, right_primer, max_size) -> Sequence[GfPcrLocation]:
+        "query server for product locations"
+        return list(self.iter_locations(left_primer, right_primer, max_size))
+
+    def _get_twobit_path(self, seq_file):
+        if seq_file is not None:
+            return os.path.join(self.spec.target_seq_dir, seq_file)
+        twobits = glob.glob(os.path.join(self.spec.target_seq_dir, "*.2bit"))
+        if len(twobits) != 1:
+            raise PrimersJuJuError(f"gfServer did not return a sequence file name and there is not exactly one 2bit in {self.spec.target_seq_dir}")
+        return twobits[0]
+
+    def _get_target_dna(self, location):
+        # TwoBitFile is not thread-safe, so reads are serialized
+        with self._lock:
+            twobit_path = self._get_twobit_path(location.seq_file)
+            twobit = self._twobits.get(twobit_path)
+            if twobit is None:
+                twobit = self._twobits[twobit_path] = TwoBitFile(twobit_path)
+            try:
+                return (twobit[location.seq_name][location.start:location.end],
+                        twobit.sequence_sizes()[location.seq_name])
+            except KeyError as ex:
+                raise PrimersJuJuError(f"gfServer returned sequence '{location.seq_name}' not in {twobit_path}") from ex
+
+    def iter_pcr(self, name, left_primer, right_primer, max_size):
+        "generator of PSL records, as gfPcr would output, as they are received"
+        with closing(self.iter_locations(left_primer, right_primer, max_size)) as locations:
+            for location in locations:
+                target_dna, target_size = self._get_target_dna(location)
+                yield gfpcr_location_to_psl(name, left_primer, right_primer, location, target_dna, target_size)
+
+    def pcr(self, name, left_primer, right_primer, max_size) -> Sequence[Psl]:
+        "query and return PSL records, as gfPcr would"
+        return list(self.iter_pcr(name, left_primer, right_primer, max_size))
+
+class LocalPcrClient:
+    """Run PCR queries with a local KmerPcrIndex for a LocalPcrSpec, returning
+    the same PSLs as gfPcr"""
+    def __init__(self, spec):
+        self.spec = spec
+        self.index = KmerPcrIndex(spec)
+
+    def iter_pcr(self, name, left_primer, right_primer, max_size):
+        "generator of PSL records, building each only when it is requested"
+        for product in self.index.pcr_products(left_primer, right_primer, max_size):
+            location = GfPcrLocation(None, product.seq_name, product.start, product.end, product.strand)
+            yield gfpcr_location_to_psl(name, left_primer, right_primer, location,
+                                        self.index.get_seq(product.seq_name, product.start, product.end),
+                                        product.seq_size)
+
+    def pcr(self, name, left_primer, right_primer, max_size) -> Sequence[Psl]:
+        return list(self.iter_pcr(name, left_primer, right_primer, max_size))
+
 def _check_psl(psl):
     if len(psl.blocks) != 2:
         raise PrimersJuJuError(f"expected a two-block result back from isPcr, got: {psl}")
@@ -87,7 +391,7 @@ def _genome_psl_to_hit(psl):
                for i in range(2)]
     return GenomeHit(*gcoords, psl)
 
-def _split_transcriptome_id(ispcr_trans_id):
+def split_transcriptome_id(ispcr_trans_id):
     """split id in the form ENST00000244050.3__SNAI1, second part is optional"""
     parts = ispcr_trans_id.split('__')
     if len(parts) == 1:
@@ -95,18 +399,22 @@ def _split_transcriptome_id(ispcr_trans_id):
     else:
         return parts
 
-def _get_transcript_bed(transcriptome_spec, ispcr_id, trans_id):
-    # try both names if different; fetch doesn't return an error
-    if ispcr_id == trans_id:
-        bed = bigbed_read_by_name(transcriptome_spec.trans_bigbed, trans_id)
-    else:
-        bed = bigbed_fetch_by_name(transcriptome_spec.trans_bigbed, ispcr_id)
-        if bed is None:
-            # error if not found
-            bed = bigbed_read_by_name(transcriptome_spec.trans_bigbed, trans_id)
-    # fix up BED id to match psl
-    bed.name = ispcr_id
-    return bed
+def _resolve_transcript_beds(transcriptome_spec, ispcr_ids):
+    """get transcript BEDs for isPcr target ids with a single bigBed lookup,
+    trying both the <trans_id>__<gene_name> and <trans_id> names.  Returns dict
+    by ispcr_id, with BED names changed to the ispcr_id"""
+    trans_ids = {ispcr_id: split_transcriptome_id(ispcr_id)[0] for ispcr_id in ispcr_ids}
+    beds = bigbed_fetch_by_names(transcriptome_spec.trans_bigbed, set(ispcr_ids) | set(trans_ids.values()))
+    missing = sorted([ispcr_id for ispcr_id in ispcr_ids
+                      if (ispcr_id not in beds) and (trans_ids[ispcr_id] not in beds)])
+    if len(missing) > 0:
+        raise PrimersJuJuDataError(f"transcripts not found in bigBed {transcriptome_spec.trans_bigbed}: " + ", ".join(missing))
+    ispcr_beds = {}
+    for ispcr_id in ispcr_ids:
+        bed = copy.copy(beds.get(ispcr_id, beds.get(trans_ids[ispcr_id])))
+        bed.name = ispcr_id  # fix up BED id to match psl
+        ispcr_beds[ispcr_id] = bed
+    return ispcr_beds
 
 def _trans_range_to_features(trans_features, tcoords):
     """map a transcript range to features, with positive genome coordinates"""
@@ -115,14 +423,12 @@ def _trans_range_to_features(trans_features, tcoords):
         features = features.strandReverse()
     return features
 
-def _trans_psl_to_hit(genome_data, transcriptome_spec, psl):
+def _trans_psl_to_hit(trans_features, psl):
     _check_psl(psl)
     # the fact that the server and transcript BED might have
     # different names due to the ispcr server conventions requires
     # some care here to use the same name
-    trans_id, gene_name = _split_transcriptome_id(psl.tName)
-    transcriptome_bed = _get_transcript_bed(transcriptome_spec, psl.tName, trans_id)
-    trans_features = bed_to_features(genome_data, transcriptome_bed)
+    trans_id, gene_name = split_transcriptome_id(psl.tName)
 
     # hit genomic coordinates
     tcoords_list = [Coords(psl.tName, psl.blocks[i].tStart, psl.blocks[i].tEnd, psl.tStrand, psl.tSize)
@@ -134,25 +440,428 @@ def _trans_psl_to_hit(genome_data, transcriptome_spec, psl):
         features_list.reverse()   # put in genomic order
     return TranscriptomeHit(psl.tName, trans_id, gene_name, *features_list, psl)
 
+class _GenomeHitConverter:
+    "convert genome PSLs to hits"
+    def convert_alignment(self, alignment):
+        return _genome_psl_to_hit(alignment)
+
+    def convert(self, psls_by_name):
+        return {name: [_genome_psl_to_hit(psl) for psl in psls]
+                for name, psls in psls_by_name.items()}
+
+class _TranscriptomeHitConverter:
+    """Convert transcriptome PSLs to hits.  The transcript BEDs for all of the
+    PSLs are looked up in bulk and transcript features are memoized, up to the
+    spec's trans_cache_size least recently used, so cost scales with the number
+    of distinct transcripts.  Thread-safe."""
+    def __init__(self, genome_data, transcriptome_spec):
+        self.genome_data = genome_data
+        self.transcriptome_spec = transcriptome_spec
+        self._lock = threading.Lock()
+        self._trans_features = OrderedDict()  # by ispcr_id
+
+    def _get_trans_features(self, ispcr_ids):
+        trans_features = {}
+        with self._lock:
+            for ispcr_id in ispcr_ids:
+                features = self._trans_features.get(ispcr_id)
+                if features is not None:
+                    self._trans_features.move_to_end(ispcr_id)
+                    trans_features[ispcr_id] = features
+        missing = set(ispcr_ids) - set(trans_features.keys())
+        if len(missing) > 0:
+            beds = _resolve_transcript_beds(self.transcriptome_spec, missing)
+            new_features = {ispcr_id: bed_to_features(self.genome_data, bed)
+                            for ispcr_id, bed in beds.items()}
+            trans_features.update(new_features)
+            if self.transcriptome_spec.trans_cache_size > 0:
+                with self._lock:
+                    self._trans_features.update(new_features)
+                    while len(self._trans_features) > self.transcriptome_spec.trans_cache_size:
+                        self._trans_features.popitem(last=False)
+        return trans_features
+
+    def convert_alignment(self, alignment):
+        return _trans_psl_to_hit(self._get_trans_features({alignment.tName})[alignment.tName], alignment)
+
+    def convert(self, psls_by_name):
+        trans_features = self._get_trans_features({psl.tName for psls in psls_by_name.values() for psl in psls})
+        return {name: [_trans_psl_to_hit(trans_features[psl.tName], psl) for psl in psls]
+                for name, psls in psls_by_name.items()}
+
+def _server_identity(spec):
+    "string identifying the server or local index a spec queries"
+    if isinstance(spec, LocalPcrSpec):
+        return f"local:{os.path.abspath(spec.twobit)}:{spec.kmer_size}:{spec.max_mismatches}"
+    return f"{spec.host}:{spec.port}:{spec.dyn_name}:{spec.dyn_data_dir}"
+
+def _cache_identity(spec):
+    """string identifying the sequences a spec queries, used to key cached
+    results.  The host and port are not included, so equivalent replica
+    servers share cached results."""
+    if isinstance(spec, LocalPcrSpec):
+        return _server_identity(spec)
+    return f"isPcr:{os.path.abspath(spec.target_seq_dir)}:{spec.dyn_name}:{spec.dyn_data_dir}:{spec.trans_bigbed}"
+
+def _file_stamp(path):
+    st = os.stat(path)
+    return f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns}"
+
+def _server_stamp(spec):
+    """stamp of the sequence files used by a server, which changes if they are
+    modified"""
+    if isinstance(spec, LocalPcrSpec):
+        return _file_stamp(spec.twobit)
+    return ",".join([_file_stamp(p) for p in sorted(glob.glob(os.path.join(spec.target_seq_dir, "*.2bit")))])
+
+def _completed_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+class BatchQueryFuture:
+    """Results of a batch query that was split into concurrently run chunks.
+    result() returns the dict of hits by query name, in request order"""
+    def __init__(self, queries, chunk_futures):
+        self.queries = queries
+        self.chunk_futures = chunk_futures
+
+    def result(self):
+        hits_by_name = {}
+        for chunk_future in self.chunk_futures:
+            hits_by_name.update(chunk_future.result())
+        return {query.name: hits_by_name[query.name] for query in self.queries}
+
+def _split_chunks(queries, num_chunks):
+    chunk_size = -(-len(queries) // num_chunks)
+    return [queries[i:i + chunk_size] for i in range(0, len(queries), chunk_size)]
+
+@dataclass
+class IsPcrServerStats:
+    "query statistics for one isPcr server or local index"
+    server: str
+    queries: int = 0
+    failures: int = 0
+    total_time: float = 0.0  # seconds spent running queries
+    healthy: bool = True
+
+    @property
+    def mean_latency(self):
+        "mean seconds per query, a batch counts as one query"
+        return (self.total_time / self.queries) if self.queries > 0 else 0.0
+
+class _IsPcrServer:
+    """Runs gfPcr queries for one server spec, or local PCR queries for a
+    LocalPcrSpec, in a thread pool, limited to the spec's max_in_flight"""
+    def __init__(self, spec, hit_converter, pcr_cache):
+        if spec.max_in_flight < 1:
+            raise PrimersJuJuError(f"{type(spec).__name__} max_in_flight must be at least 1, got {spec.max_in_flight}")
+        self.spec = spec
+        self.hit_converter = hit_converter
+        if isinstance(spec, LocalPcrSpec):
+            self.native_client = LocalPcrClient(spec)
+            thread_name_prefix = "localPcr"
+        else:
+            if spec.client not in ("gfPcr", "native"):
+                raise PrimersJuJuError(f"IsPcrServerSpec client must be 'gfPcr' or 'native', got '{spec.client}'")
+            self.native_client = GfServerPcrClient(spec) if spec.client == "native" else None
+            thread_name_prefix = f"gfPcr-{spec.host}:{spec.port}"
+        self.executor = ThreadPoolExecutor(max_workers=spec.max_in_flight,
+                                           thread_name_prefix=thread_name_prefix)
+        self.pcr_cache = pcr_cache
+        self.server_id = _server_identity(spec)
+        self.cache_id = _cache_identity(spec)
+        if pcr_cache is not None:
+            self.server_stamp = _server_stamp(spec)
+            pcr_cache.invalidate_server(self.cache_id, self.server_stamp)
+        # dispatch state, maintained by _IsPcrServerPool
+        self.stats = IsPcrServerStats(self.server_id)
+        self.outstanding = 0
+        self.consecutive_failures = 0
+
+    def _run_pcr(self, name, left_primer, right_primer, max_size):
+        if self.native_client is not None:
+            return self.native_client.pcr(name, left_primer, right_primer, max_size)
+        return _gfPcr(self.spec, name, left_primer, right_primer, max_size)
+
+    def _run_pcr_batch(self, queries, max_size):
+        if self.native_client is not None:
+            return {query.name: self.native_client.pcr(*query, max_size) for query in queries}
+        return _gfPcr_batch(self.spec, queries, max_size)
+
+    def _cache_get(self, name, left_primer, right_primer, max_size):
+        return self.pcr_cache.get(self.cache_id, self.server_stamp, name, left_primer, right_primer, max_size)
+
+    def _cache_put(self, left_primer, right_primer, max_size, psls):
+        self.pcr_cache.put(self.cache_id, self.server_stamp, left_primer, right_primer, max_size, psls)
+
+    def _pcr(self, name, left_primer, right_primer, max_size):
+        if self.pcr_cache is None:
+            return self._run_pcr(name, left_primer, right_primer, max_size)
+        psls = self._cache_get(name, left_primer, right_primer, max_size)
+        if psls is None:
+            psls = self._run_pcr(name, left_primer, right_primer, max_size)
+            self._cache_put(left_primer, right_primer, max_size, psls)
+        return psls
+
+    def _pcr_batch(self, queries, max_size):
+        if self.pcr_cache is None:
+            return self._run_pcr_batch(queries, max_size)
+        psls_by_name = {query.name: self._cache_get(*query, max_size) for query in queries}
+        misses = [query for query in queries if psls_by_name[query.name] is None]
+        if len(misses) > 0:
+            psls_by_name.update(self._run_pcr_batch(misses, max_size))
+            for query in misses:
+                self._cache_put(query.left_primer, query.right_primer, max_size, psls_by_name[query.name])
+        return psls_by_name
+
+    def _run_pcr_stream(self, name, left_primer, right_primer, max_size):
+        if self.native_client is not None:
+            return (_psl_to_row(psl) for psl in self.native_client.iter_pcr(name, left_primer, right_primer, max_size))
+        return _gfPcr_stream(self.spec, name, left_primer, right_primer, max_size)
+
+    def _pcr_stream(self, name, left_primer, right_primer, max_size):
+        """generator of PSL rows from the cache or the server.  Results are
+        only cached if all of the rows were read."""
+        if self.pcr_cache is not None:
+            psls = self._cache_get(name, left_primer, right_primer, max_size)
+            if psls is not None:
+                yield from (_psl_to_row(psl) for psl in psls)
+                return
+        rows = []
+        with closing(self._run_pcr_stream(name, left_primer, right_primer, max_size)) as rows_iter:
+            for row in rows_iter:
+                if self.pcr_cache is not None:
+                    rows.append(row)
+                yield row
+        if self.pcr_cache is not None:
+            self.pcr_cache.put_rows(self.cache_id, self.server_stamp, left_primer, right_primer, max_size, rows)
+
+    def _query_stream(self, name, left_primer, right_primer, max_size, hit_sink):
+        with closing(self._pcr_stream(name, left_primer, right_primer, max_size)) as rows:
+            for row in rows:
+                if not hit_sink(self.hit_converter.convert_alignment(parse_pcr_alignment(row))):
+                    return False
+        return True
+
+    def _query(self, name, left_primer, right_primer, max_size):
+        return self.hit_converter.convert({name: self._pcr(name, left_primer, right_primer, max_size)})[name]
+
+    def _query_batch(self, queries, max_size):
+        return self.hit_converter.convert(self._pcr_batch(queries, max_size))
+
+def _check_pool_specs(specs):
+    "replicas must be equivalent in the options that affect results"
+    def _results_opts(spec):
+        return (type(spec), spec.trans_bigbed, spec.max_size, spec.first_tier_size_factor)
+    for spec in specs[1:]:
+        if _results_opts(spec) != _results_opts(specs[0]):
+            raise PrimersJuJuError(f"isPcr server replicas must have the same type, trans_bigbed, max_size, and first_tier_size_factor: {specs[0]} and {spec}")
+
+class _IsPcrServerPool:
+    """Pool of equivalent servers for either genome or transcriptome queries.
+    Each query is sent to the healthy server with the least outstanding queries
+    relative to its max_in_flight.  A query that fails is retried on another
+    server, and a server is dropped after max_failures consecutive failures.
+    Streamed queries are not retried, as hits may have already been passed on.
+    A PrimersJuJuDataError is not considered a server failure."""
+    def __init__(self, specs, hit_converter, pcr_cache, max_failures):
+        if max_failures < 1:
+            raise PrimersJuJuError(f"replica max_failures must be at least 1, got {max_failures}")
+        _check_pool_specs(specs)
+        self.servers = [_IsPcrServer(spec, hit_converter, pcr_cache) for spec in specs]
+        self.max_failures = max_failures
+        self._lock = threading.Lock()
+
+    def _select(self, tried):
+        "pick server and count query as outstanding, or None if no healthy servers left"
+        with self._lock:
+            candidates = [server for server in self.servers
+                          if server.stats.healthy and (server not in tried)]
+            if len(candidates) == 0:
+                return None
+            server = min(candidates, key=lambda server: server.outstanding / server.spec.max_in_flight)
+            server.outstanding += 1
+            return server
+
+    def _finish(self, server, elapsed, failed):
+        with self._lock:
+            server.outstanding -= 1
+            server.stats.queries += 1
+            server.stats.total_time += elapsed
+            if failed:
+                server.stats.failures += 1
+                server.consecutive_failures += 1
+                if server.consecutive_failures >= self.max_failures:
+                    server.stats.healthy = False
+            else:
+                server.consecutive_failures = 0
+
+    def _run(self, server, query_method, args):
+        "run query in a server thread, recording latency and failures"
+        start = time.monotonic()
+        failed = False
+        try:
+            return getattr(server, query_method)(*args)
+        except PrimersJuJuDataError:
+            raise
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._finish(server, time.monotonic() - start, failed)
+
+    def _dispatch_next(self, result_future, query_method, args, retry, tried, last_ex):
+        server = self._select(tried)
+        if server is None:
+            if last_ex is None:
+                last_ex = PrimersJuJuError("no healthy isPcr servers left: " + ", ".join([s.server_id for s in self.servers]))
+            result_future.set_exception(last_ex)
+            return
+        tried.add(server)
+        future = server.executor.submit(self._run, server, query_method, args)
+        future.add_done_callback(functools.partial(self._dispatch_done, result_future, query_method, args, retry, tried))
+
+    def _dispatch_done(self, result_future, query_method, args, retry, tried, future):
+        ex = future.exception()
+        if ex is None:
+            result_future.set_result(future.result())
+        elif retry and not isinstance(ex, PrimersJuJuDataError):
+            self._dispatch_next(result_future, query_method, args, retry, tried, ex)
+        else:
+            result_future.set_exception(ex)
+
+    def _dispatch(self, query_method, args, *, retry=True):
+        result_future = Future()
+        self._dispatch_next(result_future, query_method, args, retry, set(), None)
+        return result_future
+
+    def submit(self, name, left_primer, right_primer, max_size):
+        return self._dispatch("_query", (name, left_primer, right_primer, max_size))
+
+    def submit_stream(self, name, left_primer, right_primer, max_size, hit_sink):
+        return self._dispatch("_query_stream", (name, left_primer, right_primer, max_size, hit_sink), retry=False)
+
+    def submit_batch(self, queries, max_size):
+        _check_batch_queries(queries)
+        with self._lock:
+            capacity = sum([server.spec.max_in_flight for server in self.servers if server.stats.healthy])
+        chunks = _split_chunks(queries, max(capacity, 1)) if len(queries) > 0 else []
+        return BatchQueryFuture(queries, [self._dispatch("_query_batch", (chunk, max_size))
+                                          for chunk in chunks])
+
+    def get_stats(self) -> Sequence[IsPcrServerStats]:
+        with self._lock:
+            return [copy.copy(server.stats) for server in self.servers]
+
+def _spec_list(spec):
+    "spec maybe None, a single spec, or a sequence of replicas"
+    if spec is None:
+        return []
+    elif isinstance(spec, (list, tuple)):
+        return list(spec)
+    else:
+        return [spec]
+
 class UniquenessQuery:
     """Interface to UCSC isPCR server to query for uniqueness. the
-    spec
+    spec.  Either spec maybe a LocalPcrSpec to use a local k-mer index instead
+    of a server.  Queries are run concurrently, up to the max_in_flight of each spec.
+    The submit_* methods return futures, the query_* methods wait for results.
+    If pcr_cache, a PcrResultCache, is specified, the PSLs from the servers are
+    cached.
+
+    If max_off_targets is not None, primer uniqueness checks use the streamed
+    queries, one per primer pair rather than batched, which classify hits as
+    they are received and stop reading after max_off_targets off-target hits.
+
+    Either spec maybe a list of equivalent replica servers, with queries
+    spread across them.  A replica is dropped after replica_max_failures
+    consecutive failed queries.  The genome_spec and transcriptome_spec
+    attributes are the first of the replicas.
     """
-    def __init__(self, genome_data, genome_spec, transcriptome_spec):
+    def __init__(self, genome_data, genome_spec, transcriptome_spec, *, pcr_cache=None,
+                 max_off_targets=None, replica_max_failures=3):
+        if (max_off_targets is not None) and (max_off_targets < 1):
+            raise PrimersJuJuError(f"max_off_targets must be at least 1, got {max_off_targets}")
+        genome_specs = _spec_list(genome_spec)
+        transcriptome_specs = _spec_list(transcriptome_spec)
         self.genome_data = genome_data
-        self.genome_spec = genome_spec
-        self.transcriptome_spec = transcriptome_spec
+        self.genome_spec = genome_specs[0] if len(genome_specs) > 0 else None
+        self.transcriptome_spec = transcriptome_specs[0] if len(transcriptome_specs) > 0 else None
+        self.pcr_cache = pcr_cache
+        self.max_off_targets = max_off_targets
+        self._genome_server = None
+        if len(genome_specs) > 0:
+            self._genome_server = _IsPcrServerPool(genome_specs, _GenomeHitConverter(), pcr_cache,
+                                                   replica_max_failures)
+        self._transcriptome_server = None
+        if len(transcriptome_specs) > 0:
+            self._transcriptome_server = _IsPcrServerPool(transcriptome_specs,
+                                                          _TranscriptomeHitConverter(genome_data, self.transcriptome_spec),
+                                                          pcr_cache, replica_max_failures)
+
+    def server_stats(self) -> Sequence[IsPcrServerStats]:
+        "query statistics for each genome and then transcriptome server"
+        return [stats for pool in (self._genome_server, self._transcriptome_server) if pool is not None
+                for stats in pool.get_stats()]
+
+    def submit_genome(self, name, left_primer, right_primer, max_size) -> Future:
+        """start query for primer hits in genome, future returns a list of GenomeHit"""
+        if self._genome_server is None:
+            return _completed_future([])
+        return self._genome_server.submit(name, left_primer, right_primer, max_size)
+
+    def submit_transcriptome(self, name, left_primer, right_primer, max_size) -> Future:
+        """start query for primer hits in transcriptome, future returns a list of TranscriptomeHit"""
+        if self._transcriptome_server is None:
+            return _completed_future([])
+        return self._transcriptome_server.submit(name, left_primer, right_primer, max_size)
+
+    def submit_genome_stream(self, name, left_primer, right_primer, max_size, hit_sink) -> Future:
+        """start a streamed query for primer hits in genome.  Each GenomeHit is
+        passed to hit_sink as it is received, with only the needed PSL fields
+        kept in the alignment.  If hit_sink returns False, the query is stopped.
+        The future returns True if all hits were read."""
+        if self._genome_server is None:
+            return _completed_future(True)
+        return self._genome_server.submit_stream(name, left_primer, right_primer, max_size, hit_sink)
+
+    def submit_transcriptome_stream(self, name, left_primer, right_primer, max_size, hit_sink) -> Future:
+        """start a streamed query for primer hits in transcriptome, passing
+        each TranscriptomeHit to hit_sink, see submit_genome_stream"""
+        if self._transcriptome_server is None:
+            return _completed_future(True)
+        return self._transcriptome_server.submit_stream(name, left_primer, right_primer, max_size, hit_sink)
+
+    def submit_genome_batch(self, queries, max_size) -> BatchQueryFuture:
+        """start query for primer hits in genome for a list of PrimerPairQuery
+        objects, split into concurrent gfPcr runs"""
+        if self._genome_server is None:
+            return BatchQueryFuture(queries, [_completed_future({query.name: [] for query in queries})])
+        return self._genome_server.submit_batch(queries, max_size)
+
+    def submit_transcriptome_batch(self, queries, max_size) -> BatchQueryFuture:
+        """start query for primer hits in transcriptome for a list of PrimerPairQuery
+        objects, split into concurrent gfPcr runs"""
+        if self._transcriptome_server is None:
+            return BatchQueryFuture(queries, [_completed_future({query.name: [] for query in queries})])
+        return self._transcriptome_server.submit_batch(queries, max_size)
 
     def query_genome(self, name, left_primer, right_primer, max_size) -> Sequence[GenomeHit]:
         """query for primer hits in genome"""
-        if self.genome_spec is None:
-            return []
-        genome_pcr_psls = _gfPcr(self.genome_spec, name, left_primer, right_primer, max_size)
-        return [_genome_psl_to_hit(psl) for psl in genome_pcr_psls]
+        return self.submit_genome(name, left_primer, right_primer, max_size).result()
 
     def query_transcriptome(self, name, left_primer, right_primer, max_size) -> Sequence[TranscriptomeHit]:
         """query for primer hits in transcriptome"""
-        if self.transcriptome_spec is None:
-            return []
-        trans_pcr_psls = _gfPcr(self.transcriptome_spec, name, left_primer, right_primer, max_size)
-        return [_trans_psl_to_hit(self.genome_data, self.transcriptome_spec, psl) for psl in trans_pcr_psls]
+        return self.submit_transcriptome(name, left_primer, right_primer, max_size).result()
+
+    def query_genome_batch(self, queries, max_size) -> dict[str, Sequence[GenomeHit]]:
+        """query for primer hits in genome for a list of PrimerPairQuery
+        objects, returning a dict of hits by query name"""
+        return self.submit_genome_batch(queries, max_size).result()
+
+    def query_transcriptome_batch(self, queries, max_size) -> dict[str, Sequence[TranscriptomeHit]]:
+        """query for primer hits in transcriptome for a list of PrimerPairQuery
+        objects, returning a dict of hits by query name"""
+        return self.submit_transcriptome_batch(queries, max_size).result()
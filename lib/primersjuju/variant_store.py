@@ -0,0 +1,179 @@
+"""
+Indexed store of genomic variants, such as common SNPs, used to screen primers.
+
+A bigBed or VCF of variants is compiled into sorted, memory-mapped numpy
+arrays, so overlapping variants for many primer blocks are found with binary
+searches rather than by reading the source for each primer.  A VCF may be
+bgzip-compressed, as with a tabix-indexed VCF; it is read sequentially when
+compiling.
+
+Store files in the store directory:
+  - starts.npy, ends.npy - variant ranges, sorted by chrom and start
+  - ids.npy - variant ids, as bytes
+  - index.json - parameters, the source size and modification time, the range
+    of each chrom in the arrays, and the maximum variant length.  Written last.
+"""
+import os
+import os.path as osp
+import gzip
+import json
+from typing import NamedTuple, Sequence
+from dataclasses import dataclass, KW_ONLY
+import numpy as np
+import pipettor
+from pycbio.hgdata.bed import BedReader
+from . import PrimersJuJuDataError
+
+_store_version = 1
+
+@dataclass
+class VariantStoreSpec:
+    """Specification of a variant store compiled from a bigBed or VCF file.
+    The store is built in store_dir on first use and rebuilt if the source
+    changes."""
+    source: str  # local bigBed, or VCF, which maybe compressed
+    store_dir: str
+    _: KW_ONLY
+    min_af: float = None  # for VCFs, skip variants with an INFO AF below this or without AF
+
+class Variant(NamedTuple):
+    "a variant from a VariantStore, genomic coordinates on the positive strand"
+    variant_id: str
+    chrom: str
+    start: int
+    end: int
+
+class PrimerVariant(NamedTuple):
+    "a variant overlapping a primer"
+    variant: Variant
+    primer: str  # "left" or "right"
+    dist_3p: int  # number of primer bases between the variant and the 3' end
+
+def _is_vcf(source):
+    return source.endswith((".vcf", ".vcf.gz", ".vcf.bgz"))
+
+def _vcf_max_af(info):
+    for field in info.split(';'):
+        if field.startswith("AF="):
+            return max((float(af) for af in field[3:].split(',') if af != '.'), default=None)
+    return None
+
+def _read_vcf_variants(spec):
+    "generate (chrom, start, end, id) from a VCF"
+    open_func = gzip.open if spec.source.endswith(("gz", "bgz")) else open
+    with open_func(spec.source, "rt") as fh:
+        for line in fh:
+            if line.startswith('#'):
+                continue
+            row = line.rstrip('\n').split('\t')
+            chrom, start, var_id, ref = row[0], int(row[1]) - 1, row[2], row[3]
+            if spec.min_af is not None:
+                max_af = _vcf_max_af(row[7])
+                if (max_af is None) or (max_af < spec.min_af):
+                    continue
+            if var_id == '.':
+                var_id = f"{chrom}:{start + 1}{ref}>{row[4]}"
+            yield chrom, start, start + max(len(ref), 1), var_id
+
+def _read_bigbed_variants(spec):
+    "generate (chrom, start, end, id) from a bigBed"
+    with pipettor.Popen(['bigBedToBed', spec.source, '/dev/stdout']) as fh:
+        for bed in BedReader(fh, numStdCols=4):
+            yield bed.chrom, bed.chromStart, bed.chromEnd, bed.name
+
+def _source_stamp(source):
+    st = os.stat(source)
+    return {"size": st.st_size, "mtime": st.st_mtime}
+
+def _store_info(spec):
+    return {"version": _store_version, "source": osp.abspath(spec.source),
+            "source_stamp": _source_stamp(spec.source), "min_af": spec.min_af}
+
+def _read_store_info(spec):
+    info_file = osp.join(spec.store_dir, "index.json")
+    if not osp.exists(info_file):
+        return None
+    with open(info_file) as fh:
+        info = json.load(fh)
+    if {k: info.get(k) for k in ("version", "source", "source_stamp", "min_af")} != _store_info(spec):
+        return None
+    return info
+
+def variant_store_build(spec):
+    """build the store for a VariantStoreSpec"""
+    os.makedirs(spec.store_dir, exist_ok=True)
+    info_file = osp.join(spec.store_dir, "index.json")
+    if osp.exists(info_file):
+        os.unlink(info_file)
+    chrom_idxs = {}
+    chroms, starts, ends, ids = [], [], [], []
+    for chrom, start, end, var_id in (_read_vcf_variants(spec) if _is_vcf(spec.source) else _read_bigbed_variants(spec)):
+        chroms.append(chrom_idxs.setdefault(chrom, len(chrom_idxs)))
+        starts.append(start)
+        ends.append(end)
+        ids.append(var_id)
+    chroms = np.array(chroms, dtype=np.int32)
+    starts = np.array(starts, dtype=np.int64)
+    ends = np.array(ends, dtype=np.int64)
+    order = np.lexsort((starts, chroms))
+    chroms = chroms[order]
+    for name, arr in (("starts", starts[order]), ("ends", ends[order]),
+                      ("ids", np.array(ids, dtype=bytes)[order] if len(ids) > 0 else np.zeros(0, dtype="S1"))):
+        np.save(osp.join(spec.store_dir, name + ".tmp.npy"), arr)
+        os.replace(osp.join(spec.store_dir, name + ".tmp.npy"), osp.join(spec.store_dir, name + ".npy"))
+    chrom_ranges = {chrom: [int(np.searchsorted(chroms, idx, side='left')), int(np.searchsorted(chroms, idx, side='right'))]
+                    for chrom, idx in chrom_idxs.items()}
+    info = _store_info(spec)
+    info["chrom_ranges"] = chrom_ranges
+    info["max_length"] = int((ends - starts).max(initial=0))
+    with open(info_file, "w") as fh:
+        json.dump(info, fh)
+
+class VariantStore:
+    """Memory-mapped variant store, built if needed.  Queries are
+    thread-safe."""
+    def __init__(self, spec):
+        if not osp.exists(spec.source):
+            raise PrimersJuJuDataError(f"variant source must be a local file, not found: {spec.source}")
+        self.spec = spec
+        info = _read_store_info(spec)
+        if info is None:
+            variant_store_build(spec)
+            info = _read_store_info(spec)
+        self.chrom_ranges = info["chrom_ranges"]
+        self.max_length = info["max_length"]
+        self.starts = np.load(osp.join(spec.store_dir, "starts.npy"), mmap_mode="r")
+        self.ends = np.load(osp.join(spec.store_dir, "ends.npy"), mmap_mode="r")
+        self.ids = np.load(osp.join(spec.store_dir, "ids.npy"), mmap_mode="r")
+
+    def _chrom_overlaps(self, chrom, qstarts, qends):
+        """find overlapping variants for ranges on one chrom, returning arrays
+        of query index and variant index"""
+        lo, hi = self.chrom_ranges[chrom]
+        chrom_starts = self.starts[lo:hi]
+        firsts = np.searchsorted(chrom_starts, qstarts - self.max_length, side='right')
+        cnts = np.searchsorted(chrom_starts, qends, side='left') - firsts
+        cnts = np.maximum(cnts, 0)
+        offsets = np.arange(cnts.sum()) - np.repeat(np.cumsum(cnts) - cnts, cnts)
+        query_idxs = np.repeat(np.arange(len(qstarts)), cnts)
+        var_idxs = np.repeat(firsts, cnts) + offsets + lo
+        overlaps = self.ends[var_idxs] > qstarts[query_idxs]
+        return query_idxs[overlaps], var_idxs[overlaps]
+
+    def query(self, gcoords_list) -> Sequence[Sequence[Variant]]:
+        """Find variants overlapping each of a list of genomic ranges, returning
+        a parallel list of lists of Variant"""
+        results = [[] for _ in gcoords_list]
+        by_chrom = {}
+        for i, gcoords in enumerate(gcoords_list):
+            by_chrom.setdefault(gcoords.name, []).append(i)
+        for chrom, idxs in by_chrom.items():
+            if chrom not in self.chrom_ranges:
+                continue
+            idxs = np.array(idxs, dtype=np.int64)
+            qstarts = np.array([gcoords_list[i].start for i in idxs], dtype=np.int64)
+            qends = np.array([gcoords_list[i].end for i in idxs], dtype=np.int64)
+            for query_idx, var_idx in zip(*self._chrom_overlaps(chrom, qstarts, qends)):
+                results[idxs[query_idx]].append(Variant(self.ids[var_idx].decode(), chrom,
+                                                        int(self.starts[var_idx]), int(self.ends[var_idx])))
+        return results
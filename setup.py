@@ -7,6 +7,7 @@ requirements = [
     "twobitreader>=3.1.7",
     "pycbio @ git+https://github.com/diekhans/pycbio.git@2024-03-20.stable",
     "pipettor",
+    "numpy",
 ]
 
 setuptools.setup(
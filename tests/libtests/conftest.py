@@ -1,10 +1,13 @@
 import pytest
 import os.path as osp
+import random
+from pycbio.hgdata import dnaOps
 from . import mydir
 from primersjuju.config import PrimersJuJuConfig
 from primersjuju.genome_data import GenomeData
 from primersjuju.primer_target_spec import primer_target_specs_read
 from primersjuju.uniqueness_query import IsPcrServerSpec, UniquenessQuery
+from .testfuncs import random_seq, make_test_twobit
 
 def _test_data_file(fname):
     return osp.join(mydir, "../data", fname)
@@ -51,3 +54,15 @@ def gencode_ispcr_spec():
 @pytest.fixture(scope="session")
 def hg38_uniqueness_query(config_hg38, hg38_ispcr_spec, gencode_ispcr_spec):
     return UniquenessQuery(config_hg38.genome, hg38_ispcr_spec, gencode_ispcr_spec)
+
+@pytest.fixture(scope="session")
+def local_pcr_genome():
+    "random genome with a primer pair site and a copy with 5' mismatches"
+    rand = random.Random(2)
+    seqs = {f"chr{i}": random_seq(rand, 20000) for i in range(1, 4)}
+    left_primer = seqs["chr2"][1000:1020]
+    right_primer = dnaOps.reverseComplement(seqs["chr2"][5000:5020])
+    chr3 = seqs["chr3"]
+    seqs["chr3"] = (chr3[:2000] + ("T" if left_primer[0] != "T" else "A") + left_primer[1:] + chr3[2020:3000] +
+                    dnaOps.reverseComplement(right_primer[1:]) + ("T" if right_primer[0] != "A" else "C") + chr3[3020:])
+    return make_test_twobit(osp.join("output", "kmer_pcr"), "genome.2bit", seqs), left_primer, right_primer
@@ -0,0 +1,93 @@
+"""
+Local stand-in for a gfServer that implements the PCR query protocol with
+exact primer matches, used to test the native client without a real server.
+"""
+import os.path as osp
+import threading
+import socketserver
+from twobitreader import TwoBitFile
+from pycbio.hgdata import dnaOps
+from primersjuju.uniqueness_query import GF_SIGNATURE, gfserver_send_string
+
+def _find_all(seq, sub):
+    start = seq.find(sub)
+    while start >= 0:
+        yield start
+        start = seq.find(sub, start + 1)
+
+def _side_products(seq, first_primer, last_primer, max_size, strand):
+    last_rc = dnaOps.reverseComplement(last_primer)
+    last_starts = list(_find_all(seq, last_rc))
+    for first_start in _find_all(seq, first_primer):
+        for last_start in last_starts:
+            end = last_start + len(last_rc)
+            if (last_start >= first_start + len(first_primer)) and (end - first_start <= max_size):
+                yield (first_start, end, strand)
+
+def standin_pcr_products(seq, left_primer, right_primer, max_size):
+    "find products in seq as (start, end, strand)"
+    left_primer = left_primer.upper()
+    right_primer = right_primer.upper()
+    return sorted(list(_side_products(seq, left_primer, right_primer, max_size, '+')) +
+                  list(_side_products(seq, right_primer, left_primer, max_size, '-')))
+
+class _PcrHandler(socketserver.BaseRequestHandler):
+    def _parse_request(self, request):
+        if not request.startswith(GF_SIGNATURE):
+            raise ValueError("bad signature")
+        words = request[len(GF_SIGNATURE):].split()
+        if (len(words) == 0) or (words[0] != "pcr"):
+            raise ValueError("unsupported command")
+        words = words[1:]
+        if len(words) == 5:
+            dyn_name, dyn_data_dir = words[0:2]
+            if (dyn_name, dyn_data_dir) != (self.server.dyn_name, self.server.dyn_data_dir):
+                raise ValueError(f"unknown dynamic genome {dyn_name} {dyn_data_dir}")
+            words = words[2:]
+        elif self.server.dyn_name is not None:
+            raise ValueError("dynamic genome not specified")
+        if len(words) != 3:
+            raise ValueError("expected primers and max size")
+        return words[0], words[1], int(words[2])
+
+    def handle(self):
+        self.server.request_cnt += 1
+        try:
+            left_primer, right_primer, max_size = self._parse_request(self.request.recv(4096).decode())
+        except ValueError as ex:
+            gfserver_send_string(self.request, f"Error: {ex}")
+            return
+        for seq_name, seq in self.server.seqs.items():
+            for start, end, strand in standin_pcr_products(seq, left_primer, right_primer, max_size):
+                gfserver_send_string(self.request, f"{self.server.seq_file}:{seq_name} {start} {end} {strand}")
+        gfserver_send_string(self.request, "end")
+
+class GfServerStandIn(socketserver.ThreadingTCPServer):
+    """Serve PCR queries for selected sequences from a 2bit file on a local
+    port.  Use as a context manager."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, twobit_file, seq_names, *, dyn_name=None, dyn_data_dir=None):
+        super().__init__(("127.0.0.1", 0), _PcrHandler)
+        self.seq_file = osp.basename(twobit_file)
+        twobit = TwoBitFile(twobit_file)
+        self.seqs = {seq_name: str(twobit[seq_name]).upper() for seq_name in seq_names}
+        self.dyn_name = dyn_name
+        self.dyn_data_dir = dyn_name if (dyn_name is not None) and (dyn_data_dir is None) else dyn_data_dir
+        self.request_cnt = 0
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
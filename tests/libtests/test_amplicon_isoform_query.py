@@ -0,0 +1,51 @@
+"""
+tests cover
+   primersjuju.amplicon_isoform_query
+"""
+from types import SimpleNamespace
+from primersjuju.transcript_features import TranscriptId
+from primersjuju.amplicon_isoform_query import AmpliconIsoformQuery, AmplifiedIsoform
+from .testfuncs import make_transcript, make_primer_features
+
+def _make_design(blocks_5p, blocks_3p):
+    return SimpleNamespace(features_5p=make_primer_features(blocks_5p),
+                           features_3p=make_primer_features(blocks_3p))
+
+def test_amplified_isoforms():
+    transcripts = [make_transcript("T1", [(100, 200), (300, 400), (500, 600)]),
+                   make_transcript("T2", [(100, 200), (500, 600)]),
+                   make_transcript("T3", [(150, 200), (300, 400)]),
+                   make_transcript("T4", [(100, 180), (300, 400), (500, 600)])]
+    query = AmpliconIsoformQuery(transcripts)
+    designs = [_make_design([(120, 140)], [(520, 540)]),
+               # left primer spans the first junction
+               _make_design([(190, 200), (300, 310)], [(520, 540)])]
+    assert query.query(designs) == [[AmplifiedIsoform(TranscriptId("isoforms", "T1"), 220),
+                                     AmplifiedIsoform(TranscriptId("isoforms", "T2"), 120),
+                                     AmplifiedIsoform(TranscriptId("isoforms", "T4"), 200)],
+                                    [AmplifiedIsoform(TranscriptId("isoforms", "T1"), 150)]]
+    assert query.query(designs, exclude_trans_ids=[TranscriptId("isoforms", "T1")]) == [
+        [AmplifiedIsoform(TranscriptId("isoforms", "T2"), 120), AmplifiedIsoform(TranscriptId("isoforms", "T4"), 200)],
+        []]
+    assert [t.trans_id.name for t in query.features_isoforms(designs[1].features_5p)] == ["T1", "T3"]
+    # primers swapped, as with a negative strand target
+    assert query.query([_make_design([(520, 540)], [(120, 140)])]) == query.query(designs[0:1])
+
+def test_amplified_isoforms_none():
+    query = AmpliconIsoformQuery([make_transcript("T1", [(100, 200)])])
+    assert query.query([_make_design([(300, 320)], [(520, 540)])]) == [[]]
+    assert query.query([]) == []
+
+def test_length_gaps():
+    target_transcript = make_transcript("T1", [(100, 200), (300, 400), (500, 600)])
+    transcripts = [target_transcript,
+                   make_transcript("T2", [(100, 200), (500, 600)]),
+                   make_transcript("T4", [(100, 180), (300, 400), (500, 600)]),
+                   # same amplicons as target
+                   make_transcript("T5", [(110, 200), (300, 400), (500, 620)])]
+    query = AmpliconIsoformQuery(transcripts)
+    designs = [_make_design([(120, 140)], [(520, 540)]),
+               _make_design([(190, 200), (300, 310)], [(520, 540)])]
+    designs[0].amplicon_length = 220
+    designs[1].amplicon_length = 150
+    assert query.length_gaps(designs, target_transcript) == [20, None]
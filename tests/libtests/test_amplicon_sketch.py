@@ -0,0 +1,44 @@
+"""
+tests cover
+   primersjuju.amplicon_sketch
+"""
+import os.path as osp
+import random
+from pycbio.hgdata import dnaOps
+from primersjuju.seq_codes import encode_seq
+from primersjuju.amplicon_sketch import AmpliconSketchSpec, AmpliconSketchIndex, sketch_hashes
+from .testfuncs import get_test_outdir, random_seq, make_test_twobit
+
+def _sketch_index(request, names=("T1", "P1", "U1"), **kwargs):
+    "transcriptome with a target, a paralog sharing part of it, and an unrelated transcript"
+    outdir = get_test_outdir(request)
+    rand = random.Random(4)
+    target = random_seq(rand, 2000)
+    seqs = dict(zip(names, (target,
+                            random_seq(rand, 500) + dnaOps.reverseComplement(target[200:600]) + random_seq(rand, 500),
+                            random_seq(rand, 2000))))
+    twobit = make_test_twobit(outdir, "transcriptome.2bit", seqs)
+    return AmpliconSketchIndex(AmpliconSketchSpec(twobit, osp.join(outdir, "index"), **kwargs)), target
+
+def test_sketch_canonical():
+    seq = random_seq(random.Random(5), 500)
+    assert sketch_hashes(encode_seq(seq), 21, 4).tolist() == sketch_hashes(encode_seq(dnaOps.reverseComplement(seq)), 21, 4).tolist()
+    assert len(sketch_hashes(encode_seq(seq), 21, 1)) == 480
+
+def test_similar_transcripts(request):
+    index, target = _sketch_index(request, scale=1)
+    amplicon = target[100:700]
+    similar = index.query([amplicon, target[1000:1500]], [{"T1"}, {"T1"}])
+    assert [s.name for s in similar[0]] == ["P1"]
+    # shared region k-mers, plus any where random flanking bases happen to match
+    assert 380 <= similar[0][0].shared <= 385
+    assert abs(similar[0][0].containment - similar[0][0].shared / 580) < 1e-6
+    assert similar[1] == []
+    similar = index.query([amplicon], [set()])
+    assert [(s.name, s.containment) for s in similar[0]][0] == ("T1", 1.0)
+
+def test_similar_transcripts_gene_names(request):
+    # transcriptome names with gene names are excluded by trans_id
+    index, target = _sketch_index(request, names=("T1__GENE1", "P1__GENE2", "U1__GENE3"), scale=1)
+    similar = index.query([target[100:700]], [{"T1"}])
+    assert [s.name for s in similar[0]] == ["P1__GENE2"]
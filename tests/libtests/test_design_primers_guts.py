@@ -3,10 +3,21 @@ tests cover
    primersjuju.design_primers
 these are faster tests that check various function that don't use isPcr queries.
 """
+import os
+import os.path as osp
 import re
+import multiprocessing
+from types import SimpleNamespace
 import pytest
+from pycbio.hgdata.coords import Coords
 from primersjuju import PrimersJuJuDataError
-from .testfuncs import get_test_id, run_primer_design_test
+from primersjuju.primer3_interface import primer3_design, primer3_oligo_3p_positions
+from primersjuju.primer_uniqueness import PrimerUniqueness
+from primersjuju.uniqueness_query import GenomeHit
+from primersjuju.design_primers import design_primers, DesignStatus, primer_design_amplicon, _primer_variant_dist_3p, _build_primer_designs, _primer_design_variant_score
+from primersjuju.variant_store import VariantStoreSpec, VariantStore, Variant, PrimerVariant
+from primersjuju.sweep import sweep_design
+from .testfuncs import get_test_id, run_primer_design_test, make_primer3_config, build_test_primer_targets
 
 def test_pos_strand(request, config_hg38, wtc11_targets_specs_set1):
     # simple positive strand case, both regions in exons
@@ -73,3 +84,188 @@ def test_too_short(request, config_hg38, wtc11_targets_specs_set1):
                        match=re.escape('transcript WTC11_consolidated/NNC_64139 region chr19:50658490-50658506 exon length 16 is less than PRIMER_MIN_SIZE 18')):
         run_primer_design_test(get_test_id(request), config_hg38, wtc11_targets_specs_set1,
                                "C19orf81+1")
+
+# per-pair primer3 fields used by design and output
+_pair_fields = ("PRIMER_LEFT", "PRIMER_RIGHT", "PRIMER_LEFT_SEQUENCE", "PRIMER_RIGHT_SEQUENCE",
+                "PRIMER_LEFT_TM", "PRIMER_RIGHT_TM", "PRIMER_LEFT_GC_PERCENT", "PRIMER_RIGHT_GC_PERCENT",
+                "PRIMER_LEFT_END_STABILITY", "PRIMER_RIGHT_END_STABILITY", "PRIMER_LEFT_PENALTY", "PRIMER_RIGHT_PENALTY",
+                "PRIMER_LEFT_HAIRPIN_TH", "PRIMER_RIGHT_HAIRPIN_TH", "PRIMER_LEFT_SELF_ANY_TH", "PRIMER_RIGHT_SELF_ANY_TH",
+                "PRIMER_LEFT_SELF_END_TH", "PRIMER_RIGHT_SELF_END_TH", "PRIMER_PAIR_PENALTY", "PRIMER_PAIR_PRODUCT_SIZE",
+                "PRIMER_PAIR_COMPL_ANY_TH", "PRIMER_PAIR_COMPL_END_TH")
+
+def test_split_pair_picking(config_hg38, wtc11_targets_specs_set1):
+    # split picking results have the same shape as primer3 pair picking
+    primer3_config = make_primer3_config(pair_picking="split")
+    primer_targets = build_test_primer_targets(config_hg38, wtc11_targets_specs_set1, "SNAI1+1")
+    target_transcript = primer_targets.transcripts[0]
+    primer3_results = primer3_design(primer3_config, target_transcript)
+    assert primer3_results.PRIMER_PAIR_NUM_RETURNED == 5
+    assert primer3_results.PRIMER_LEFT_NUM_RETURNED == primer3_results.PRIMER_RIGHT_NUM_RETURNED == 5
+    assert [pair.result_num for pair in primer3_results.pairs] == [0, 1, 2, 3, 4]
+    for pair in primer3_results.pairs:
+        assert [fld for fld in _pair_fields if fld not in pair] == []
+    penalties = [pair.PRIMER_PAIR_PENALTY for pair in primer3_results.pairs]
+    assert penalties == sorted(penalties)
+
+    primer_designs = _build_primer_designs(primer_targets, target_transcript, primer3_results, None, None)
+    assert len(primer_designs.designs) == 5
+    assert primer_designs.status == DesignStatus.GOOD
+    for primer_design in primer_designs.designs:
+        amplicon = primer_design_amplicon(primer_design, target_transcript)
+        assert len(amplicon) == primer_design.primer3_pair.PRIMER_PAIR_PRODUCT_SIZE
+        assert amplicon.startswith(primer_design.primer3_pair.PRIMER_LEFT_SEQUENCE)
+
+def test_prescreen(config_hg38, wtc11_targets_specs_set1):
+    # OK regions are narrowed to the feasible oligo windows, which doesn't lose the best pair
+    primer3_config = make_primer3_config(prescreen=True)
+    primer_targets = build_test_primer_targets(config_hg38, wtc11_targets_specs_set1, "SNAI1+1")
+    primer_designs = design_primers(primer3_config, primer_targets)
+    assert primer_designs.status == DesignStatus.GOOD
+    assert len(primer_designs.designs) == 5
+    p3p = primer_designs.designs[0].primer3_pair
+    assert p3p.PRIMER_LEFT_SEQUENCE == 'CGAGTGGTTCTTCTGCGCTA'
+    assert p3p.PRIMER_RIGHT_SEQUENCE == 'TCATCAAAGTCCTGTGGGGC'
+
+def test_prescreen_no_oligos(config_hg38, wtc11_targets_specs_set1):
+    # no oligo passes a poly-X limit of zero, so primer3 is not run
+    primer3_config = make_primer3_config(prescreen=True, PRIMER_MAX_POLY_X=0)
+    primer_targets = build_test_primer_targets(config_hg38, wtc11_targets_specs_set1, "SNAI1+1")
+    primer_designs = design_primers(primer3_config, primer_targets)
+    assert primer_designs.status == DesignStatus.NO_PRIMERS
+    assert len(primer_designs.designs) == 0
+    primer3_results = primer_designs.primer3_results
+    assert primer3_results.PRIMER_PAIR_NUM_RETURNED == 0
+    assert primer3_results.PRIMER_PAIR_EXPLAIN == "prescreen: no feasible oligos, primer3 not run"
+    for side in ("LEFT", "RIGHT"):
+        explain = primer3_results[f"PRIMER_{side}_EXPLAIN"]
+        assert explain.startswith(f"prescreen {side}: considered ")
+        assert explain.endswith(", ok 0")
+
+def test_time_budget(config_hg38, wtc11_targets_specs_set1):
+    # budget is exceeded before primer3 starts
+    primer3_config = make_primer3_config(time_budget=0)
+    primer_targets = build_test_primer_targets(config_hg38, wtc11_targets_specs_set1, "SNAI1+1")
+    primer_designs = design_primers(primer3_config, primer_targets)
+    assert primer_designs.status == DesignStatus.TIMEOUT
+    assert len(primer_designs.designs) == 0
+
+def test_time_budget_kill(config_hg38, wtc11_targets_specs_set1):
+    # budget expires while the primer3 worker process is still running and it is killed
+    primer3_config = make_primer3_config(time_budget=0.01)
+    primer_targets = build_test_primer_targets(config_hg38, wtc11_targets_specs_set1, "SNAI1+1")
+    primer_designs = design_primers(primer3_config, primer_targets)
+    assert primer_designs.status == DesignStatus.TIMEOUT
+    assert len(primer_designs.designs) == 0
+    assert primer_designs.primer3_results.PRIMER_PAIR_EXPLAIN == "primer3 time budget of 0.01 seconds exceeded"
+    assert multiprocessing.active_children() == []
+
+def test_time_budget_worker(config_hg38, wtc11_targets_specs_set1):
+    # primer3 completes within the budget in the worker process, results are returned through the pipe
+    primer3_config = make_primer3_config(time_budget=60)
+    primer_targets = build_test_primer_targets(config_hg38, wtc11_targets_specs_set1, "SNAI1+1")
+    primer_designs = design_primers(primer3_config, primer_targets)
+    assert primer_designs.status == DesignStatus.GOOD
+    assert len(primer_designs.designs) == 5
+    p3p = primer_designs.designs[0].primer3_pair
+    assert p3p.PRIMER_LEFT == [22, 20]
+    assert p3p.PRIMER_RIGHT == [1026, 20]
+    assert p3p.PRIMER_LEFT_SEQUENCE == 'CGAGTGGTTCTTCTGCGCTA'
+    assert p3p.PRIMER_RIGHT_SEQUENCE == 'TCATCAAAGTCCTGTGGGGC'
+    assert multiprocessing.active_children() == []
+
+def _pair_seqs(primer3_pair):
+    return (primer3_pair.PRIMER_LEFT_SEQUENCE, primer3_pair.PRIMER_RIGHT_SEQUENCE)
+
+def _pairs_3p_positions(primer3_pairs):
+    return {pos for primer3_pair in primer3_pairs for pos in primer3_oligo_3p_positions(primer3_pair)}
+
+class _StubUniqueness:
+    """Stands in for isPcr queries, passed as both the uniqueness query and cache.
+    All pairs in the first batch except the first have a genome off-target,
+    pairs in later batches are unique.  The pairs of each batch are recorded."""
+    def __init__(self):
+        self.batches = []
+
+    def query_batch(self, uniqueness_query, pair_targets):
+        off_target = GenomeHit(Coords("chr1", 1000, 1020), Coords("chr1", 1500, 1520), None)
+        batch_num = len(self.batches)
+        self.batches.append([pair_target.primer3_pair for pair_target in pair_targets])
+        return [PrimerUniqueness([], [off_target] if ((batch_num == 0) and (i > 0)) else [], [], [], [], [])
+                for i in range(len(pair_targets))]
+
+def test_iterative_design(config_hg38, wtc11_targets_specs_set1):
+    primer3_config = make_primer3_config(design_max_rounds=3, design_min_good=2)
+    primer_targets = build_test_primer_targets(config_hg38, wtc11_targets_specs_set1, "SNAI1+1")
+    stub = _StubUniqueness()
+    primer_designs = design_primers(primer3_config, primer_targets, uniqueness_query=stub, uniqueness_cache=stub)
+    assert primer_designs.primer3_rounds == 2
+    assert len(stub.batches) == 2
+    round1_pairs, round2_pairs = stub.batches
+    assert len(round1_pairs) == 5
+    assert len(round2_pairs) > 0
+
+    # the 3' ends of the failed oligos are excluded in round 2, unless they are also in the GOOD pair
+    excluded_3p_positions = _pairs_3p_positions(round1_pairs[1:]) - _pairs_3p_positions(round1_pairs[0:1])
+    assert len(excluded_3p_positions) > 0
+    assert _pairs_3p_positions(primer_designs.primer3_results.pairs).isdisjoint(excluded_3p_positions)
+
+    # round 2 returned the GOOD pair from round 1 again, it was not queried again
+    round2_seqs = [_pair_seqs(pair) for pair in round2_pairs]
+    assert _pair_seqs(round1_pairs[0]) in [_pair_seqs(pair) for pair in primer_designs.primer3_results.pairs]
+    assert len(set(round2_seqs)) == len(round2_seqs)
+    assert set(round2_seqs).isdisjoint(_pair_seqs(pair) for pair in round1_pairs)
+
+    assert primer_designs.status == DesignStatus.GOOD
+    assert primer_designs.good_count == 1 + len(round2_pairs)
+    assert len(primer_designs.designs) == len(round1_pairs) + len(round2_pairs)
+    assert [pd.priority for pd in primer_designs.designs] == list(range(1, len(primer_designs.designs) + 1))
+
+def test_sweep(config_hg38, wtc11_targets_specs_set1):
+    primer3_variants = {"default": make_primer3_config(),
+                        "no_time": make_primer3_config(time_budget=0)}
+    primer_targets = build_test_primer_targets(config_hg38, wtc11_targets_specs_set1, "SNAI1+1")
+    sweep_results = sweep_design(primer3_variants, [primer_targets], max_workers=2)
+    assert [(r.target_id, r.variant) for r in sweep_results] == [("SNAI1+1", "default"), ("SNAI1+1", "no_time")]
+    assert sweep_results[0].primer_designs.status == DesignStatus.GOOD
+    assert sweep_results[1].primer_designs.status == DesignStatus.TIMEOUT
+
+def test_sweep_error(config_hg38, wtc11_targets_specs_set1):
+    # primer3 raises OSError for the bad variant, the other results are kept
+    primer3_variants = {"default": make_primer3_config(),
+                        "bad": make_primer3_config(PRIMER_OPT_SIZE=40)}
+    primer_targets = build_test_primer_targets(config_hg38, wtc11_targets_specs_set1, "SNAI1+1")
+    sweep_results = sweep_design(primer3_variants, [primer_targets], max_workers=2)
+    assert [(r.target_id, r.variant) for r in sweep_results] == [("SNAI1+1", "default"), ("SNAI1+1", "bad")]
+    assert sweep_results[0].primer_designs.status == DesignStatus.GOOD
+    assert sweep_results[1].primer_designs is None
+    assert isinstance(sweep_results[1].error, OSError)
+
+def test_primer_variant_dist_3p():
+    # primer spanning a splice junction, 10 bases in each exon
+    blocks = [Coords("chr1", 100, 110, strand='+', size=1000), Coords("chr1", 200, 210, strand='+', size=1000)]
+    variant = Variant("rs1", "chr1", 105, 106)
+    assert _primer_variant_dist_3p(blocks, variant, True) == 14
+    assert _primer_variant_dist_3p(blocks, variant, False) == 5
+    assert _primer_variant_dist_3p(blocks, Variant("rs2", "chr1", 208, 212), True) == 0
+
+def test_variant_store_priority(request, config_hg38, wtc11_targets_specs_set1):
+    # variant at the 3' end of the right primer of the best design
+    outdir = osp.join("output", get_test_id(request))
+    os.makedirs(outdir, exist_ok=True)
+    vcf_file = osp.join(outdir, "variants.vcf")
+    with open(vcf_file, "w") as fh:
+        print("chr20", 49988189, "rs1", "A", "G", ".", "PASS", ".", sep='\t', file=fh)
+    variant_store = VariantStore(VariantStoreSpec(vcf_file, osp.join(outdir, "store")))
+    primer_targets = build_test_primer_targets(config_hg38, wtc11_targets_specs_set1, "SNAI1+1")
+    primer_designs = design_primers(config_hg38.primer3, primer_targets, variant_store=variant_store)
+    assert [pd.ppair_id for pd in primer_designs.designs] == ["SNAI1+1_pp4", "SNAI1+1_pp2", "SNAI1+1_pp1",
+                                                              "SNAI1+1_pp5", "SNAI1+1_pp3"]
+    assert primer_designs.designs[-1].primer_variants == [PrimerVariant(Variant("rs1", "chr20", 49988188, 49988189), "right", 0)]
+    assert primer_designs.designs[0].primer_variants == []
+
+def test_variant_3p_bases():
+    # variants near a 3' end are scored worse, with nearness from the configuration
+    primer_design = SimpleNamespace(primer_variants=[PrimerVariant(Variant("rs1", "chr20", 100, 101), "left", 3)])
+    assert _primer_design_variant_score(SimpleNamespace(primer_variants=[]), 5) == 0
+    assert _primer_design_variant_score(primer_design, make_primer3_config().design_variant_3p_bases) == 2
+    assert _primer_design_variant_score(primer_design, 3) == 1
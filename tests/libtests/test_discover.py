@@ -0,0 +1,30 @@
+"""
+tests cover
+   primersjuju.discover
+"""
+from types import SimpleNamespace
+from primersjuju.discover import track_loci, discover_target_specs
+from .testfuncs import make_junction_index
+
+def _bed(chrom, start, end, name, strand):
+    return SimpleNamespace(chrom=chrom, chromStart=start, chromEnd=end, name=name, strand=strand)
+
+def test_track_loci():
+    beds = [_bed("chr1", 100, 500, "A1", '+'),
+            _bed("chr1", 150, 300, "B1", '-'),
+            _bed("chr1", 400, 900, "A2", '+'),
+            _bed("chr1", 600, 700, "B2", '-'),
+            _bed("chr1", 900, 1000, "A3", '+'),
+            _bed("chr2", 100, 200, "C1", '+')]
+    assert sorted([b.name for b in locus] for locus in track_loci(beds)) == [
+        ["A1", "A2"], ["A3"], ["B1"], ["B2"], ["C1"]]
+
+def test_discover_target_specs(request):
+    index, beds = make_junction_index(request)
+    primer_target_specs = list(discover_target_specs(index, index.genome_data.get_track("ann")))
+    assert [p.target_id for p in primer_target_specs] == ["T2+J1"]
+    primer_target_spec = primer_target_specs[0]
+    assert (primer_target_spec.region_5p.start, primer_target_spec.region_5p.end) == (150, 200)
+    assert (primer_target_spec.region_3p.start, primer_target_spec.region_3p.end) == (500, 550)
+    assert primer_target_spec.get_tracks_trans() == [("ann", "T2")]
+    assert primer_target_spec.user_attrs == {"suggest_junction": "chr1:201-500", "locus_isoforms": "3"}
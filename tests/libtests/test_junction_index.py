@@ -0,0 +1,30 @@
+"""
+tests cover
+   primersjuju.junction_index
+"""
+from primersjuju.transcript_features import TranscriptId
+from primersjuju.junction_index import JunctionIndex
+from .testfuncs import make_junction_index
+
+def _tids(*names):
+    return [TranscriptId("ann", name) for name in names]
+
+def test_transcript_sharing(request):
+    index, beds = make_junction_index(request)
+    sharings = index.transcript_sharing(TranscriptId("ann", "T1"), beds["T1"])
+    assert [(s.kind, s.gcoords.start, s.gcoords.end, s.same_coords, s.same_seq) for s in sharings] == [
+        ("junction", 200, 300, _tids("T3"), []),
+        ("exon_pair", 100, 400, [], []),
+        ("junction", 400, 500, [], _tids("P1")),
+        ("exon_pair", 300, 600, [], []),
+        ("junction", 600, 700, _tids("T2"), []),
+        ("exon_pair", 500, 800, _tids("T2"), [])]
+
+def test_suggest_regions(request):
+    index, beds = make_junction_index(request)
+    assert index.suggest_regions(TranscriptId("ann", "T1"), beds["T1"]) == []
+    suggestions = index.suggest_regions(TranscriptId("ann", "T2"), beds["T2"])
+    assert [((s.region_5p.start, s.region_5p.end), (s.region_3p.start, s.region_3p.end), s.sharing.gcoords.start)
+            for s in suggestions] == [((150, 200), (500, 550), 200)]
+    # reopened without rebuilding
+    assert JunctionIndex(index.spec, index.genome_data).suggest_regions(TranscriptId("ann", "T2"), beds["T2"]) == suggestions
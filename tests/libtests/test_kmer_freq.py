@@ -0,0 +1,39 @@
+"""
+tests cover
+   primersjuju.kmer_freq
+"""
+import os.path as osp
+import random
+from pycbio.hgdata import dnaOps
+from primersjuju.kmer_freq import KmerFreqSpec, KmerFreqTable, KmerFreqFilter
+from .testfuncs import get_test_outdir, random_seq, make_test_twobit
+
+def _repeat_genome(request):
+    "random genome with a repeat inserted many times, returns twobit and repeat"
+    rand = random.Random(3)
+    repeat = random_seq(rand, 30)
+    seqs = {f"chr{i}": "".join([random_seq(rand, 200) + repeat for _ in range(10)]) for i in range(1, 3)}
+    return make_test_twobit(get_test_outdir(request), "genome.2bit", seqs), repeat
+
+def _kmer_freq_spec(request, twobit, **kwargs):
+    return KmerFreqSpec(twobit, osp.join(get_test_outdir(request), "kmer_freqs.npy"), **kwargs)
+
+def test_kmer_freq_counts(request):
+    twobit, repeat = _repeat_genome(request)
+    table = KmerFreqTable(_kmer_freq_spec(request, twobit, kmer_size=11))
+    freqs = table.seq_kmer_freqs(repeat)
+    assert list(freqs[0:20]) == 20 * [20]
+    assert list(freqs[20:]) == 10 * [0]  # runs off end
+    # both strands counted
+    assert list(table.seq_kmer_freqs(dnaOps.reverseComplement(repeat))[0:20]) == 20 * [20]
+
+def test_kmer_freq_3p_positions(request):
+    twobit, repeat = _repeat_genome(request)
+    table = KmerFreqTable(_kmer_freq_spec(request, twobit, kmer_size=12, max_freq=10))
+    template = 100 * "N" + repeat + 100 * "N" + repeat + 100 * "N"
+    ok_regions = [[90, 50, 220, 50]]
+    # left 3' ends are the last base of a repeat k-mer, right are the first
+    assert KmerFreqFilter([table]).high_freq_3p_positions(template, ok_regions) == (set(range(111, 130)) |
+                                                                                    set(range(230, 249)))
+    table = KmerFreqTable(_kmer_freq_spec(request, twobit, kmer_size=12, max_freq=20))
+    assert KmerFreqFilter([table]).high_freq_3p_positions(template, ok_regions) == set()
@@ -0,0 +1,90 @@
+"""
+tests cover
+   primersjuju.kmer_pcr
+"""
+import os
+import os.path as osp
+import pytest
+from primersjuju import PrimersJuJuError
+from primersjuju.kmer_pcr import LocalPcrSpec, KmerPcrIndex
+from primersjuju.uniqueness_query import UniquenessQuery, PrimerPairQuery, PcrAlignment
+from .testfuncs import get_test_id
+
+def _local_pcr_spec(request, twobit, **kwargs):
+    return LocalPcrSpec(twobit, osp.join("output", get_test_id(request), "index"), kmer_size=10, **kwargs)
+
+def test_kmer_pcr_products(request, local_pcr_genome):
+    twobit, left_primer, right_primer = local_pcr_genome
+    index = KmerPcrIndex(_local_pcr_spec(request, twobit))
+    products = index.pcr_products(left_primer, right_primer, 10000)
+    assert [tuple(p) for p in products] == [("chr2", 1000, 5020, '+', 20000), ("chr3", 2000, 3020, '+', 20000)]
+    products = index.pcr_products(right_primer, left_primer, 10000)
+    assert [tuple(p) for p in products] == [("chr2", 1000, 5020, '-', 20000), ("chr3", 2000, 3020, '-', 20000)]
+    # max_size
+    assert [p.seq_name for p in index.pcr_products(left_primer, right_primer, 2000)] == ["chr3"]
+
+def test_kmer_pcr_mismatches(request, local_pcr_genome):
+    twobit, left_primer, right_primer = local_pcr_genome
+    index = KmerPcrIndex(_local_pcr_spec(request, twobit, max_mismatches=0))
+    assert [p.seq_name for p in index.pcr_products(left_primer, right_primer, 10000)] == ["chr2"]
+
+def test_kmer_pcr_rebuild(request, local_pcr_genome):
+    twobit, left_primer, right_primer = local_pcr_genome
+    spec = _local_pcr_spec(request, twobit)
+    KmerPcrIndex(spec)
+    mtime = os.stat(osp.join(spec.index_dir, "index.json")).st_mtime_ns
+    KmerPcrIndex(spec)
+    assert os.stat(osp.join(spec.index_dir, "index.json")).st_mtime_ns == mtime
+    os.utime(twobit, ns=(mtime + 10**9, mtime + 10**9))
+    KmerPcrIndex(spec)
+    assert os.stat(osp.join(spec.index_dir, "index.json")).st_mtime_ns != mtime
+
+def test_kmer_pcr_uniqueness_query(request, local_pcr_genome):
+    twobit, left_primer, right_primer = local_pcr_genome
+    uniqueness_query = UniquenessQuery(None, _local_pcr_spec(request, twobit), None)
+    hits = uniqueness_query.query_genome("pp1", left_primer, right_primer, 10000)
+    assert [str(h.get_genome_range()) for h in hits] == ["chr2:1000-5020", "chr3:2000-3020"]
+    assert [(h.alignment.match, h.alignment.misMatch) for h in hits] == [(40, 0), (38, 2)]
+
+def _batch_hit_ranges(batch_hits):
+    return {name: [str(h.get_genome_range()) for h in hits] for name, hits in batch_hits.items()}
+
+def test_kmer_pcr_uniqueness_batch_concurrent(request, local_pcr_genome):
+    # batch split over concurrent local queries gives the serial results, in input order
+    twobit, left_primer, right_primer = local_pcr_genome
+    queries = [PrimerPairQuery(f"pp{i}", *primers)
+               for i, primers in enumerate(5 * [(left_primer, right_primer), (right_primer, left_primer), (left_primer, left_primer)])]
+    queries.reverse()
+    serial_hits = UniquenessQuery(None, _local_pcr_spec(request, twobit), None).query_genome_batch(queries, 10000)
+    concurrent_hits = UniquenessQuery(None, _local_pcr_spec(request, twobit, max_in_flight=4), None).query_genome_batch(queries, 10000)
+    assert list(concurrent_hits.keys()) == [query.name for query in queries]
+    assert _batch_hit_ranges(concurrent_hits) == _batch_hit_ranges(serial_hits)
+    assert _batch_hit_ranges(concurrent_hits)["pp0"] == ["chr2:1000-5020", "chr3:2000-3020"]
+    assert _batch_hit_ranges(concurrent_hits)["pp2"] == []
+
+def test_kmer_pcr_max_in_flight_invalid(request, local_pcr_genome):
+    twobit, left_primer, right_primer = local_pcr_genome
+    with pytest.raises(PrimersJuJuError, match="max_in_flight must be at least 1"):
+        UniquenessQuery(None, _local_pcr_spec(request, twobit, max_in_flight=0), None)
+
+def test_kmer_pcr_uniqueness_stream(request, local_pcr_genome):
+    twobit, left_primer, right_primer = local_pcr_genome
+    uniqueness_query = UniquenessQuery(None, _local_pcr_spec(request, twobit), None)
+    hits = []
+    assert uniqueness_query.submit_genome_stream("pp1", left_primer, right_primer, 10000, lambda h: hits.append(h) or True).result()
+    assert [str(h.get_genome_range()) for h in hits] == ["chr2:1000-5020", "chr3:2000-3020"]
+    assert isinstance(hits[0].alignment, PcrAlignment)
+    assert [tuple(b) for b in hits[0].alignment.blocks] == [(1000, 1020), (5000, 5020)]
+
+    # stop after first hit
+    hits = []
+    assert not uniqueness_query.submit_genome_stream("pp1", left_primer, right_primer, 10000, lambda h: hits.append(h) or False).result()
+    assert [str(h.get_genome_range()) for h in hits] == ["chr2:1000-5020"]
+
+def test_kmer_pcr_oligo_sites(request, local_pcr_genome):
+    twobit, left_primer, right_primer = local_pcr_genome
+    index = KmerPcrIndex(_local_pcr_spec(request, twobit))
+    left_sites = index.oligo_sites(left_primer)
+    assert len(left_sites.fwd) == 2
+    assert len(left_sites.rc) == 0
+    assert index.oligo_sites(left_primer.lower()) is left_sites
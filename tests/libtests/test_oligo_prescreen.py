@@ -0,0 +1,36 @@
+"""
+tests cover
+   primersjuju.oligo_prescreen
+"""
+import primer3
+from primersjuju.oligo_prescreen import oligo_window_metrics, oligo_region_screen, prescreen_narrow_ok_regions
+
+def test_window_metrics_left():
+    metrics = oligo_window_metrics("AAAAAAGCGCTTTC", 0, 14, 5, "LEFT", {})
+    assert metrics.starts.tolist() == [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+    assert metrics.gc_percent.tolist() == [0.0, 0.0, 20.0, 40.0, 60.0, 80.0, 80.0, 60.0, 40.0, 40.0]
+    assert metrics.max_poly_x.tolist() == [5, 5, 4, 3, 2, 1, 1, 2, 3, 3]
+    assert metrics.end_gc.tolist() == [0, 0, 1, 2, 3, 4, 4, 3, 2, 2]
+    assert metrics.clamp_gc.tolist() == [0, 0, 1, 2, 3, 4, 0, 0, 0, 1]
+
+def test_window_metrics_right():
+    # 3' end of right primer is at the start of the window
+    metrics = oligo_window_metrics("AAAAAAGCGCTTTC", 0, 14, 5, "RIGHT", {})
+    assert metrics.clamp_gc.tolist() == [0, 0, 0, 0, 0, 0, 4, 3, 2, 1]
+
+def test_window_tm():
+    seq = "AGAATGGCCCTGACGATTACGCAAGTCCG"
+    metrics = oligo_window_metrics(seq, 2, len(seq), 20, "LEFT", {})
+    for start, tm in zip(metrics.starts, metrics.tm):
+        assert abs(tm - primer3.bindings.calc_tm(seq[start:start + 20])) < 0.01
+
+def test_region_screen():
+    seq = 60 * "A" + "AGAATGGCCCTGACGATTACGCAAGTCCG" + 60 * "T"
+    global_args = {"PRIMER_MIN_SIZE": 18, "PRIMER_MAX_SIZE": 22}
+    screen = oligo_region_screen(seq, (0, 60), "LEFT", global_args)
+    assert not screen.feasible
+    assert screen.num_considered == screen.num_gc
+    screen = oligo_region_screen(seq, (20, 100), "LEFT", global_args)
+    assert screen.feasible
+    assert screen.feasible_region == [56, 38]
+    assert prescreen_narrow_ok_regions([(screen, screen)]) == [[56, 38, 56, 38]]
@@ -2,7 +2,9 @@
 tests cover
    primersjuju.primer3_interface
 """
-from primersjuju.primer3_interface import primer3_parse_output, primer3_annotate_amplicon
+import numpy as np
+from primersjuju.primer3_interface import primer3_parse_output, primer3_annotate_amplicon, split_pair_metrics
+from primersjuju.primer3_interface import _soft_mask_runs, _soft_mask_template
 from primersjuju.primer_targets import primer_targets_build
 
 # not much tested here, mostly is done in test_design_primers
@@ -150,3 +152,21 @@ def test_annotate_amplicon(config_hg38, wtc11_targets_specs_set1):
                        'CTACCTGCTCAAACACATGGTCACGCACACCGGCGTGCGCGCCTTCCAGTGCGCCGTCTGCGCCAAGCGCTTCACGCAGAAGAGCTCGCTCAACGTGCACATGCGCACTCACCGGCCCGAGCGCGCGCCCTGCCCCGCCTGCGGCAAGGTCTTCTCGCACCGCGCGCTGCTGGAGCGCCACCTGGCGGCGCACCCTGCGC'
                        'CCTGATGGCGCTGGGGCCTGGCCTCGCCCACGGTGGATCCGGGGCCTCCCGCACAGTCGGCCACGCCCGCTGCGGGACCCGTGGTTCCCGCCACTAGACCACGCTCCCTCCTGAGCGCAGGTCCTCTCTCTCCCTTCACCCTTTCTCCATACCAGGGCCTAAGTCCGCCTTACTCCTCTCCTCCATGTACTTGAACCCTC'
                        'CAGGTGGTGCCGGGCTGGGGCTGGGGCTGGTTAGACCACTTCTGAGAACTGGACTATTTCCTGCGTAAACCGGGCGCTCAGGCGCTTGGACCCGGCCCAAGATTTGACTCCGGT')
+
+def test_split_pair_metrics():
+    product_size, diff_tm, penalty, ok = split_pair_metrics(np.array([10, 20]), np.array([60.0, 57.0]), np.array([0.5, 1.0]),
+                                                            np.array([1009, 5009]), np.array([60.5, 63.5]), np.array([0.25, 2.0]),
+                                                            [[500, 2000]], {})
+    assert product_size.tolist() == [[1000, 5000], [990, 4990]]
+    assert diff_tm.tolist() == [[0.5, 3.5], [3.5, 6.5]]
+    assert penalty.tolist() == [[0.75, 2.5], [1.25, 3.0]]
+    assert ok.tolist() == [[True, False], [True, False]]
+
+def test_soft_mask_runs():
+    rna_soft_masked = "ACgtacGTaGTacgtNnnA"
+    starts, ends = _soft_mask_runs(rna_soft_masked, 3)
+    assert starts.tolist() == [2, 11] and ends.tolist() == [6, 15]
+    starts, ends = _soft_mask_runs(rna_soft_masked, 1)
+    assert starts.tolist() == [2, 8, 11, 16] and ends.tolist() == [6, 9, 15, 18]
+    assert _soft_mask_template(rna_soft_masked.upper(), rna_soft_masked, 3) == "ACgtacGTAGTacgtNNNA"
+    assert _soft_mask_template("ACGT", "ACGT", 3) == "ACGT"
@@ -0,0 +1,44 @@
+"""
+tests cover
+   primersjuju.splice_graph
+"""
+from primersjuju.splice_graph import SpliceGraph
+from .testfuncs import make_transcript, make_primer_features
+
+def _names(transcripts):
+    return [t.trans_id.name for t in transcripts]
+
+def _isoforms_splice_graph():
+    return SpliceGraph([make_transcript("T1", [(100, 200), (300, 400), (500, 600)]),
+                        make_transcript("T2", [(100, 200), (500, 600)]),
+                        make_transcript("T3", [(150, 200), (300, 400)]),
+                        make_transcript("T4", [(100, 180), (300, 400), (500, 600)])])
+
+def test_splice_graph_build():
+    splice_graph = _isoforms_splice_graph()
+    assert splice_graph.node_starts.tolist() == [100, 150, 180, 300, 500]
+    assert splice_graph.node_ends.tolist() == [150, 180, 200, 400, 600]
+    assert [_names(splice_graph.bits_transcripts(b)) for b in splice_graph.node_bits] == [
+        ["T1", "T2", "T4"], ["T1", "T2", "T3", "T4"], ["T1", "T2", "T3"], ["T1", "T3", "T4"], ["T1", "T2", "T4"]]
+    assert list(zip(splice_graph.junc_donors.tolist(), splice_graph.junc_acceptors.tolist())) == [
+        (180, 300), (200, 300), (200, 500), (400, 500)]
+
+def test_splice_graph_queries():
+    splice_graph = _isoforms_splice_graph()
+    assert _names(splice_graph.bits_transcripts(splice_graph.segment_bits(120, 190))) == ["T1", "T2"]
+    assert _names(splice_graph.bits_transcripts(splice_graph.segment_bits(190, 310))) == []
+    assert _names(splice_graph.bits_transcripts(splice_graph.junction_bits(200, 300))) == ["T1", "T3"]
+    assert _names(splice_graph.bits_transcripts(splice_graph.junction_bits(200, 400))) == []
+    # junction-spanning primer
+    assert _names(splice_graph.features_transcripts(make_primer_features([(190, 200), (300, 310)]))) == ["T1", "T3"]
+    assert _names(splice_graph.features_transcripts(make_primer_features([(170, 180), (300, 310)]))) == ["T4"]
+    assert _names(splice_graph.features_transcripts(make_primer_features([(520, 540)]))) == ["T1", "T2", "T4"]
+
+def test_splice_graph_many_isoforms():
+    # more than one bitset word
+    transcripts = [make_transcript(f"T{i}", [(100, 200), (300 + i, 400)]) for i in range(100)]
+    splice_graph = SpliceGraph(transcripts)
+    assert splice_graph.num_words == 2
+    assert _names(splice_graph.features_transcripts(make_primer_features([(370, 390)]))) == [
+        f"T{i}" for i in range(71)]
+    assert _names(splice_graph.features_transcripts(make_primer_features([(190, 200), (390, 400)]))) == ["T90"]
@@ -2,11 +2,12 @@
 tests cover
    primersjuju.transcript_features
 """
+import numpy as np
 from pycbio.hgdata.coords import Coords
 from primersjuju.transcript_features import (ExonFeature, IntronFeature, Features,
                                              bed_to_features, features_intersect_genome,
                                              transcript_range_to_features, features_to_genomic_coords,
-                                             features_to_transcript_coords)
+                                             features_to_transcript_coords, ExonIntervalIndex)
 
 def transcript_region_check(config_hg38, wtc11_track, trans_id, region, expected_feats):
     trans_bed = wtc11_track.read_by_name(trans_id)
@@ -148,3 +149,11 @@ def test_features_to_tcoords():
 
     tcoords = features_to_transcript_coords(list(reversed(features_tpos)))
     assert tcoords == expect_tcoords
+
+def test_exon_interval_index():
+    index = ExonIntervalIndex(features_tneg)
+    assert list(index.starts) == [58514260, 58517667, 58519741]
+    chroms = np.array(['chr19', 'chr19', 'chr19', 'chr19', 'chr1'], dtype=object)
+    starts = np.array([58514270, 58514280, 58517600, 58519755, 58514270])
+    ends = np.array([58514290, 58517667, 58517668, 58519800, 58514290])
+    assert list(index.overlaps(chroms, starts, ends)) == [True, False, True, False, False]
@@ -0,0 +1,80 @@
+"""
+tests cover
+   primersjuju.uniqueness_cache
+"""
+import os
+import os.path as osp
+import shutil
+from primersjuju.kmer_pcr import LocalPcrSpec
+from primersjuju.uniqueness_cache import PcrResultCache
+from primersjuju.uniqueness_query import UniquenessQuery, PrimerPairQuery, IsPcrServerSpec
+from . import mydir
+from .testfuncs import get_test_id
+
+def _setup(request, local_pcr_genome):
+    twobit, left_primer, right_primer = local_pcr_genome
+    outdir = osp.join("output", get_test_id(request))
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.makedirs(outdir)
+    test_twobit = osp.join(outdir, "genome.2bit")
+    shutil.copy(twobit, test_twobit)
+    spec = LocalPcrSpec(test_twobit, osp.join(outdir, "index"), kmer_size=10)
+    return spec, osp.join(outdir, "cache.db"), left_primer, right_primer
+
+def test_cache_hit(request, local_pcr_genome):
+    spec, cache_db, left_primer, right_primer = _setup(request, local_pcr_genome)
+    uniqueness_query = UniquenessQuery(None, spec, None, pcr_cache=PcrResultCache(cache_db))
+    hits1 = uniqueness_query.query_genome("pp1", left_primer, right_primer, 10000)
+    assert uniqueness_query.pcr_cache.count() == 1
+
+    # new process, results come from the cache with the new name
+    uniqueness_query = UniquenessQuery(None, spec, None, pcr_cache=PcrResultCache(cache_db))
+    uniqueness_query._genome_server.native_client = None  # would fail if not cached
+    hits2 = uniqueness_query.query_genome("pp2", left_primer, right_primer, 10000)
+    assert [h.get_genome_range() for h in hits2] == [h.get_genome_range() for h in hits1]
+    assert [h.alignment.qName for h in hits2] == ["pp2", "pp2"]
+
+def test_cache_batch(request, local_pcr_genome):
+    spec, cache_db, left_primer, right_primer = _setup(request, local_pcr_genome)
+    uniqueness_query = UniquenessQuery(None, spec, None, pcr_cache=PcrResultCache(cache_db))
+    uniqueness_query.query_genome("pp1", left_primer, right_primer, 10000)
+    hits = uniqueness_query.query_genome_batch([PrimerPairQuery("pp1", left_primer, right_primer),
+                                                PrimerPairQuery("pp2", right_primer, left_primer)], 10000)
+    assert [len(hits["pp1"]), len(hits["pp2"])] == [2, 2]
+    assert uniqueness_query.pcr_cache.count() == 2
+
+def test_cache_invalidate(request, local_pcr_genome):
+    spec, cache_db, left_primer, right_primer = _setup(request, local_pcr_genome)
+    uniqueness_query = UniquenessQuery(None, spec, None, pcr_cache=PcrResultCache(cache_db))
+    uniqueness_query.query_genome("pp1", left_primer, right_primer, 10000)
+    assert uniqueness_query.pcr_cache.count() == 1
+    mtime = os.stat(spec.twobit).st_mtime_ns + 10**9
+    os.utime(spec.twobit, ns=(mtime, mtime))
+    uniqueness_query = UniquenessQuery(None, spec, None, pcr_cache=PcrResultCache(cache_db))
+    assert uniqueness_query.pcr_cache.count() == 0
+
+def test_cache_trim(request, local_pcr_genome):
+    spec, cache_db, left_primer, right_primer = _setup(request, local_pcr_genome)
+    uniqueness_query = UniquenessQuery(None, spec, None, pcr_cache=PcrResultCache(cache_db, max_entries=2))
+    for max_size in (5000, 6000, 7000, 8000):
+        uniqueness_query.query_genome("pp1", left_primer, right_primer, max_size)
+    assert uniqueness_query.pcr_cache.count() == 2
+
+def test_cache_replicas(request, config_hg38, hg38_chr20_standin):
+    # replicas of a server share cached results
+    outdir = osp.join("output", get_test_id(request))
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.makedirs(outdir)
+    cache_db = osp.join(outdir, "cache.db")
+    left_primer, right_primer = 'GGTTCTTCTGCGCTACTGCT', 'CAAAAACCCACGCAGACAGG'
+
+    spec = IsPcrServerSpec("127.0.0.1", hg38_chr20_standin.port, osp.join(mydir, "../data"), client="native")
+    uniqueness_query = UniquenessQuery(config_hg38.genome, spec, None, pcr_cache=PcrResultCache(cache_db))
+    hits1 = uniqueness_query.query_genome("pp1", left_primer, right_primer, 200000)
+    assert len(hits1) == 1
+
+    # nothing is listening on this replica, so results must come from the cache
+    replica_spec = IsPcrServerSpec("127.0.0.1", 1, osp.join(mydir, "../data"), client="native")
+    uniqueness_query = UniquenessQuery(config_hg38.genome, replica_spec, None, pcr_cache=PcrResultCache(cache_db))
+    hits2 = uniqueness_query.query_genome("pp2", left_primer, right_primer, 200000)
+    assert [h.get_genome_range() for h in hits2] == [h.get_genome_range() for h in hits1]
@@ -2,11 +2,19 @@
 tests cover
    primersjuju.uniqueness_query
 """
+import os.path as osp
+import pytest
 from pycbio.hgdata.coords import Coords
 from pycbio.hgdata.psl import Psl
 
+from primersjuju import PrimersJuJuError
 from primersjuju.transcript_features import ExonFeature
-from primersjuju.uniqueness_query import GenomeHit, TranscriptomeHit
+from primersjuju.uniqueness_query import GenomeHit, TranscriptomeHit, PrimerPairQuery, IsPcrServerSpec, UniquenessQuery, _TranscriptomeHitConverter
+from primersjuju.primer_targets import primer_targets_build
+from primersjuju.primer3_interface import Primer3Pair
+from primersjuju.primer_uniqueness import primer_uniqueness_query, PrimerUniquenessCache, _HitClassifier, _ON_TARGET, _OFF_TARGET
+from . import mydir
+from .gfserver_standin import GfServerStandIn
 
 SNAI1_PRIMER_LEFT_SEQUENCE = 'GGTTCTTCTGCGCTACTGCT'
 SNAI1_PRIMER_RIGHT_SEQUENCE = 'CAAAAACCCACGCAGACAGG'
@@ -40,3 +48,131 @@ def test_uniqueness_query_transcriptome_junc(hg38_uniqueness_query):
                                                      ExonFeature(genome=Coords(name='chr19', start=58519741, end=58519755, strand='+', size=58617616),
                                                                  trans=Coords(name='ENST00000594051.6__ZBTB45', start=2060, end=2074, strand='-', size=2129))],
                                      alignment=Psl.fromRow(['40', '0', '0', '0', '1', '1303', '1', '1303', '+', 'ZBTB45+1', '1343', '0', '1343', 'ENST00000594051.6__ZBTB45', '2129', '55', '1398', '2', '20,20,', '0,1323,', '55,1378,']))]
+
+def _batch_queries():
+    return [PrimerPairQuery("SNAI1+1+pp1", SNAI1_PRIMER_LEFT_SEQUENCE, SNAI1_PRIMER_RIGHT_SEQUENCE),
+            PrimerPairQuery("ZBTB45+1", ZBTB45_PRIMER_LEFT_SEQUENCE, ZBTB45_PRIMER_RIGHT_SEQUENCE)]
+
+def test_uniqueness_query_genome_batch(hg38_uniqueness_query):
+    hits = hg38_uniqueness_query.query_genome_batch(_batch_queries(), 200000)
+    assert hits == {query.name: hg38_uniqueness_query.query_genome(*query, 200000)
+                    for query in _batch_queries()}
+
+def test_uniqueness_query_transcriptome_batch(hg38_uniqueness_query):
+    hits = hg38_uniqueness_query.query_transcriptome_batch(_batch_queries(), 200000)
+    assert hits == {query.name: hg38_uniqueness_query.query_transcriptome(*query, 200000)
+                    for query in _batch_queries()}
+
+@pytest.fixture(scope="module")
+def hg38_chr20_standin():
+    with GfServerStandIn(osp.join(mydir, "../data/hg38.2bit"), ["chr20"]) as standin:
+        yield standin
+
+def _native_uniqueness_query(config_hg38, standin, **kwargs):
+    return UniquenessQuery(config_hg38.genome,
+                           IsPcrServerSpec("127.0.0.1", standin.port, osp.join(mydir, "../data"),
+                                           client="native", **kwargs),
+                           None)
+
+def test_native_client_genome(config_hg38, hg38_chr20_standin, hg38_uniqueness_query):
+    uniqueness_query = _native_uniqueness_query(config_hg38, hg38_chr20_standin)
+    hits = uniqueness_query.query_genome("SNAI1+1+pp1", SNAI1_PRIMER_LEFT_SEQUENCE, SNAI1_PRIMER_RIGHT_SEQUENCE, 200000)
+    assert hits == hg38_uniqueness_query.query_genome("SNAI1+1+pp1", SNAI1_PRIMER_LEFT_SEQUENCE, SNAI1_PRIMER_RIGHT_SEQUENCE, 200000)
+
+def test_native_client_genome_reversed(config_hg38, hg38_chr20_standin):
+    # primers swapped gives a minus strand hit
+    uniqueness_query = _native_uniqueness_query(config_hg38, hg38_chr20_standin)
+    hits = uniqueness_query.query_genome("SNAI1_rev", SNAI1_PRIMER_RIGHT_SEQUENCE, SNAI1_PRIMER_LEFT_SEQUENCE, 200000)
+    assert hits == [GenomeHit(left_gcoords=Coords(name='chr20', start=49983006, end=49983026, strand='+', size=64444167),
+                              right_gcoords=Coords(name='chr20', start=49988321, end=49988341, strand='+', size=64444167),
+                              alignment=Psl.fromRow(['40', '0', '0', '0', '1', '5295', '1', '5295', '-', 'SNAI1_rev', '5335', '0', '5335', 'chr20', '64444167', '49983006', '49988341', '2', '20,20,', '0,5315,', '49983006,49988321,']))]
+
+def test_native_client_batch(config_hg38, hg38_chr20_standin):
+    uniqueness_query = _native_uniqueness_query(config_hg38, hg38_chr20_standin, max_in_flight=2)
+    hits = uniqueness_query.query_genome_batch(_batch_queries(), 200000)
+    assert list(hits.keys()) == ["SNAI1+1+pp1", "ZBTB45+1"]
+    assert len(hits["SNAI1+1+pp1"]) == 1
+    assert hits["ZBTB45+1"] == []  # not on chr20
+
+def test_native_client_dynamic(config_hg38):
+    with GfServerStandIn(osp.join(mydir, "../data/hg38.2bit"), ["chr20"], dyn_name="hg38") as standin:
+        uniqueness_query = _native_uniqueness_query(config_hg38, standin, dyn_name="hg38")
+        hits = uniqueness_query.query_genome("SNAI1+1+pp1", SNAI1_PRIMER_LEFT_SEQUENCE, SNAI1_PRIMER_RIGHT_SEQUENCE, 200000)
+        assert len(hits) == 1
+        uniqueness_query = _native_uniqueness_query(config_hg38, standin, dyn_name="mm39")
+        with pytest.raises(PrimersJuJuError, match="unknown dynamic genome"):
+            uniqueness_query.query_genome("SNAI1+1+pp1", SNAI1_PRIMER_LEFT_SEQUENCE, SNAI1_PRIMER_RIGHT_SEQUENCE, 200000)
+
+def _snai1_pair(config_hg38, wtc11_targets_specs_set1):
+    "target transcript and Primer3Pair for the SNAI1 primers"
+    target_transcript = primer_targets_build(config_hg38.genome, wtc11_targets_specs_set1.get_target("SNAI1+1")).transcripts[0]
+    primer3_pair = Primer3Pair(0)
+    primer3_pair.PRIMER_LEFT_SEQUENCE = SNAI1_PRIMER_LEFT_SEQUENCE
+    primer3_pair.PRIMER_RIGHT_SEQUENCE = SNAI1_PRIMER_RIGHT_SEQUENCE
+    return target_transcript, primer3_pair
+
+def test_native_client_tiered(config_hg38, hg38_chr20_standin, wtc11_targets_specs_set1):
+    target_transcript, primer3_pair = _snai1_pair(config_hg38, wtc11_targets_specs_set1)
+    uniqueness = primer_uniqueness_query(_native_uniqueness_query(config_hg38, hg38_chr20_standin),
+                                         target_transcript, "SNAI1+1+pp1", primer3_pair)
+    assert uniqueness.tier is None
+    assert uniqueness.genome_on_target_cnt == 1
+
+    # no off-targets in first tier, so decided by the second
+    uniqueness = primer_uniqueness_query(_native_uniqueness_query(config_hg38, hg38_chr20_standin, first_tier_size_factor=1.5),
+                                         target_transcript, "SNAI1+1+pp1", primer3_pair)
+    assert uniqueness.tier == 2
+    assert uniqueness.genome_on_target_cnt == 1
+
+def test_uniqueness_cache_failure(config_hg38, hg38_chr20_standin, wtc11_targets_specs_set1):
+    # a failed query is not cached, so a later request queries again
+    target_transcript, primer3_pair = _snai1_pair(config_hg38, wtc11_targets_specs_set1)
+    uniqueness_cache = PrimerUniquenessCache()
+    with GfServerStandIn(osp.join(mydir, "../data/hg38.2bit"), ["chr20"], dyn_name="hg38") as dyn_standin:
+        with pytest.raises(PrimersJuJuError):
+            uniqueness_cache.query(_native_uniqueness_query(config_hg38, dyn_standin), target_transcript, "SNAI1+1+pp1", primer3_pair)
+    uniqueness = uniqueness_cache.query(_native_uniqueness_query(config_hg38, hg38_chr20_standin),
+                                        target_transcript, "SNAI1+1+pp1", primer3_pair)
+    assert uniqueness.genome_on_target_cnt == 1
+
+def test_native_client_replicas(config_hg38, hg38_chr20_standin):
+    # replica expecting a dynamic server request fails and is dropped
+    with GfServerStandIn(osp.join(mydir, "../data/hg38.2bit"), ["chr20"], dyn_name="hg38") as bad_standin:
+        specs = [IsPcrServerSpec("127.0.0.1", standin.port, osp.join(mydir, "../data"), client="native")
+                 for standin in (bad_standin, hg38_chr20_standin)]
+        uniqueness_query = UniquenessQuery(config_hg38.genome, specs, None, replica_max_failures=1)
+        for _ in range(3):
+            hits = uniqueness_query.query_genome("SNAI1+1+pp1", SNAI1_PRIMER_LEFT_SEQUENCE, SNAI1_PRIMER_RIGHT_SEQUENCE, 200000)
+            assert len(hits) == 1
+        bad_stats, good_stats = uniqueness_query.server_stats()
+        assert (bad_stats.queries, bad_stats.failures, bad_stats.healthy) == (1, 1, False)
+        assert (good_stats.queries, good_stats.failures, good_stats.healthy) == (3, 0, True)
+
+def _hit_classes_stub(genome_data, target_transcript, hits):
+    # hits are their own class
+    return hits
+
+def test_hit_classifier_max_off_targets():
+    # exactly max_off_targets off-targets is not truncated
+    classifier = _HitClassifier(_hit_classes_stub, None, None, 2)
+    assert [classifier(hit) for hit in (_OFF_TARGET, _ON_TARGET, _OFF_TARGET)] == [True, True, True]
+    assert classifier.off_target_cnt == 2
+    assert not classifier.truncated
+    # a further hit stops the query and the count becomes a lower bound
+    assert not classifier(_ON_TARGET)
+    assert classifier.off_target_cnt == 2
+    assert classifier.truncated
+    assert classifier.classified == ([_ON_TARGET], [_OFF_TARGET, _OFF_TARGET], [])
+
+def test_trans_features_cache(config_hg38):
+    # memoized transcript features are limited to trans_cache_size, least recently used dropped
+    spec = IsPcrServerSpec("localhost", 0, osp.join(mydir, "../data"), trans_bigbed=osp.join(mydir, "../data/gencodeV39.bb"),
+                           trans_cache_size=2)
+    converter = _TranscriptomeHitConverter(config_hg38.genome, spec)
+    ids = ("ENST00000244050.3__SNAI1", "ENST00000226091.3__EFNB3", "ENST00000594051.6__ZBTB45")
+    trans_features = converter._get_trans_features(ids[0:2])
+    assert sorted(trans_features.keys()) == sorted(ids[0:2])
+    converter._get_trans_features(ids[0:1])
+    converter._get_trans_features(ids[2:3])
+    assert list(converter._trans_features.keys()) == [ids[0], ids[2]]
+    assert converter._get_trans_features(ids[1:2]) == {ids[1]: trans_features[ids[1]]}
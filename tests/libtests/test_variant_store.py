@@ -0,0 +1,50 @@
+"""
+tests cover
+   primersjuju.variant_store
+"""
+import os
+import os.path as osp
+import gzip
+from pycbio.hgdata.coords import Coords
+from primersjuju.variant_store import VariantStoreSpec, VariantStore, Variant
+from .testfuncs import get_test_id
+
+_vcf_recs = (("chr2", 11, "rs3", "A", "T", "AF=0.5"),
+             ("chr1", 151, ".", "ACG", "A", "AF=0.01"),
+             ("chr1", 101, "rs1", "A", "G", "AF=0.2,0.3"),
+             ("chr1", 201, "rs4", "C", "T", "DP=10"))
+
+def _write_vcf(vcf_file):
+    with gzip.open(vcf_file, "wt") as fh:
+        print("##fileformat=VCFv4.2", file=fh)
+        print("#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", sep='\t', file=fh)
+        for chrom, pos, var_id, ref, alt, info in _vcf_recs:
+            print(chrom, pos, var_id, ref, alt, ".", "PASS", info, sep='\t', file=fh)
+
+def _variant_store(request, **kwargs):
+    outdir = osp.join("output", get_test_id(request))
+    os.makedirs(outdir, exist_ok=True)
+    vcf_file = osp.join(outdir, "variants.vcf.gz")
+    _write_vcf(vcf_file)
+    return VariantStore(VariantStoreSpec(vcf_file, osp.join(outdir, "store"), **kwargs))
+
+def _gcoords(chrom, start, end):
+    return Coords(chrom, start, end, strand='+', size=1000)
+
+def test_variant_query(request):
+    store = _variant_store(request)
+    assert store.max_length == 3
+    assert store.query([_gcoords("chr1", 90, 101),
+                        _gcoords("chr1", 152, 160),
+                        _gcoords("chr1", 101, 150),
+                        _gcoords("chr2", 0, 100),
+                        _gcoords("chr3", 0, 100)]) == [
+        [Variant("rs1", "chr1", 100, 101)],
+        [Variant("chr1:151ACG>A", "chr1", 150, 153)],
+        [],
+        [Variant("rs3", "chr2", 10, 11)],
+        []]
+
+def test_variant_min_af(request):
+    store = _variant_store(request, min_af=0.1)
+    assert store.query([_gcoords("chr1", 0, 1000)]) == [[Variant("rs1", "chr1", 100, 101)]]
@@ -1,8 +1,19 @@
 """
 functions to support tests
 """
+import os
 import os.path as osp
+import struct
+import random
+from dataclasses import dataclass
 import pipettor
+from pycbio.hgdata import dnaOps
+from pycbio.hgdata.bed import Bed
+from pycbio.hgdata.coords import Coords
+from primersjuju.config import Primer3Config
+from primersjuju.genome_data import GenomeData, Track
+from primersjuju.transcript_features import TranscriptId, Transcript, ExonFeature, Features
+from primersjuju.junction_index import JunctionIndexSpec, JunctionIndex
 from primersjuju.primer_targets import primer_targets_build
 from primersjuju.design_primers import design_primers, primer_design_amplicon
 from primersjuju.output import output_target_designs
@@ -10,6 +21,10 @@ from primersjuju.output import output_target_designs
 def get_test_id(request):
     return request.node.name
 
+def get_test_outdir(request):
+    "output directory for a test"
+    return osp.join("output", get_test_id(request))
+
 def diff_expected(rel_name):
     pipettor.run(["diff", "-u",
                   osp.join("expected", rel_name),
@@ -24,10 +39,19 @@ def _check_primer_design(primer_designs, primer_design):
     assert primer_design.primer3_pair.PRIMER_PAIR_PRODUCT_SIZE == primer_design.amplicon_length, \
         f"primer3_pair.PRIMER_PAIR_PRODUCT_SIZE {primer_design.primer3_pair.PRIMER_PAIR_PRODUCT_SIZE} != primer_design.amplicon_length {primer_design.amplicon_length}"
 
+def make_primer3_config(**attrs):
+    "default primer3 configuration with the specified attributes changed"
+    primer3_config = Primer3Config()
+    for name, value in attrs.items():
+        setattr(primer3_config, name, value)
+    return primer3_config
+
+def build_test_primer_targets(config, targets_specs, target_id):
+    return primer_targets_build(config.genome, targets_specs.get_target(target_id))
+
 def run_primer_design_test(test_id, config, targets_specs, target_id, uniqueness_query=None):
     outdir = osp.join("output", test_id)
-    target_spec = targets_specs.get_target(target_id)
-    primer_targets = primer_targets_build(config.genome, target_spec)
+    primer_targets = build_test_primer_targets(config, targets_specs, target_id)
     primer_designs = design_primers(config.primer3, primer_targets, uniqueness_query=uniqueness_query)
 
     for primer_design in primer_designs.designs:
@@ -40,3 +64,89 @@ def run_primer_design_test(test_id, config, targets_specs, target_id, uniqueness
     for suffix in output_suffixes:
         diff_expected(osp.join(test_id, primer_targets.target_id + suffix))
     return primer_designs
+
+def write_twobit(twobit_file, seqs):
+    """write a dict of sequences to a 2bit file, must only contain ACGT"""
+    base_bits = {"T": 0, "C": 1, "A": 2, "G": 3}
+    names = list(seqs.keys())
+    offset = 16 + sum([1 + len(name) + 4 for name in names])
+    index = b""
+    records = b""
+    for name in names:
+        seq = seqs[name].upper()
+        index += bytes([len(name)]) + name.encode() + struct.pack("<I", offset + len(records))
+        packed = bytearray()
+        for i in range(0, len(seq), 4):
+            byte = 0
+            for base in seq[i:i + 4].ljust(4, "T"):
+                byte = (byte << 2) | base_bits[base]
+            packed.append(byte)
+        records += struct.pack("<IIII", len(seq), 0, 0, 0) + packed
+    with open(twobit_file, "wb") as fh:
+        fh.write(struct.pack("<IIII", 0x1A412743, 0, len(names), 0) + index + records)
+
+def random_seq(rand, length):
+    "random ACGT sequence generated with a random.Random"
+    return "".join(rand.choices("ACGT", k=length))
+
+def make_test_twobit(outdir, twobit_name, seqs):
+    """write a dict of sequences to a 2bit in outdir, which is created if
+    needed, returning the 2bit path"""
+    os.makedirs(outdir, exist_ok=True)
+    twobit = osp.join(outdir, twobit_name)
+    write_twobit(twobit, seqs)
+    return twobit
+
+_CHROM_SIZE = 100000
+
+def _make_exon(name, start, end, trans_start):
+    return ExonFeature(Coords("chr1", start, end, strand='+', size=_CHROM_SIZE),
+                       Coords(name, trans_start, trans_start + (end - start), strand='+', size=0))
+
+def make_transcript(name, exons):
+    """build a positive-strand chr1 Transcript from a list of (start, end) exons"""
+    features = Features()
+    trans_start = 0
+    for start, end in exons:
+        features.append(_make_exon(name, start, end, trans_start))
+        trans_start += end - start
+    return Transcript(trans_id=TranscriptId("isoforms", name), bed=None, features=features)
+
+def make_primer_features(blocks):
+    """build primer features from a list of (start, end) genomic blocks"""
+    return Features([_make_exon("T1", start, end, 0) for start, end in blocks])
+
+@dataclass
+class _BedListTrack(Track):
+    "track with BEDs in memory rather than a bigBed"
+    beds: list = None
+
+    def read_all(self):
+        return self.beds
+
+    def iter_all(self):
+        return iter(self.beds)
+
+def _make_bed(chrom, name, strand, blocks):
+    bed = Bed(chrom, blocks[0][0], blocks[-1][1], name, strand=strand)
+    for start, end in blocks:
+        bed.addBlock(start, end)
+    return bed
+
+def make_junction_index(request):
+    """Build a JunctionIndex on the "ann" track, returning it and a dict of the
+    BEDs by name.  chr1 has isoforms sharing junctions by coordinates, chr2 has
+    a negative-strand paralog sharing the sequence of a T1 junction"""
+    outdir = get_test_outdir(request)
+    rand = random.Random(7)
+    chr1 = random_seq(rand, 1000)
+    chr2 = dnaOps.reverseComplement(random_seq(rand, 100) + chr1[300:400] + random_seq(rand, 100) +
+                                    chr1[500:600] + random_seq(rand, 100))
+    genome_data = GenomeData("test", make_test_twobit(outdir, "genome.2bit", {"chr1": chr1, "chr2": chr2}))
+    beds = [_make_bed("chr1", "T1", '+', [(100, 200), (300, 400), (500, 600), (700, 800)]),
+            _make_bed("chr1", "T2", '+', [(100, 200), (500, 600), (700, 800)]),
+            _make_bed("chr1", "T3", '+', [(150, 200), (300, 400)]),
+            _make_bed("chr2", "P1", '-', [(100, 200), (300, 400)])]
+    genome_data.tracks["ann"] = _BedListTrack("ann", "ann.bb", "ann.bb", beds=beds)
+    index = JunctionIndex(JunctionIndexSpec(osp.join(outdir, "index"), ["ann"], region_flank=50), genome_data)
+    return index, {bed.name: bed for bed in beds}